@@ -0,0 +1,391 @@
+"""
+file: 'fetch.py'
+description:
+    This file contains an asyncio-based orchestrator for fetching a day's
+    rawacf files via the Globus sync script as several smaller queries,
+    rather than one query for the whole day.
+
+    A day is split into shards, either by station ('YYYYMMDD*sas') or by
+    hour ('YYYYMMDD.HH*'), and each shard is fetched into its own folder by
+    its own sync script subprocess. Up to 'concurrency' of these run at once,
+    and each shard is handed over as soon as its fetch completes, so that
+    it can be parsed while the rest of the day is still being fetched.
+
+    Where the files come from is up to a FetchBackend:
+    - GlobusBackend runs the Globus sync script, as
+        SYNC_SCRIPT_LOC -y YEAR -m MONTH -p PATTERN DEST
+      so any script taking the same arguments can stand in for it (e.g. one
+      which copies files from a local directory, for testing).
+    - LocalMirrorBackend takes files from a local archive laid out as 
+      ROOT/YYYY/MM/, hardlinking (or reflinking, or failing those, copying)
+      them into place, with no network transfer at all.
+
+date: October 2026
+"""
+import asyncio
+import collections
+import logging
+import os
+import queue
+import threading
+
+import rawacf_utils as rut
+
+# Fetches (e.g. sync script subprocesses) to run at once
+DEFAULT_CONCURRENCY = 4
+# Where a LocalMirrorBackend expects to find a month's files under its root
+ARCHIVE_LAYOUT = "{year:04d}/{month:02d}"
+# ioctl request for cloning (reflinking) a file's extents, from linux/fs.h
+FICLONE = 0x40049409
+# Times to fetch a failed shard again before giving up on it
+FETCH_RETRIES = 1
+
+class FetchShard(collections.namedtuple('FetchShard', 
+        ['label', 'year', 'month', 'pattern', 'folder'])):
+    """
+    One piece of a fetch: a label for logging, the year and month of the
+    files wanted, a filename pattern (as taken by the sync script) and the
+    folder which the files are fetched into.
+    """
+    __slots__ = ()
+
+class FetchError(Exception):
+    """
+    Raised when a fetch fails, so that whatever it was fetching isn't taken
+    to be complete (and can be fetched again).
+    """
+    pass
+
+# -----------------------------------------------------------------------------
+#                               Fetch Backends
+# -----------------------------------------------------------------------------
+
+class FetchBackend(object):
+    """
+    Somewhere that rawacf files can be fetched from. Subclasses implement
+    fetch(), and may override fetch_async() if they can do better than 
+    running fetch() in a thread.
+    """
+    def connect(self):
+        """ Gets ready for fetching (e.g. starts up a Globus endpoint). """
+        pass
+
+    def disconnect(self):
+        """ Tears down whatever connect() set up. """
+        pass
+
+    def fetch(self, shard):
+        """
+        Fetches the files matching a shard's pattern into its folder.
+
+        :param shard: [FetchShard]
+
+        :returns: [int] 0 if the fetch succeeded, non-zero (or None if it
+                    couldn't be attempted) otherwise
+        """
+        raise NotImplementedError
+
+    async def fetch_async(self, shard):
+        """
+        Like fetch(), but for running concurrently in an event loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.fetch, shard)
+
+class GlobusBackend(FetchBackend):
+    """
+    Fetches files via Globus, using the sync script.
+    """
+    def __init__(self, sync_script=None):
+        """
+        [:param sync_script:] [str] path to the sync script, if not the
+                    configured SYNC_SCRIPT_LOC
+        """
+        if sync_script is None:
+            if not hasattr(rut, 'SYNC_SCRIPT_LOC'):
+                rut.read_config()
+            sync_script = rut.SYNC_SCRIPT_LOC
+        self.sync_script = sync_script
+
+    def query(self, shard):
+        """ :returns: [list of str] the sync script request for a shard """
+        return [self.sync_script, '-y', str(shard.year), '-m', str(shard.month),
+                '-p', shard.pattern, shard.folder]
+
+    def connect(self):
+        rut.globus_connect()
+
+    def disconnect(self):
+        rut.globus_disconnect()
+
+    def fetch(self, shard):
+        import subprocess
+        query = self.query(shard)
+        logging.info("Preparing to query: {0}".format(query))
+        try:
+            out = subprocess.check_output(query, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            logging.error("\t\tFailed Globus query for {0} (exit code {1}): {2}".format(
+                          shard.label, e.returncode, e.output))
+            return e.returncode
+        except OSError:
+            logging.error("\t\tFailed to call Globus script", exc_info=True)
+            return None
+        logging.info("Fetch request for {0} answered with: {1}".format(shard.label, out))
+        return 0
+
+    async def fetch_async(self, shard):
+        query = self.query(shard)
+        logging.info("Preparing to query: {0}".format(query))
+        try:
+            proc = await asyncio.create_subprocess_exec(*query,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        except OSError:
+            logging.error("\t\tFailed to call Globus script", exc_info=True)
+            return None
+        out, _ = await proc.communicate()
+        if proc.returncode != 0:
+            logging.error("\t\tFailed Globus query for {0} (exit code {1}): {2}".format(
+                          shard.label, proc.returncode, out))
+        else:
+            logging.info("Fetch request for {0} answered with: {1}".format(shard.label, out))
+        return proc.returncode
+
+class LocalMirrorBackend(FetchBackend):
+    """
+    Fetches files from a local archive tree, laid out by default as 
+    ROOT/YYYY/MM/<rawacf files>. Each file is hardlinked into place if it 
+    can be, otherwise reflinked (on filesystems which support it, e.g. btrfs
+    or XFS), otherwise copied. Files already present in the destination 
+    (with the same size) are left alone.
+    """
+    def __init__(self, root, layout=ARCHIVE_LAYOUT):
+        """
+        :param root: [str] path to the top of the archive
+        [:param layout:] [str] format string for a month's folder in the
+                    archive, taking 'year' and 'month'
+        """
+        self.root = root
+        self.layout = layout
+
+    def month_dir(self, year, month):
+        """ :returns: [str] the archive folder holding a month's files """
+        return os.path.join(self.root, self.layout.format(year=year, month=month))
+
+    def fetch(self, shard):
+        import fnmatch
+        src_dir = self.month_dir(shard.year, shard.month)
+        if not os.path.isdir(src_dir):
+            logging.error("\t\tNo archive folder {0} for {1}".format(src_dir, shard.label))
+            return 1
+        failures = 0
+        linked, skipped = 0, 0
+        for entry in os.scandir(src_dir):
+            # The sync script treats its pattern as a prefix
+            if not entry.is_file() or not fnmatch.fnmatch(entry.name, shard.pattern + '*'):
+                continue
+            dest = os.path.join(shard.folder, entry.name)
+            try:
+                if os.path.exists(dest) and os.path.getsize(dest) == entry.stat().st_size:
+                    skipped += 1
+                    continue
+                link_or_copy(entry.path, dest)
+                linked += 1
+            except (IOError, OSError):
+                logging.error("\t\tCouldn't fetch {0}".format(entry.path), exc_info=True)
+                failures += 1
+        logging.info("Fetched {0} files for {1} from {2} ({3} already present)".format(
+                     linked, shard.label, src_dir, skipped))
+        return 0 if failures == 0 else 1
+
+def link_or_copy(src, dest):
+    """
+    Puts a file in place without copying its contents if possible: by 
+    hardlinking it, or else by reflinking it (FICLONE). Otherwise it's copied.
+
+    :param src: [str] path to the existing file
+    :param dest: [str] path to put it at (which is replaced if it exists)
+    """
+    import shutil
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return
+    except OSError:
+        # e.g. a different filesystem, or one without hardlinks
+        pass
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dest)
+        return
+    except (ImportError, IOError, OSError):
+        if os.path.lexists(dest):
+            os.remove(dest)
+    shutil.copy2(src, dest)
+
+# -----------------------------------------------------------------------------
+#                               Orchestration
+# -----------------------------------------------------------------------------
+
+def day_shards(year, month, day, dest, by='hour', station_codes=None):
+    """
+    Splits a day's fetch into shards, each with their own folder under dest.
+
+    :param year: [int]
+    :param month: [int]
+    :param day: [int]
+    :param dest: [str] folder to make the shards' folders in
+    [:param by:] [str] 'hour' for one shard per hour, 'station' for one per
+                    station. ** Stations not listed 
+                    in rawacf_utils.allradars won't be fetched by 'station'. **
+    [:param station_codes:] [list of str] stations to fetch (only these are
+                    fetched, whichever way the day is split up)
+
+    :returns: [list of FetchShard]
+    """
+    datestr = "{0}{1:02d}{2:02d}".format(year, month, day)
+    if by == 'station':
+        codes = sorted(rut.allradars) if station_codes is None else station_codes
+        patterns = [(code, datestr + "*" + code) for code in codes]
+    elif by == 'hour':
+        suffixes = [""] if station_codes is None else ["*" + c for c in station_codes]
+        patterns = [("{0:02d}h{1}".format(hr, sfx), "{0}.{1:02d}*{2}".format(datestr, hr, sfx))
+                    for hr in range(24) for sfx in suffixes]
+    else:
+        raise ValueError("Can't split up a day's fetch by '{0}'".format(by))
+
+    shards = []
+    for label, pattern in patterns:
+        folder = os.path.join(dest, label.replace('*', ''))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        shards.append(FetchShard(label, year, month, pattern, folder))
+    return shards
+
+async def run_shard(backend, shard, semaphore):
+    """
+    Fetches one shard through the backend, once the semaphore lets it.
+
+    :param backend: [FetchBackend]
+    :param shard: [FetchShard]
+    :param semaphore: [asyncio.Semaphore] limiting how many run at once
+
+    :returns: [tuple] of the shard and the backend's return code
+    """
+    async with semaphore:
+        return shard, await backend.fetch_async(shard)
+
+async def run_shards(backend, shards, concurrency=DEFAULT_CONCURRENCY, on_done=None):
+    """
+    Fetches the shards, at most 'concurrency' at a time.
+
+    :param backend: [FetchBackend]
+    :param shards: [list of FetchShard]
+    [:param concurrency:] [int] most fetches to run at once
+    [:param on_done:] [callable] called with (shard, return code) as each
+                    fetch finishes
+
+    :returns: [list] of (shard, return code), in order of completion
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    done = []
+    for fut in asyncio.as_completed([run_shard(backend, shard, semaphore) for shard in shards]):
+        result = await fut
+        done.append(result)
+        if on_done is not None:
+            on_done(*result)
+    return done
+
+def iter_fetched(backend, shards, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Fetches shards in a background thread's event loop, yielding each one
+    as soon as its fetch completes (while the rest carry on fetching).
+
+    :param backend: [FetchBackend]
+    :param shards: [list of FetchShard]
+    [:param concurrency:] [int] most fetches to run at once
+
+    :returns: a generator of (shard, return code), in order of completion
+    """
+    results = queue.Queue()
+    failure = []
+
+    def fetcher():
+        try:
+            asyncio.run(run_shards(backend, shards, concurrency,
+                                   lambda *result: results.put(result)))
+        except Exception as e:
+            logging.error("\t\tFetch orchestrator failed!", exc_info=True)
+            failure.append(e)
+        finally:
+            results.put(None)
+
+    thread = threading.Thread(target=fetcher)
+    thread.daemon = True
+    thread.start()
+    while True:
+        result = results.get()
+        if result is None:
+            break
+        yield result
+    thread.join()
+    if len(failure) > 0:
+        raise failure[0]
+
+def fetch_and_parse_day(year, month, day, conn, backend=None, dest=None, by='hour',
+                        station_codes=None, concurrency=DEFAULT_CONCURRENCY,
+                        retries=FETCH_RETRIES, **parse_kwargs):
+    """
+    Fetches a day's rawacf files shard by shard, parsing each shard (and
+    then clearing out its folder) as soon as it arrives.
+
+    A shard whose fetch fails is neither parsed nor cleared. Once the rest
+    have been through, the failed ones are fetched again (up to 'retries'
+    times). Any which still fail are left as they are, so running the day
+    again fetches them again.
+
+    :param year: [int]
+    :param month: [int]
+    :param day: [int]
+    :param conn: [sqlite3 connection] to the database to save records to
+    [:param backend:] [FetchBackend] to fetch with; by default Globus
+    [:param dest:] [str] folder to fetch into; by default the day's staging
+                    folder in the endpoint
+    [:param by:], [:param station_codes:] see day_shards()
+    [:param concurrency:] [int] most fetches to run at once
+    [:param retries:] [int] times to fetch a failed shard again
+    [:param parse_kwargs:] passed on to parse.parse_rawacf_folder()
+
+    :returns: [list of FetchShard] the shards whose fetch still failed
+    """
+    import parse
+    staging = dest is None
+    if staging:
+        dest = rut.staging_dir(year, month, day)
+    if backend is None:
+        backend = GlobusBackend()
+    shards = day_shards(year, month, day, dest, by, station_codes)
+    todo = shards
+    for attempt in range(retries + 1):
+        failed = []
+        for shard, returncode in iter_fetched(backend, todo, concurrency):
+            if returncode != 0:
+                # Whatever did arrive stays put until the shard is fetched properly
+                failed.append(shard)
+                continue
+            parse.parse_rawacf_folder(shard.folder, conn=conn, **parse_kwargs)
+            conn.commit()
+            rut.clear_staging_dir(shard.folder)
+        if len(failed) == 0 or attempt == retries:
+            break
+        logging.warning("\t\tFetching {0} shard(s) again: {1}".format(
+                        len(failed), [s.label for s in failed]))
+        todo = failed
+    if len(failed) > 0:
+        logging.error("\t\t{0} / {1} fetches failed: {2}. Their files are left in {3}".format(
+                      len(failed), len(shards), [s.label for s in failed], dest))
+    elif staging:
+        rut.clear_staging_dir(dest)
+    return failed
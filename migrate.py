@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+file: 'migrate.py'
+description:
+    This python script brings databases made by older versions of these
+    scripts up to date, in place, e.g.
+
+    > migrate.py superdarntimes.sqlite 2016data.sqlite
+
+    > migrate.py -j 8 archive/
+
+    Each database's schema version is kept in its 'PRAGMA user_version' (see
+    rawacf_utils.SCHEMA_VERSION; databases made before it was kept are
+    version 0). The steps in MIGRATIONS which a database hasn't had yet are
+    run in order, and its version is recorded after each one, so a migration
+    which gets interrupted carries on from the last finished step when it's
+    run again. Each step only changes what's actually missing, so running
+    this on a database that's already up to date does nothing.
+
+    Steps which have to touch every record (e.g. filling in a new column) do
+    so a batch at a time, one transaction per batch, logging their progress
+    as they go. The database stays in WAL mode throughout, so it can still be
+    read (e.g. by uptime.py) while it's being migrated.
+
+    Folders are searched for '.sqlite' files (e.g. the month databases left
+    by proc_range.py), and the databases are migrated in parallel, one per
+    process.
+
+    When DB_SCHEMA changes, SCHEMA_VERSION goes up by one and a step for it
+    is added to the end of MIGRATIONS.
+
+date: October 2026
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import rawacf_utils as rut
+
+# Records to fill in per transaction
+MIGRATE_BATCH_SIZE = 50000
+# Databases to migrate at once
+DEFAULT_JOBS = 4
+# Files that are taken to be databases when searching folders
+DB_SUFFIX = '.sqlite'
+
+#------------------------------------------------------------------------------
+#                       Migration Steps
+#------------------------------------------------------------------------------
+# Each step takes (conn, batch_size, label) and returns the number of records
+# it changed. They must be safe to run again on a database which already had
+# them (or part of them), since unversioned databases run every step.
+
+def add_manifest_table(conn, batch_size=MIGRATE_BATCH_SIZE, label=''):
+    """ Adds the manifest table (see rawacf_utils.connect_db()). """
+    conn.execute(rut.MANIFEST_TABLE)
+    return 0
+
+def add_jobs_table(conn, batch_size=MIGRATE_BATCH_SIZE, label=''):
+    """ Adds the jobs table (see rawacf_utils.connect_db()). """
+    conn.execute(rut.JOBS_TABLE)
+    return 0
+
+def add_ts_columns(cur):
+    """
+    Adds the start_ts/end_ts columns to the exps table, if they're missing.
+
+    :param cur: cursor to the sqlite3 database
+
+    :returns: [list of str] the columns which were added
+    """
+    cur.execute('PRAGMA table_info (exps)')
+    have = set(row[1] for row in cur.fetchall())
+    added = []
+    for col in rut.EXPS_TS_COLUMNS:
+        if col not in have:
+            cur.execute('ALTER TABLE exps ADD COLUMN {0} integer'.format(col))
+            added.append(col)
+    return added
+
+def backfill_ts(conn, batch_size=MIGRATE_BATCH_SIZE, label=''):
+    """
+    Fills in start_ts/end_ts for records which don't have them yet, from
+    their start_iso/end_iso, committing after each batch (so an interrupted
+    migration can just be run again).
+
+    :param conn: [sqlite3 connection] to the database
+    [:param batch_size:] [int] records to fill in per transaction
+    [:param label:] [str] what to call the database in the progress reports
+
+    :returns: [int] number of records filled in
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT count(*) FROM exps WHERE start_ts IS NULL OR end_ts IS NULL')
+    todo = cur.fetchone()[0]
+    total = 0
+    last_rowid = -1
+    t0 = time.time()
+    while total < todo:
+        # Walking the rowids means each batch picks up where the last left off
+        cur.execute('SELECT rowid, start_iso, end_iso FROM exps WHERE rowid > ? AND '
+                    '(start_ts IS NULL OR end_ts IS NULL) ORDER BY rowid LIMIT ?',
+                    (last_rowid, batch_size))
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            break
+        rowids, starts, ends = zip(*rows)
+        # numpy parses the ISO strings directly to microseconds
+        start_us = np.array(starts, dtype='datetime64[us]').astype(np.int64)
+        end_us = np.array(ends, dtype='datetime64[us]').astype(np.int64)
+        start_ts = start_us // rut.US_IN_SEC
+        end_ts = -(-end_us // rut.US_IN_SEC)
+        rut.execute_retrying(cur, 'UPDATE exps SET start_ts = ?, end_ts = ? WHERE rowid = ?',
+                             [(int(s), int(e), r) for s, e, r in zip(start_ts, end_ts, rowids)],
+                             many=True)
+        conn.commit()
+        total += len(rows)
+        last_rowid = rowids[-1]
+        elapsed = time.time() - t0
+        logging.info("\t{0}: filled in {1} of {2} records ({3:.0f}%, {4:.0f} per s)".format(
+                     label, total, todo, 100. * total / todo,
+                     total / elapsed if elapsed > 0 else 0.))
+    return total
+
+def add_ts(conn, batch_size=MIGRATE_BATCH_SIZE, label=''):
+    """ Adds, fills in and indexes the exps table's start_ts/end_ts columns. """
+    cur = conn.cursor()
+    added = add_ts_columns(cur)
+    conn.commit()
+    if len(added) > 0:
+        logging.info("\t{0}: added column(s) {1}".format(label, ", ".join(added)))
+    total = backfill_ts(conn, batch_size, label)
+    cur.execute(rut.EXPS_TS_INDEX)
+    return total
+
+# (version, description, step): running a step brings a database at the
+# version before it up to its version
+MIGRATIONS = [
+    (1, "add the manifest table", add_manifest_table),
+    (2, "add the jobs table", add_jobs_table),
+    (3, "add the start_ts/end_ts columns and their index", add_ts),
+]
+
+#------------------------------------------------------------------------------
+#                       Running Migrations
+#------------------------------------------------------------------------------
+
+def pending_migrations(cur):
+    """
+    :param cur: cursor to the sqlite3 database
+
+    :returns: [list of tuple] the MIGRATIONS the database hasn't had yet
+
+    :raises: ValueError if the database is newer than these scripts
+    """
+    version = rut.db_version(cur)
+    if version > rut.SCHEMA_VERSION:
+        raise ValueError("Schema version {0} is newer than these scripts (version {1})".format(
+                         version, rut.SCHEMA_VERSION))
+    return [step for step in MIGRATIONS if step[0] > version]
+
+def migrate_db(dbname, batch_size=MIGRATE_BATCH_SIZE):
+    """
+    Brings a database up to date (see the description above).
+
+    :param dbname: [str] path to the database file
+    [:param batch_size:] [int] records to change per transaction
+
+    :returns: [int] number of records changed
+
+    :raises: ValueError if the file doesn't exist or the database is newer
+                than these scripts
+    """
+    if not os.path.isfile(dbname):
+        raise ValueError("There's no database file {0}".format(dbname))
+    conn = rut.open_db(dbname)
+    cur = conn.cursor()
+    total = 0
+    if not rut.has_table(cur, 'exps'):
+        # Nothing to migrate; it just needs making
+        cur.executescript(rut.DB_SCHEMA)
+        rut.set_db_version(cur, rut.SCHEMA_VERSION)
+    else:
+        for version, description, step in pending_migrations(cur):
+            logging.info("{0}: migrating to version {1} ({2})...".format(
+                         dbname, version, description))
+            total += step(conn, batch_size, dbname)
+            conn.commit()
+            rut.set_db_version(cur, version)
+            conn.commit()
+    if not rut.check_db(cur):
+        logging.error("{0} still isn't configured as expected".format(dbname))
+    conn.close()
+    logging.info("{0} is up to date ({1} records changed)".format(dbname, total))
+    return total
+
+def _migrate_db(dbname, batch_size):
+    """ migrate_db() for a pool worker: :returns: [tuple] of (records changed, error) """
+    try:
+        return migrate_db(dbname, batch_size), None
+    except (sqlite3.DatabaseError, ValueError) as e:
+        logging.error("Couldn't migrate {0}: {1}".format(dbname, e))
+        return 0, str(e)
+
+def find_dbs(paths):
+    """
+    Lists the databases to migrate: files are taken as they are, and folders
+    are searched (recursively) for '.sqlite' files.
+
+    :param paths: [list of str] database files and/or folders
+
+    :returns: [list of str] paths to database files
+    """
+    dbnames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            dbnames.append(path)
+            continue
+        for dirpath, dirnames, fnames in os.walk(path):
+            dirnames.sort()
+            dbnames.extend(os.path.join(dirpath, fname) for fname in sorted(fnames)
+                           if fname.endswith(DB_SUFFIX))
+    return dbnames
+
+def migrate_dbs(dbnames, jobs=DEFAULT_JOBS, batch_size=MIGRATE_BATCH_SIZE):
+    """
+    Migrates several databases, 'jobs' at a time, each in its own process.
+    A database that can't be migrated doesn't stop the others.
+
+    :param dbnames: [list of str] paths to the database files
+    [:param jobs:] [int] most databases to migrate at once
+    [:param batch_size:] [int] records to change per transaction
+
+    :returns: [list of str] the databases which couldn't be migrated
+    """
+    failed = []
+    if jobs <= 1 or len(dbnames) <= 1:
+        for dbname in dbnames:
+            if _migrate_db(dbname, batch_size)[1] is not None:
+                failed.append(dbname)
+        return failed
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = dict((pool.submit(_migrate_db, dbname, batch_size), dbname)
+                       for dbname in dbnames)
+        for done, future in enumerate(as_completed(futures), 1):
+            if future.result()[1] is not None:
+                failed.append(futures[future])
+            logging.info("Finished {0} of {1} databases".format(done, len(dbnames)))
+    return sorted(failed)
+
+def print_versions(dbnames):
+    """
+    Prints each database's schema version and what (if anything) it's
+    missing, without changing it.
+    """
+    for dbname in dbnames:
+        conn = rut.open_db(dbname, readonly=True)
+        cur = conn.cursor()
+        print("{0}: version {1} of {2}".format(dbname, rut.db_version(cur), rut.SCHEMA_VERSION))
+        for problem in rut.schema_problems(cur):
+            print("\t{0}".format(problem))
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dbs", nargs='+', help="Database file(s), or folders of them, to migrate")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help="Databases to migrate at once (default: {0})".format(DEFAULT_JOBS))
+    parser.add_argument("--batch_size", type=int, default=MIGRATE_BATCH_SIZE,
+                        help="Records to change per transaction")
+    parser.add_argument("--check", action="store_true",
+                        help="Only show each database's version and what it's missing")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+        format='%(levelname)s %(asctime)s: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    dbnames = find_dbs(args.dbs)
+    if args.check:
+        print_versions(dbnames)
+        sys.exit(0)
+    failed = migrate_dbs(dbnames, args.jobs, args.batch_size)
+    if len(failed) > 0:
+        logging.error("These databases couldn't be migrated: {0}".format(", ".join(failed)))
+    sys.exit(1 if len(failed) > 0 else 0)
@@ -31,20 +31,41 @@ date: July 6 2017
 import logging
 import os
 
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 import numpy as np
 import sqlite3
 import argparse
+import sys
 import time
 import multiprocessing as mp
-import itertools
+import threading
+import queue
 
 import backscatter 
 import rawacf_utils as rut
+import rawacf_index
+import fetch
 from rawacf_utils import two_pad
 
 SUBPROC_JOIN_TIMEOUT = 15
-SHORT_SLEEP_INTERVAL = 0.1
+# Most exception messages to write out at once
+EXC_BATCH_SIZE = 100
+# Retries (with exponential backoff from RETRY_BACKOFF s) for a file that
+# ran out of memory
+MAX_PARSE_RETRIES = 3
+RETRY_BACKOFF = 1.0
+# Days of rawacfs to fetch ahead of the one being parsed
+DEFAULT_LOOKAHEAD = 1
+# Files' records to write between commits, and to hold while the writer's busy
+WRITE_BATCH_SIZE = 50
+WRITE_QUEUE_SIZE = 200
+# Files estimated to cost less than this (see rawacf_index.estimate_cost) are
+# batched together into shared tasks for the worker pool
+SMALL_TASK_COST = 16 << 20
+# Share of physical memory that the worker pool may plan on using
+MEMORY_BUDGET_FRACTION = 0.5
+# Seconds a worker may spend on one file before it's presumed hung
+PARSE_TIMEOUT = 900
 
 BAD_RAWACFS_FILE = './bad_rawacfs.txt'
 INCONSISTENT_FIELDS_FILE = './bad_fields.txt'
@@ -65,7 +86,9 @@ rootLogger.addHandler(fileHandler)
 #                           High-Level Methods 
 # -----------------------------------------------------------------------------
 
-def process_rawacfs_day(year, month, day, station_code=None, conn=None):
+def process_rawacfs_day(year, month, day, station_code=None, conn=None, multiprocess=True,
+                        workers=None, memory_budget=None, file_timeout=PARSE_TIMEOUT,
+                        shard_by=None, fetches=fetch.DEFAULT_CONCURRENCY, backend=None):
     """
     A function which fetches and processes rawacfs from a particular day
     into the sqlite3 database. Can optionally select a particular day.
@@ -74,130 +97,335 @@ def process_rawacfs_day(year, month, day, station_code=None, conn=None):
     :param month:
     :param day: 
     [:param station_code:] 3-letter [string] for the station e.g. 'sas' for Saskatoon
+    [:param multiprocess:] [boolean] whether to use multiprocessing or not
+    [:param workers:] [int] number of processes to parse files with (by 
+                    default, one per CPU if multiprocess is set)
+    [:param memory_budget:] [int] bytes that files being parsed may take up
+    [:param file_timeout:] [float] seconds a worker may spend on one file
+    [:param shard_by:] [str] if 'hour' or 'station', split the day's fetch
+                    up into that many queries, run 'fetches' at a time, and 
+                    parse each one's files as soon as they arrive (see fetch.py)
+    [:param fetches:] [int] most sync script queries to run at once
+    [:param backend:] [fetch.FetchBackend] where to fetch files from (by
+                    default, Globus)
+
+    :returns: [boolean] False if the day's files (or, with shard_by, some
+                of its shards) couldn't be fetched. What failed isn't parsed,
+                and whatever did arrive of it is left in place.
 
     ** Note: it would've been ideal to take station ID parameters but I didn't
             know of a really quick and easy way to convert stid's and station codes
             without requiring an installation of e.g. davitpy **
     """
-    import subprocess
-    import calendar 
-
     if conn==None:
         conn = sqlite3.connect("superdarntimes.sqlite")
-
-    # If a stid is given to function, then just grab that station's stuff
-    all_stids = True if station_code is None else False
-
-    # I. Run the globus connect process
-    rut.globus_connect()
-
-    # II. Fetch the files
-    if all_stids:
-        script_query = [rut.SYNC_SCRIPT_LOC,'-y', str(year), '-m',
-            str(month), '-p', str(year)+"{:02d}".format(month)+"{:02d}".format(day)+"*", rut.ENDPOINT]
-    else:
-        # The case that we're looking at just one particular station
-        script_query = [rut.SYNC_SCRIPT_LOC,'-y', str(year), '-m',
-            str(month), '-p', str(year)+"{:02d}".format(month)+"{:02d}".format(day)+"*"+station_code, 
-            rut.ENDPOINT]
-    rut.globus_query(script_query)
+    if backend is None:
+        backend = fetch.GlobusBackend()
+
+    # I. Run the globus connect process (or whatever the backend needs)
+    backend.connect()
+
+    if shard_by is not None:
+        # II/III. Fetch the files piece by piece, parsing each piece as it comes
+        station_codes = None if station_code is None else [station_code]
+        failed = fetch.fetch_and_parse_day(year, month, day, conn, backend=backend,
+                                           by=shard_by, station_codes=station_codes,
+                                           concurrency=fetches, multiprocess=multiprocess,
+                                           workers=workers, memory_budget=memory_budget,
+                                           file_timeout=file_timeout)
+        logging.info("Completed processing of requested day's rawacf data.")
+        return len(failed) == 0
+
+    # II. Fetch the files (into the day's own staging folder)
+    try:
+        folder = fetch_day(year, month, day, station_code=station_code, backend=backend)
+    except fetch.FetchError as e:
+        logging.error("\t\tCouldn't fetch {0}-{1:02d}-{2:02d}: {3}".format(year, month, day, e))
+        return False
 
     # III.
     # B. Parse the rawacf files, save their metadata in our DB
-    parse_rawacf_folder(rut.ENDPOINT, conn=conn)
+    parse_rawacf_folder(folder, conn=conn, multiprocess=multiprocess, workers=workers,
+                        memory_budget=memory_budget, file_timeout=file_timeout)
     logging.info("\t\tDone with parsing {0}-{1}-{2} rawacf data".format(
                  str(year), "{:02d}".format(month), "{:02d}".format(day)))
     conn.commit()
 
     # C. Clear the rawacf files that were fetched in this cycle
-    try:
-        rut.clear_endpoint()
-        logging.info("\t\tDone with clearing {0}-{1}-{2} rawacf data".format(
+    rut.clear_staging_dir(folder)
+    logging.info("\t\tDone with clearing {0}-{1}-{2} rawacf data".format(
                  str(year), "{:02d}".format(month), "{:02d}".format(day)))
-    except subprocess.CalledProcessError:
-        logging.error("\t\tUnable to remove files.", exc_info=True)
     logging.info("Completed processing of requested day's rawacf data.")
+    return True
  
 def process_rawacfs_month(year, month, conn=sqlite3.connect("superdarntimes.sqlite"),
-                         multiprocess=True, days=[]):
+                         multiprocess=True, days=[], lookahead=DEFAULT_LOOKAHEAD,
+                         workers=None, memory_budget=None, file_timeout=PARSE_TIMEOUT,
+                         backend=None, resume=True):
     """
     Takes starting month and year and ending month and year as arguments. Steps
     through each day in each year/month combo
 
+    While one day's files are being parsed, the following 'lookahead' days
+    are fetched (each into its own staging folder) in background threads, 
+    so that the network and the CPU are kept busy at the same time. A day's
+    staging folder is only cleared once its records have been committed.
+
+    Each day's progress (and that of each station within it) is kept in the
+    database's jobs table, so if a run stops part-way through, running it 
+    again picks up from the first day which wasn't finished. A day whose 
+    fetch fails isn't parsed or cleared; it's skipped (and left unfinished)
+    and the run carries on with the next.
+
     :param year: [int] indicating the year to look at
     :param month: [int] indicating the month to look at
     :param conn: [sqlite3 connection] to the database for saving to
     :param multiprocess: [boolean] whether to use multiprocessing or not
     :param days: [list of ints] an optional days subset for the month
+    [:param lookahead:] [int] how many days ahead to fetch. With 0, each day
+                    is fetched only once the previous one is done. Note that
+                    up to lookahead + 1 days of files will be on disk at once.
+    [:param workers:] [int] number of processes to parse files with (by 
+                    default, one per CPU if multiprocess is set)
+    [:param memory_budget:] [int] bytes that files being parsed may take up
+    [:param file_timeout:] [float] seconds a worker may spend on one file
+    [:param backend:] [fetch.FetchBackend] where to fetch files from (by
+                    default, Globus)
+    [:param resume:] [boolean] skip days the jobs table says are finished 
+                    (otherwise every day is started again from scratch)
+
+    :returns: [list of int] the days whose fetch failed. They're left 
+                unfinished in the jobs table, to be fetched again next run.
 
     ** On Maxwell this has taken upwards of 14 hours to run for a given month **
 
     """
-    import subprocess
     import calendar 
+    from concurrent.futures import ThreadPoolExecutor
 
     last_day = calendar.monthrange(year, month)[1]
+    days_list = np.arange(1,last_day+1)
     if type(days)==list and len(days) > 0: 
         cond1 = all([ type(d)==int for d in days])
-        cond2 = all([ d in np.arange(1,last_day+1)])
+        cond2 = all([ d in days_list for d in days])
         if cond1 and cond2:
             # Only now has the custom days range been fully validated
             days_list = days
-    else:
-        days_list = np.arange(1,last_day+1)
+    days_list = [int(d) for d in days_list]
+    if backend is None:
+        backend = fetch.GlobusBackend()
+    days_list = plan_day_jobs(conn, year, month, days_list, resume)
 
-    # I. Run the globus connect process
-    rut.globus_connect()
+    # I. Run the globus connect process (or whatever the backend needs)
+    backend.connect()
 
     logging.info("Beginning to process Rawacf logs... ")
     
     logging.info("Starting to analyze {0}-{1} files...".format(str(year), "{:02d}".format(month))) 
 
-    # II. For each day in the month:
-    for day in days_list:
-        logging.info("\tLooking at {0}-{1}-{2}".format(
-                     str(year), "{:02d}".format(month), "{:02d}".format(day)))
+    cur = conn.cursor()
+    fetcher = ThreadPoolExecutor(max_workers=max(lookahead, 1))
+    fetches = dict()
+    failed = []
+    try:
+        # II. For each day in the month:
+        for i, day in enumerate(days_list):
+            # A. First, make sure the rawacfs for this day (and the next few) 
+            # are being grabbed via globus, and wait on this day's
+            for d in days_list[i:i+lookahead+1]:
+                if d not in fetches:
+                    rut.set_job_status(cur, dt(year, month, d).date(), rut.ALL_STATIONS,
+                                       rut.JOB_FETCHING)
+                    conn.commit()
+                    fetches[d] = fetcher.submit(fetch_day, year, month, d,
+                                                 backend=backend)
+            logging.info("\tLooking at {0}-{1}-{2}".format(
+                         str(year), "{:02d}".format(month), "{:02d}".format(day)))
+            try:
+                folder = fetches.pop(day).result()
+            except fetch.FetchError as e:
+                # Leave the day unfinished (and whatever did arrive in its 
+                # folder), so that the next run fetches it again
+                logging.error("\t\tSkipping {0}-{1:02d}-{2:02d}: {3}".format(
+                              year, month, day, e))
+                failed.append(day)
+                continue
+            index = rawacf_index.RawacfIndex.from_folder(folder)
+            set_day_jobs(cur, dt(year, month, day).date(), rut.JOB_FETCHING, index)
+            conn.commit()
 
-        # A. First, grab the rawacfs via globus (and wait on it)
-        script_query = [rut.SYNC_SCRIPT_LOC,'-y', str(year), '-m',
-            str(month), '-p', str(year)+"{:02d}".format(month)+"{:02d}".format(day)+"*", rut.ENDPOINT]
+            # B. Parse the rawacf files, save their metadata in our DB
+            parse_rawacf_folder(folder, conn=conn, multiprocess=multiprocess,
+                                workers=workers, memory_budget=memory_budget,
+                                file_timeout=file_timeout)
+            set_day_jobs(cur, dt(year, month, day).date(), rut.JOB_PARSED, index)
+            conn.commit()
+            logging.info("\t\tDone with parsing {0}-{1}-{2} rawacf data".format(
+                         str(year), "{:02d}".format(month), "{:02d}".format(day)))
 
-        rut.globus_query(script_query)
+            # C. Clear the rawacf files that were fetched for this day
+            rut.clear_staging_dir(folder)
+            set_day_jobs(cur, dt(year, month, day).date(), rut.JOB_COMMITTED, index)
+            conn.commit()
+            logging.info("\t\tDone with clearing {0}-{1}-{2} rawacf data".format(
+                         str(year), "{:02d}".format(month), "{:02d}".format(day)))
+    finally:
+        # Don't start any more fetches if we're bailing out early
+        for fut in fetches.values():
+            fut.cancel()
+        fetcher.shutdown(wait=True)
+
+    if len(failed) > 0:
+        logging.error("Couldn't fetch {0} day(s): {1}. Run this again to retry them.".format(
+                      len(failed), ", ".join(str(d) for d in failed)))
+    logging.info("Completed processing of requested month's rawacf data.")
+    return failed
 
-        # B. Parse the rawacf files, save their metadata in our DB
-        parse_rawacf_folder(rut.ENDPOINT, conn=conn, multiprocess=multiprocess)
-        logging.info("\t\tDone with parsing {0}-{1}-{2} rawacf data".format(
-                     str(year), "{:02d}".format(month), "{:02d}".format(day)))
+def plan_day_jobs(conn, year, month, days, resume=True):
+    """
+    Records a month run's days in the jobs table, and works out which of
+    them still need doing. A day which was parsed but whose staging folder
+    wasn't cleared just has that finished off here.
 
-        # C. Clear the rawacf files that were fetched in this cycle
-        try:
-            rut.clear_endpoint()
-            logging.info("\t\tDone with clearing {0}-{1}-{2} rawacf data".format(
-                     str(year), "{:02d}".format(month), "{:02d}".format(day)))
-        except subprocess.CalledProcessError:
-            logging.error("\t\tUnable to remove files.", exc_info=True)
+    :param conn: [sqlite3 connection] to the database
+    :param year: [int]
+    :param month: [int]
+    :param days: [list of int] days of the month to run
+    [:param resume:] [boolean] leave out days which are already finished
+                    (otherwise, every day's progress is forgotten)
 
-    logging.info("Completed processing of requested month's rawacf data.")
-    return
+    :returns: [list of int] the days still to be fetched and parsed
+    """
+    cur = conn.cursor()
+    start = dt(year, month, 1)
+    statuses = rut.job_statuses(cur, start.date(), date_range(year, month)[1].date())
+    todo = []
+    for day in days:
+        key = dt(year, month, day).date()
+        status = statuses.get((str(key), rut.ALL_STATIONS))
+        if not resume:
+            rut.clear_jobs(cur, key)
+        elif status == rut.JOB_COMMITTED:
+            logging.info("\tSkipping {0}, which was already finished".format(key))
+            continue
+        elif status == rut.JOB_PARSED:
+            logging.info("\tClearing the staging folder left behind for {0}".format(key))
+            rut.clear_staging_dir(rut.staging_dir(year, month, day))
+            set_day_jobs(cur, key, rut.JOB_COMMITTED)
+            continue
+        if status is None or not resume:
+            rut.set_job_status(cur, key, rut.ALL_STATIONS, rut.JOB_PENDING)
+        todo.append(day)
+    conn.commit()
+    if len(todo) < len(days):
+        logging.info("Resuming: {0} / {1} days left to do".format(len(todo), len(days)))
+    return todo
+
+def set_day_jobs(cur, day, status, index=None):
+    """
+    Sets the status of a day's shard in the jobs table, along with those of
+    each station's files in the day (the caller commits).
+
+    :param cur: cursor to the sqlite3 database
+    :param day: [date] the day
+    :param status: [str] one of the rawacf_utils.JOB_* statuses
+    [:param index:] [rawacf_index.RawacfIndex] of the day's fetched files
+    """
+    if index is not None:
+        for (_, station), files in index.by_day().items():
+            rut.set_job_status(cur, day, station, status, files=len(files),
+                               size=sum(f.size for f in files))
+        rut.set_job_status(cur, day, rut.ALL_STATIONS, status, files=len(index),
+                           size=sum(f.size for f in index))
+    else:
+        for (_, station) in rut.job_statuses(cur, day, day + timedelta(days=1)):
+            rut.set_job_status(cur, day, station, status)
+
+def print_job_status(conn, start=None, end=None):
+    """
+    Shows the progress recorded in the jobs table, and how quickly it went.
+
+    :param conn: [sqlite3 connection] to the database
+    [:param start:] [datetime or date] earliest day to include
+    [:param end:] [datetime or date] day to stop before
+    """
+    cur = conn.cursor()
+    start = None if start is None else start.strftime("%Y-%m-%d")
+    end = None if end is None else end.strftime("%Y-%m-%d")
+    summary = rut.job_summary(cur, start, end)
+    days = sum(summary[status] for status in rut.JOB_STATUSES)
+    print("Days: {0} committed, {1} parsed, {2} fetching, {3} pending (of {4})".format(
+          summary[rut.JOB_COMMITTED], summary[rut.JOB_PARSED], 
+          summary[rut.JOB_FETCHING], summary[rut.JOB_PENDING], days))
+    print("Committed: {0} station-days, {1} files, {2:.1f} MB".format(
+          summary['station_days'], summary['files'], summary['bytes'] / 2.**20))
+    if summary['elapsed'] > 0:
+        print("Throughput: {0:.2f} files/s, {1:.2f} MB/s over {2}".format(
+              summary['files_per_sec'], summary['bytes_per_sec'] / 2.**20,
+              timedelta(seconds=int(summary['elapsed']))))
+        left = days - summary[rut.JOB_COMMITTED]
+        if summary[rut.JOB_COMMITTED] > 0 and left > 0:
+            per_day = summary['elapsed'] / summary[rut.JOB_COMMITTED]
+            print("At that rate, the remaining {0} days will take about {1}".format(
+                  left, timedelta(seconds=int(per_day * left))))
+    unfinished = sorted(day for (day, station), status in 
+                        rut.job_statuses(cur, start, end).items()
+                        if station == rut.ALL_STATIONS and 
+                           status in (rut.JOB_FETCHING, rut.JOB_PARSED))
+    if len(unfinished) > 0:
+        print("Started but not finished: {0}".format(", ".join(unfinished)))
+
+def fetch_day(year, month, day, station_code=None, backend=None):
+    """
+    Fetches a day's rawacf files into their own staging folder.
+
+    :param year: [int]
+    :param month: [int]
+    :param day: [int]
+    [:param station_code:] [str] to only fetch e.g. 'sas' files
+    [:param backend:] [fetch.FetchBackend] where to fetch files from (by
+                    default, Globus)
+
+    :returns: [str] the staging folder holding the day's files
+
+    :raises: fetch.FetchError if the fetch failed (whatever did arrive is
+                left in the folder)
+    """
+    if backend is None:
+        backend = fetch.GlobusBackend()
+    folder = rut.staging_dir(year, month, day)
+    pattern = "{0}{1:02d}{2:02d}*".format(year, month, day)
+    if station_code is not None:
+        pattern += station_code
+    returncode = backend.fetch(fetch.FetchShard(pattern, year, month, pattern, folder))
+    if returncode != 0:
+        raise fetch.FetchError("Fetching {0} failed (exit code {1})".format(
+                               pattern, returncode))
+    logging.info("\t\tDone with fetching {0}-{1}-{2} rawacf data".format(
+                 str(year), "{:02d}".format(month), "{:02d}".format(day)))
+    return folder
         
-def process_file(fname, conn=sqlite3.connect("superdarntimes.sqlite")):
+def process_file(fname, conn=sqlite3.connect("superdarntimes.sqlite"), bz2_threads=1):
     """
     Essentially a wrapper for using parse_file that handles some possible 
     exceptions. This function is only used if you call the script to just
     process a particular file. (so its efficiency isn't as critical fyi)
     
     :param f: file name including path.
+    [:param bz2_threads:] [int] threads to decompress a .bz2 file's blocks with
     """
     # Start exception handler/write handler
-    manager = mp.Manager()
-    exc_msg_queue = manager.Queue()
-    write_handler = mp.Process(target=exc_handler_func, args=( exc_msg_queue,))
-    write_handler.start()
+    exc_msg_queue, write_handler = start_exc_handler()
     try:
         dummy_index = 1
         path = os.path.dirname(fname)
         fil = os.path.basename(fname)
-        r = parse_file(path, fil, dummy_index, exc_msg_queue)
+        failure = None
+        r = parse_file(path, fil, dummy_index, exc_msg_queue, bz2_threads=bz2_threads)
+
+    except ParseRetryError as e:
+        logging.error("\tFile {0}: {1}. Try again later.".format(fname, e))
+        r, failure = None, e
 
     except backscatter.dmap.DmapDataError as e:
         # TODO: Test whether this condition is ever tripped - 'parse_file' should handle this for every case
@@ -209,81 +437,475 @@ def process_file(fname, conn=sqlite3.connect("superdarntimes.sqlite")):
     except rut.InconsistentRawacfError as e:
         err_str = "\t{0} File {1}: Exception raised during process_experiment: {2}"
         logging.warning(err_str.format(index, fname, e))
-    write_handler.terminate()
+    stop_exc_handler(exc_msg_queue, write_handler)
     curr = conn.cursor()
-    r.save_to_db(curr)
+    saved = r.save_to_db(curr) if r is not None else None
+    rut.record_manifest(curr, path, fil, manifest_status(fil, r, saved, failure), 
+                        detail=str(failure or ""))
     conn.commit() 
     return r
 
 def parse_rawacf_folder(folder, conn=sqlite3.connect("superdarntimes.sqlite"), 
-                        multiprocess=False):
+                        multiprocess=False, skip_done=True, use_hash=False,
+                        start=None, end=None, station_code=None, workers=None,
+                        chunksize=None, memory_budget=None, file_timeout=PARSE_TIMEOUT):
     """
     Takes a path to a folder which contains of .rawacf files, parses them
     and inserts them into the database.
 
+    The outcome for each file is recorded in the database's manifest table,
+    in the same commit as its record, so that files which were already 
+    ingested can be skipped (without being opened) when a run is repeated.
+
     :param folder: [str] indicating the path and name of a folder to read 
                     rawacf files from
     :param conn: [sqlite3 connection] to the database
-    :param multiprocess: [Boolean] whether or not to use a multiprocessing pool
+    :param multiprocess: [Boolean] whether or not to use a pool of worker
+                    processes (with one per CPU unless 'workers' says otherwise)
+    [:param skip_done:] [Boolean] skip files the manifest says are already done
+    [:param use_hash:] [Boolean] record content hashes in the manifest, and 
+                    recognize finished files by them if their mtime changed
+    [:param start:] [datetime or date] only parse files starting at/after this
+    [:param end:] [datetime or date] only parse files starting before this
+    [:param station_code:] [str] only parse files from e.g. 'sas'
+    [:param workers:] [int] number of worker processes. More than 1 implies
+                    multiprocess, 1 means sequential.
+    [:param chunksize:] [int] most (small) files to hand a worker at a time
+                    (see plan_tasks())
+    [:param memory_budget:] [int] bytes of memory that the workers' files may
+                    be estimated to need at once (see parse_files_parallel())
+    [:param file_timeout:] [float] seconds a worker may spend on a file before
+                    it's killed and the file is recorded as timed out (None to
+                    wait forever). Doesn't apply when parsing sequentially.
+
+    ** If any of start/end/station_code are given, files are selected by 
+        their names (using a rawacf_index.RawacfIndex) and anything not named
+        like a rawacf file is left alone. **
     """
-    from contextlib import closing
     assert(os.path.isdir(folder))
-    cur = conn.cursor()
     logging.info("Acceptable path {0}. Analysis proceeding...".format(folder))
 
-    processes = []
+    if workers is None:
+        workers = os.cpu_count() if multiprocess else 1
+
+    stats = None
+    if start is not None or end is not None or station_code is not None:
+        index = rawacf_index.RawacfIndex.from_folder(folder).filter(
+                    start, end, station_code)
+        files = index.fnames()
+        stats = dict((f.fname, (f.size, f.mtime)) for f in index)
+    else:
+        files = os.listdir(folder) 
+    parse_rawacf_files(folder, files, conn, stats=stats, skip_done=skip_done,
+                       use_hash=use_hash, workers=workers, chunksize=chunksize,
+                       memory_budget=memory_budget, file_timeout=file_timeout)
+
+def parse_rawacf_tree(root, conn, start=None, end=None, station_code=None, 
+                      skip_done=True, use_hash=False, workers=None, chunksize=None, 
+                      memory_budget=None, file_timeout=PARSE_TIMEOUT):
+    """
+    Parses the rawacf files in an archive tree (e.g. one laid out as 
+    ROOT/YYYY/MM/) where they are, without fetching, copying or deleting
+    anything. The tree is walked once (see rawacf_index.RawacfIndex.from_tree)
+    and every matching file goes through the one pool of worker processes, 
+    with records streaming into the database as they're parsed.
+
+    :param root: [str] path to the top of the archive
+    :param conn: [sqlite3 connection] to the database (see 
+                    rawacf_utils.connect_db())
+    [:param start:] [datetime or date] only parse files starting at/after this
+    [:param end:] [datetime or date] only parse files starting before this
+    [:param station_code:] [str] only parse files from e.g. 'sas'
+    [:param workers:] [int] number of worker processes (one per CPU by default)
+    [:param skip_done:], [:param use_hash:], [:param chunksize:], 
+    [:param memory_budget:], [:param file_timeout:] see parse_rawacf_folder()
+    """
+    assert(os.path.isdir(root))
+    logging.info("Indexing archive {0}...".format(root))
+    index = rawacf_index.RawacfIndex.from_tree(root, start, end, station_code)
+    logging.info("Found {0} files from {1} stations over {2} days.".format(
+                 len(index), len(index.stations()), len(index.days())))
+
+    # Files are named by their path within the archive
+    stats = dict((os.path.relpath(f.path, root), (f.size, f.mtime)) for f in index)
+    files = [os.path.relpath(f.path, root) for f in index]
+    if workers is None:
+        workers = os.cpu_count()
+    parse_rawacf_files(root, files, conn, stats=stats, skip_done=skip_done,
+                       use_hash=use_hash, workers=workers, chunksize=chunksize,
+                       memory_budget=memory_budget, file_timeout=file_timeout)
+
+def parse_rawacf_files(folder, files, conn, stats=None, skip_done=True, use_hash=False,
+                       workers=1, chunksize=None, memory_budget=None, 
+                       file_timeout=PARSE_TIMEOUT):
+    """
+    Parses the given files, saving their records and manifest entries to
+    the database (see parse_rawacf_folder()).
+
+    :param folder: [str] folder which the files' paths are relative to
+    :param files: [list of str] names (or relative paths) of the files
+    :param conn: [sqlite3 connection] to the database
+    [:param stats:] [dict] of file -> (size, mtime) for files already stat'ed
+    [:param workers:] [int] number of worker processes (1 for sequential)
+    [:param skip_done:], [:param use_hash:], [:param chunksize:], 
+    [:param memory_budget:], [:param file_timeout:] see parse_rawacf_folder()
+    """
+    from concurrent.futures.process import BrokenProcessPool
+    cur = conn.cursor()
+    if skip_done:
+        done = rut.manifest_done(cur, folder, files, use_hash=use_hash, stats=stats)
+        if len(done) > 0:
+            logging.info("Skipping {0} / {1} files already in the manifest.".format(
+                         len(done), len(files)))
+            files = [f for f in files if f not in done]
 
     # Start exception handler/write handler
-    manager = mp.Manager()
-    exc_msg_queue = manager.Queue()
-    write_handler = mp.Process(target=exc_handler_func, args=( exc_msg_queue,))
-    write_handler.start()  
+    exc_msg_queue, write_handler = start_exc_handler()
     
-    files = os.listdir(folder) 
-    file_indices = np.arange(1, len(files)+1) 
-    # Perform this task differently depending on if we're willing to multiprocess
-    if multiprocess==True:
-        # Assemble a bundle of arguments for mp.pool to use 
-        arg_bundle = itertools.izip(itertools.repeat(folder), files, file_indices,
-                    itertools.repeat(exc_msg_queue))
-      
-        # Set the pool to work
-        logging.debug("Beginning a pool multiprocessing of the files...") 
-        
-        try:
-            # Force python to garbage collect by using closing from context lib?
-            with closing(mp.Pool(maxtasksperchild=2)) as pool:
-                recs = pool.map(parse_file_wrapper, arg_bundle)
-            logging.debug("Done with multiprocessing of files (supposedly)")
-        except Exception as e:
-            logging.error("\nUnsuccessful multiprocessing attempt. Continuing sequentially\n")
-            logging.exception(e)
-            multiprocess = False 
-    if multiprocess==False:
+    # Records are handed to a single writer as they come in, so that only a 
+    # bounded number are ever held in memory and finished ones are committed
+    # (it has its own connection, so don't leave it waiting on our locks)
+    conn.commit()
+    writer = RecordWriter(conn, folder, use_hash=use_hash)
+    writer.start()
+    try:
+        # Perform this task differently depending on if we're willing to multiprocess
+        if workers > 1:
+            logging.debug("Beginning parsing of the files with {0} worker processes...".format(
+                          workers)) 
+            try:
+                for fil, rec, failure in parse_files_parallel(folder, files, exc_msg_queue,
+                                        workers, chunksize, stats, memory_budget, file_timeout):
+                    writer.put(fil, rec, failure)
+                logging.debug("Done with multiprocessing of files")
+            except BrokenProcessPool as e:
+                logging.error("\nUnsuccessful multiprocessing attempt. Continuing sequentially\n")
+                logging.exception(e)
         # Sequential processing: iterate through, parsing each file 1-by-1
-        recs = []
+        # (skipping any that the worker processes already got through)
         for i, fil in enumerate(files):
-            path = rut.ENDPOINT
-            fname = os.path.basename(fil)
-            r = parse_file(path, fname, i, exc_msg_queue)
-            recs.append(r)
-    num_uncounted = 0
-    for rec in recs:
-        if rec is not None:
-            rec.save_to_db(cur)
-            conn.commit()
-        else:
-            num_uncounted += 1
-            logging.debug("Found an instance of a None record!")
-
-    write_handler.terminate() 
-
-    done_str = "Done with processing files in folder. {0} / {1} were saved to the database."
+            if fil in writer.seen:
+                continue
+            writer.put(*parse_file_wrapper((folder, fil, i, exc_msg_queue)))
+    finally:
+        writer.close()
+        stop_exc_handler(exc_msg_queue, write_handler)
+    num_uncounted = writer.num_uncounted
+
+    done_str = "Done with processing files. {0} / {1} were saved to the database."
     logging.info(done_str.format(len(files) - num_uncounted, len(files))) 
     # Commit the database changes
     conn.commit()
 
-def parse_file(path, fname, index, exc_msg_queue):
+def plan_tasks(folder, files, stats=None, batch_cost=SMALL_TASK_COST, max_batch=None):
+    """
+    Groups files into tasks for the worker pool, ordered largest first (so
+    that a big file isn't left to be started last, with every other worker
+    sitting idle). Files estimated to cost less than batch_cost are packed
+    together into shared tasks of up to batch_cost, to cut down on the 
+    number of round trips to the workers.
+
+    :param folder: [str] folder holding the files
+    :param files: [list of str] names of the files
+    [:param stats:] [dict] of fname -> (size, mtime) for files already stat'ed
+    [:param batch_cost:] [int] estimated cost (see rawacf_index.estimate_cost)
+                    up to which small files are batched together
+    [:param max_batch:] [int] most files to put in one task
+
+    :returns: [list] of (estimated cost, estimated peak memory, [list of 
+                (file index, fname)]) tasks, largest first
+    """
+    costed = []
+    for i, fil in enumerate(files, 1):
+        if stats is not None and fil in stats:
+            size = stats[fil][0]
+        else:
+            try:
+                size = os.stat(os.path.join(folder, fil)).st_size
+            except OSError:
+                size = 0
+        costed.append((rawacf_index.estimate_cost(fil, size), 
+                       rawacf_index.estimate_memory(fil, size), i, fil))
+    costed.sort(reverse=True)
+
+    tasks = []
+    batch, batch_total, batch_mem = [], 0, 0
+    for cost, mem, i, fil in costed:
+        if cost >= batch_cost:
+            tasks.append((cost, mem, [(i, fil)]))
+            continue
+        if len(batch) > 0 and (batch_total + cost > batch_cost or 
+                               (max_batch is not None and len(batch) >= max_batch)):
+            tasks.append((batch_total, batch_mem, batch))
+            batch, batch_total, batch_mem = [], 0, 0
+        batch.append((i, fil))
+        batch_total += cost
+        # A task's files are parsed one after another
+        batch_mem = max(batch_mem, mem)
+    if len(batch) > 0:
+        tasks.append((batch_total, batch_mem, batch))
+    tasks.sort(key=lambda task: -task[0])
+    return tasks
+
+def default_memory_budget():
+    """
+    :returns: [int] bytes of memory the worker pool may plan on using: 
+                MEMORY_BUDGET_FRACTION of the machine's physical memory
+    """
+    try:
+        total = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        total = 4 << 30
+    return int(total * MEMORY_BUDGET_FRACTION)
+
+def parse_files_parallel(folder, files, exc_msg_queue, workers, chunksize=None,
+                         stats=None, memory_budget=None, file_timeout=PARSE_TIMEOUT):
+    """
+    Parses files across a pool of worker processes, yielding the results as
+    they're finished. Tasks are handed out largest first (see plan_tasks) and
+    only one task per worker is submitted at any time, so memory use doesn't 
+    grow with the number of files (and a task's clock starts when it does).
+
+    Tasks are only started while the estimated memory (see 
+    rawacf_index.estimate_memory) of everything running fits within the 
+    memory budget. Any file too big to share its worker's portion of the 
+    budget goes to a separate single-worker lane, so at most one of them is
+    ever being decompressed at a time; while one is waiting to start, no new
+    tasks are started in the main pool.
+
+    A task that runs for longer than file_timeout seconds per file in it is
+    presumed hung: its lane's pool is killed and replaced, and the tasks 
+    which were running alongside it are started again. A single hung file is
+    reported as failed with a ParseTimeoutError; a batch of small files is 
+    split up and retried one file per task. If a worker dies outright (e.g. 
+    killed by the OS), every file its pool was working on is retried alone 
+    in the single-worker lane, where a second death does pin it on the file:
+    it's reported as failed with a ParseCrashError, which (unlike a timeout)
+    leaves it to be tried again on a later run, e.g. with more memory.
+
+    Once done, the time taken by the slowest task is logged against the mean
+    task time: if the slowest dwarfs the total time divided among the 
+    workers, the pool spent its tail end waiting on one file.
+
+    :param folder: [str] folder holding the files
+    :param files: [list of str] names of the files to parse
+    :param exc_msg_queue: [mp.Queue] for the workers to send exceptions to
+    :param workers: [int] number of worker processes
+    [:param chunksize:] [int] most (small) files to batch into one task
+    [:param stats:] [dict] of fname -> (size, mtime) for files already stat'ed
+    [:param memory_budget:] [int] bytes; by default default_memory_budget()
+    [:param file_timeout:] [float] seconds a file may take, or None to wait
+                    forever
+
+    :returns: a generator of parse_file_wrapper() results
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from concurrent.futures.process import BrokenProcessPool
+    if memory_budget is None:
+        memory_budget = default_memory_budget()
+    tasks = plan_tasks(folder, files, stats, max_batch=chunksize)
+    big_tasks = [t for t in tasks if t[1] > memory_budget / workers]
+    tasks = [t for t in tasks if t[1] <= memory_budget / workers]
+    if len(big_tasks) > 0:
+        logging.info("{0} file(s) are too big to share the memory budget; parsing them one at a time.".format(
+                     len(big_tasks)))
+    tasks.reverse()
+    big_tasks.reverse()
+    queues = {'main': tasks, 'big': big_tasks}
+    sizes = {'main': workers, 'big': 1}
+    pools = dict((lane, ProcessPoolExecutor(max_workers=n)) for lane, n in sizes.items())
+    # future -> (lane, task, deadline)
+    running = dict()
+    timings = []
+    pool_start = time.time()
+
+    def submit(lane):
+        task = queues[lane].pop()
+        arg_bundles = [(folder, fil, i, exc_msg_queue) for i, fil in task[2]]
+        deadline = None
+        if file_timeout is not None:
+            deadline = time.time() + file_timeout * len(task[2])
+        running[pools[lane].submit(parse_files_chunk, arg_bundles)] = (lane, task, deadline)
+
+    def failed(lane, task, exc, retry=False):
+        # Give up on a lone file (unless told to retry it), or split up a 
+        # batch to find the culprit
+        cost, mem, batch = task
+        if len(batch) == 1 and not retry:
+            i, fil = batch[0]
+            logging.error("\t{0} File: {1}: {2}".format(i, fil, exc))
+            exc_msg_queue.put((fil, exc))
+            return [(fil, None, exc)]
+        if len(batch) > 1:
+            logging.warning("\tA batch of {0} files failed ({1}); retrying them one by one.".format(
+                            len(batch), exc))
+        for i, fil in batch:
+            queues[lane].append((cost / len(batch), mem, [(i, fil)]))
+        return []
+
+    try:
+        while any(len(q) > 0 for q in queues.values()) or len(running) > 0:
+            in_use = sum(task[1] for lane, task, deadline in running.values())
+            lanes = [lane for lane, task, deadline in running.values()]
+            # A. Start the next big file once there's room for it
+            big_waiting = 'big' not in lanes and len(big_tasks) > 0
+            if big_waiting and (len(running) == 0 or in_use + big_tasks[-1][1] <= memory_budget):
+                in_use += big_tasks[-1][1]
+                submit('big')
+                big_waiting = False
+            # B. Fill up the main pool, within the budget
+            while not big_waiting and len(tasks) > 0 and lanes.count('main') < workers and \
+                    (len(running) == 0 or in_use + tasks[-1][1] <= memory_budget):
+                in_use += tasks[-1][1]
+                submit('main')
+                lanes.append('main')
+
+            deadlines = [d for lane, task, d in running.values() if d is not None]
+            timeout = max(min(deadlines) - time.time(), 0) if len(deadlines) > 0 else None
+            finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            broken = set()
+            for fut in finished:
+                lane, task, deadline = running[fut]
+                try:
+                    results, elapsed = fut.result()
+                except BrokenProcessPool:
+                    # Dealt with below, along with the rest of its lane
+                    broken.add(lane)
+                    continue
+                del running[fut]
+                timings.append((elapsed, task[2]))
+                for result in results:
+                    yield result
+
+            # C. Replace any lane with a hung (or dead) worker
+            now = time.time()
+            hung = set(fut for fut, (lane, task, d) in running.items() 
+                       if d is not None and d <= now and fut not in finished)
+            broken.update(running[fut][0] for fut in hung)
+            for lane in broken:
+                logging.warning("\tRestarting the '{0}' worker pool.".format(lane))
+                for fut in [f for f in running if running[f][0] == lane]:
+                    task = running.pop(fut)[1]
+                    if fut in hung:
+                        exc = ParseTimeoutError("Timed out after {0} s".format(
+                                                file_timeout * len(task[2])))
+                        for result in failed(lane, task, exc):
+                            yield result
+                    elif fut.done() and fut.exception() is not None:
+                        # A worker died. In the single-worker lane, its file
+                        # must be why; otherwise, any of the lane's files could
+                        # be, so each is tried again on its own in that lane.
+                        exc = ParseCrashError("Worker died while parsing")
+                        for result in failed('big', task, exc, retry=(lane != 'big')):
+                            yield result
+                    else:
+                        # Innocent bystander: start it over
+                        queues[lane].append(task)
+                _kill_pool(pools[lane])
+                pools[lane] = ProcessPoolExecutor(max_workers=sizes[lane])
+    finally:
+        for pool in pools.values():
+            if len(running) > 0:
+                _kill_pool(pool)
+            else:
+                pool.shutdown(wait=True)
+
+    if len(timings) > 0:
+        wall = time.time() - pool_start
+        slowest, batch = max(timings, key=lambda t: t[0])
+        mean = sum(t[0] for t in timings) / len(timings)
+        report = "Pool ran {0} tasks in {1:.1f} s: slowest task {2:.1f} s ({3}), " + \
+                 "mean {4:.2f} s, {5:.0%} of the wall time"
+        logging.info(report.format(len(timings), wall, slowest, 
+                     batch[0][1] if len(batch) == 1 else "{0} files".format(len(batch)),
+                     mean, slowest / wall if wall > 0 else 0))
+
+def _kill_pool(pool):
+    """
+    Shuts down a ProcessPoolExecutor without waiting on its running tasks,
+    by killing its worker processes.
+    """
+    # There's no public way to get at the workers, so this relies on 
+    # CPython's private _processes dict (pid -> Process). It's None once the
+    # pool has been shut down. Without it, a hung worker is left running.
+    if not hasattr(pool, '_processes'):
+        logging.warning("\tCan't get at the worker processes to kill them!")
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for proc in processes:
+        if proc.is_alive():
+            proc.kill()
+    for proc in processes:
+        proc.join(SUBPROC_JOIN_TIMEOUT)
+
+def parse_files_chunk(arg_bundles):
+    """
+    Runs parse_file_wrapper over a chunk of files, in a worker process.
+
+    :param arg_bundles: [list] of tuples of parse_file's arguments
+
+    :returns: [tuple] of a [list] of parse_file_wrapper's results and the 
+                time taken in seconds
+    """
+    start = time.time()
+    results = [parse_file_wrapper(args) for args in arg_bundles]
+    return results, time.time() - start
+
+def manifest_status(fname, rec, saved, failure=None):
+    """
+    Decides what outcome to record in the manifest for a parsed file.
+
+    :param fname: [str] name of the file
+    :param rec: [rawacf_utils.RawacfRecord] made from the file, or None
+    :param saved: the result of rec.save_to_db (True, False or None)
+    [:param failure:] [ParseRetryError, ParseTimeoutError or ParseCrashError]
+                    if parsing the file failed for reasons other than it 
+                    being unreadable
+
+    :returns: [str] one of the rawacf_utils.MANIFEST_* outcomes
+    """
+    if rec is None and isinstance(failure, ParseTimeoutError):
+        return rut.MANIFEST_TIMEOUT
+    if rec is None and isinstance(failure, ParseCrashError):
+        return rut.MANIFEST_CRASHED
+    if rec is None and failure is not None:
+        return rut.MANIFEST_ERROR
+    if rec is None:
+        if fname[-4:] == '.bz2' or fname[-7:] == '.rawacf':
+            return rut.MANIFEST_BAD
+        return rut.MANIFEST_IGNORED
+    if saved is None:
+        return rut.MANIFEST_ERROR
+    if saved == False:
+        return rut.MANIFEST_DUPLICATE
+    if rec.not_corrupt == False:
+        return rut.MANIFEST_INCONSISTENT
+    return rut.MANIFEST_SAVED
+
+class ParseRetryError(Exception):
+    """
+    Raised by parse_file() when a file couldn't be parsed for reasons which
+    don't mean that the file itself is bad (e.g. running out of memory).
+    """
+    pass
+
+class ParseTimeoutError(Exception):
+    """
+    Stands in for the result of a file which hung the worker process 
+    parsing it (see parse_files_parallel()).
+    """
+    pass
+
+class ParseCrashError(Exception):
+    """
+    Stands in for the result of a file whose worker process died while 
+    parsing it (see parse_files_parallel()). Whatever killed it (e.g. the 
+    OS, for lack of memory) may not happen again, so it's worth retrying.
+    """
+    pass
+
+def parse_file(path, fname, index, exc_msg_queue, bz2_threads=1):
     """
     Takes an individual .rawacf file, tries opening it, tries using 
     backscatter to parse it, and if successful at this, constructs a 
@@ -293,9 +915,19 @@ def parse_file(path, fname, index, exc_msg_queue):
     :param fname: [string] name of rawacf file
     :param exc_msg_queue: [mp.Queue] for sending exception messages to
     [:param index:] [int] number of file in directory. Helpful for logging.
+    [:param bz2_threads:] [int] if > 1, decompress a .bz2 file's blocks in 
+                    parallel with this many threads. Worth it for the odd 
+                    huge file when there aren't other files to keep the 
+                    rest of the cores busy.
 
     :returns: A RawacfRecord constructed using RawacfRecord.record_from_dics
-                on a list of dictionaries assembled using 'backscatter'.
+                on a list of dictionaries assembled using 'backscatter', or
+                None if no record could be made.
+
+    :raises: ParseRetryError if the file still couldn't be read after 
+                MAX_PARSE_RETRIES retries for lack of memory, or memory ran 
+                out while making its record. Unlike other failures, trying 
+                again later might well work.
 
     *NOTE*: Contrary to convention, _all_ exceptions are handled using umbrella
             'Exception' because otherwise these child threads fail to exit 
@@ -303,30 +935,35 @@ def parse_file(path, fname, index, exc_msg_queue):
     """
     # I. Open File / Read with Backscatter
     logging.info("{0} File: {1}".format(index, fname)) 
-    try:
-        if fname[-4:] == '.bz2':
-            dics = rut.bz2_dic(path + '/' + fname)
-        elif fname[-7:] == '.rawacf':
-            dics = rut.acf_dic(path + '/' + fname)
-        else:
-            logging.info('\t{0} File {1} not used for dmap records.'.format(index, fname))
-            return None
-    except Exception as e:
-        err_str = "\t{0} File: {1}: Error reading dmap from stream - possible record" + \
-                  " corruption. Skipping file."
-        logging.error(err_str.format(index, fname), exc_info=True)
-        # Tell the write handler to add this to the list of bad rawacf files
-        exc_msg_queue.put((fname, e))
+    if fname[-4:] != '.bz2' and fname[-7:] != '.rawacf':
+        logging.info('\t{0} File {1} not used for dmap records.'.format(index, fname))
         return None
-    except MemoryError as e:
-        logging.error("\t{0} File: {1}: RAN OUT OF MEMORY.".format(index, fname), exc_info=True)
-        exc_msg_queue.put((fname, e))
-        # 'Just do it again!'. I know its inelegant, but this occurs rarely...
-        import time
-        time.sleep(SHORT_SLEEP_INTERVAL)
-        return parse_file(path, fname, index, exc_msg_queue)
+    for attempt in range(MAX_PARSE_RETRIES + 1):
+        try:
+            # Only the scalar fields are needed, so skip the array payloads
+            dics = rut.scan_rawacf(path + '/' + fname, bz2_threads=bz2_threads)
+            break
+        except MemoryError as e:
+            # (Has to come first: MemoryError is also an Exception)
+            if attempt == MAX_PARSE_RETRIES:
+                logging.error("\t{0} File: {1}: RAN OUT OF MEMORY {2} times. Giving up.".format(
+                              index, fname, attempt + 1))
+                exc_msg_queue.put((fname, e))
+                raise ParseRetryError("MemoryError after {0} attempts".format(attempt + 1))
+            delay = RETRY_BACKOFF * 2**attempt
+            logging.error("\t{0} File: {1}: RAN OUT OF MEMORY. Retrying in {2} s.".format(
+                          index, fname, delay))
+            time.sleep(delay)
+        except Exception as e:
+            err_str = "\t{0} File: {1}: Error reading dmap from stream - possible record" + \
+                      " corruption. Skipping file."
+            logging.error(err_str.format(index, fname), exc_info=True)
+            # Tell the write handler to add this to the list of bad rawacf files
+            exc_msg_queue.put((fname, e))
+            return None
 
     # II. Make rawacf record and check the data's okay     
+    r = None
     try:
         r = rut.RawacfRecord.record_from_dics(dics)
         if r.not_corrupt == False:
@@ -334,6 +971,14 @@ def parse_file(path, fname, index, exc_msg_queue):
             raise rut.InconsistentRawacfError(err_str)
         logging.info('\t{0} File  {1}: File processed.'.format(index, fname))
 
+    except MemoryError as e:
+        # (Has to come first, as above.) Not the file's fault, so don't give
+        # up on it for good
+        logging.error("\t{0} File: {1}: RAN OUT OF MEMORY making its record.".format(
+                      index, fname))
+        exc_msg_queue.put((fname, e))
+        raise ParseRetryError("MemoryError while making the record")
+
     except Exception  as e:
         err_str = "\t{0} File {1}: Exception raised during process_experiment: {2}"
         logging.warning(err_str.format(index, fname, e))
@@ -352,41 +997,227 @@ def parse_file_wrapper(args):
     
     :param args: tuple of the arguments destined for parse_file
     
-    :returns: the output of parse_file: a [rawacf_utils.RawacfRecord object]
+    :returns: [tuple] of the file's name (since results may come back out of
+                order), the output of parse_file: a [rawacf_utils.RawacfRecord 
+                object], and None or, if parsing might work on another try,
+                the ParseRetryError saying why it failed
+    """
+    try:
+        return args[1], parse_file(*args), None
+    except ParseRetryError as e:
+        return args[1], None, e
+
+class RecordWriter(threading.Thread):
     """
-    return parse_file(*args)
+    A thread which is the only one to write parsed records (and their files'
+    manifest entries) to the database. Records are handed over through a 
+    bounded queue, so a producer which gets too far ahead just waits, and 
+    are written WRITE_BATCH_SIZE files at a time, with one executemany() 
+    (see rawacf_utils.save_records()) and one commit per batch, so that
+    finished work is kept even if the run dies part-way through.
+
+    The writer uses its own connection to the same database file as 'conn'
+    (sqlite3 connections can't be shared across threads), and is meant to be
+    the database's only writer while it runs; 'conn' is committed before it
+    starts and not written to until it's closed. Readers (e.g. uptime.py)
+    can carry on at the same time, since the database is in WAL mode (see 
+    rawacf_utils.open_db()). For an in-memory database there's no other way
+    in, so records are written straight away by the calling thread instead.
+    """
+    def __init__(self, conn, folder, use_hash=False, batch_size=WRITE_BATCH_SIZE,
+                 maxsize=WRITE_QUEUE_SIZE):
+        """
+        :param conn: [sqlite3 connection] to the database to write to
+        :param folder: [str] folder holding the files whose records are written
+        [:param use_hash:] [boolean] record content hashes in the manifest
+        [:param batch_size:] [int] files to write between commits
+        [:param maxsize:] [int] most records to hold before put() blocks
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.folder = folder
+        self.use_hash = use_hash
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.seen = set()
+        self.num_written = 0
+        self.num_uncounted = 0
+        self.error = None
+        dbs = dict((row[1], row[2]) for row in conn.execute('PRAGMA database_list'))
+        self.dbname = dbs.get('main') or None
+        # In-memory DB: write synchronously through the caller's connection
+        self.conn = conn if self.dbname is None else None
+
+    def start(self):
+        if self.dbname is not None:
+            threading.Thread.start(self)
+
+    def put(self, fname, rec, failure=None):
+        """
+        Hands over a file's record (or None) to be written, along with the
+        exception for a file that hit a retryable error or timed out (see 
+        parse_file_wrapper()).
+        """
+        self.seen.add(fname)
+        if self.error is not None:
+            raise self.error
+        if self.dbname is None:
+            self._write(self.conn.cursor(), [(fname, rec, failure)])
+            self.conn.commit()
+        else:
+            self.queue.put((fname, rec, failure))
+
+    def close(self):
+        """
+        Waits for everything handed over so far to be written and committed.
+        """
+        if self.dbname is not None:
+            self.queue.put(None)
+            self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        conn = rut.open_db(self.dbname)
+        cur = conn.cursor()
+        batch = []
+        item = ()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._write(cur, batch)
+                    conn.commit()
+                    batch = []
+            self._write(cur, batch)
+            conn.commit()
+        except Exception as e:
+            logging.error("\t\tRecord writer failed!", exc_info=True)
+            self.error = e
+            # Keep draining so that producers blocked on put() can carry on
+            while item is not None:
+                item = self.queue.get()
+        finally:
+            conn.close()
+
+    def _write(self, cur, batch):
+        """
+        Writes a batch of (fname, rec, failure) items: all of their records
+        at once, then a manifest entry for each file.
+        """
+        recs = [rec for _, rec, _ in batch if rec is not None]
+        outcomes = iter(rut.save_records(cur, recs))
+        for fname, rec, failure in batch:
+            if rec is not None:
+                saved = next(outcomes)
+            else:
+                saved = None
+                self.num_uncounted += 1
+                logging.debug("Found an instance of a None record!")
+            rut.record_manifest(cur, self.folder, fname, 
+                                manifest_status(fname, rec, saved, failure),
+                                detail=str(failure or ""), use_hash=self.use_hash)
+            self.num_written += 1
   
-def exc_handler_func(exc_msg_queue):
+def start_exc_handler():
+    """
+    Starts the process which writes bad_rawacfs.txt and bad_fields.txt.
+
+    :returns: [tuple] of the (manager) queue to send it (rawacf_filename, 
+                exception) tuples through, and its [multiprocessing.Process]
+    """
+    manager = mp.Manager()
+    exc_msg_queue = manager.Queue()
+    write_handler = mp.Process(target=exc_handler_func, args=( exc_msg_queue,))
+    write_handler.start()
+    # Keep the manager alive for as long as its queue is in use
+    write_handler.manager = manager
+    return exc_msg_queue, write_handler
+
+def stop_exc_handler(exc_msg_queue, write_handler):
+    """
+    Stops the exception handler once it has written out every message sent to
+    it so far. It's only terminated if it makes no progress through the queue
+    in SUBPROC_JOIN_TIMEOUT seconds.
+    """
+    exc_msg_queue.put(None)
+    write_handler.join(SUBPROC_JOIN_TIMEOUT)
+    while write_handler.is_alive():
+        left = exc_msg_queue.qsize()
+        logging.warning("\t\tException handler still has {0} message(s) to write...".format(left))
+        write_handler.join(SUBPROC_JOIN_TIMEOUT)
+        if write_handler.is_alive() and exc_msg_queue.qsize() >= left:
+            logging.error("\t\tException handler is stuck - terminating it.")
+            write_handler.terminate()
+            write_handler.join()
+    if write_handler.exitcode != 0:
+        logging.error("\t\tException handler exited with code {0}; some bad files may "
+                      "not have been listed.".format(write_handler.exitcode))
+    write_handler.manager.shutdown()
+
+def exc_handler_func(exc_msg_queue, bad_files_log=BAD_RAWACFS_FILE,
+                     inconsistents_log=INCONSISTENT_FIELDS_FILE):
     """
     Function for doing the writing to bad_rawacfs.txt and bad_fields.txt to 
     avoid race conditions between worker processes.
 
+    Blocks until there's a message, then takes whatever else is already 
+    waiting (up to EXC_BATCH_SIZE messages) and writes them with one open of
+    each file. Returns once it has written everything sent before a None.
+
     :param exc_msg_queue: [multiprocessing.Queue] that provides a medium
                         for processes to send (rawacf_filename, exception)
-                        tuples to handler for printing.
+                        tuples to handler for printing, and None to stop it.
+    [:param bad_files_log:] [str] file to list unreadable rawacfs in
+    [:param inconsistents_log:] [str] file to list inconsistent rawacfs in
     """
-    while True:
-        if exc_msg_queue.empty():
-            time.sleep(SHORT_SLEEP_INTERVAL)
-        else:
+    import queue as queue_mod
+    done = False
+    while not done:
+        batch = [exc_msg_queue.get()]
+        while batch[-1] is not None and len(batch) < EXC_BATCH_SIZE:
             try:
-                logging.debug("\t\tWrite handler received a message!")
-                fname, exc = exc_msg_queue.get()
-                if isinstance(exc, rut.InconsistentRawacfError):
-                    logging.debug("\t\tWrite handler saving a bad_cpid event")
-                    write_inconsistent_rawacf(fname, exc)
-                elif isinstance(exc, backscatter.dmap.DmapDataError) or isinstance(exc, rut.BadRawacfError):
-                    logging.debug("\t\tWrite handler saving a bad_rawacf event")
-                    write_bad_rawacf(fname, exc)
-                elif type(exc) == MemoryError:
-                    logging.error("\t\tException handler sees memory error", exc_info=True)
-                else:
-                    err_str = "\t\tHandled miscellaneous 'other' exception: {0}"
-                    logging.debug(err_str.format(exc))
-            except TypeError:
+                batch.append(exc_msg_queue.get_nowait())
+            except queue_mod.Empty:
+                break
+        if batch[-1] is None:
+            # Sentinel from stop_exc_handler(): write what's left and stop
+            batch.pop()
+            done = True
+        logging.debug("\t\tWrite handler received {0} message(s)!".format(len(batch)))
+
+        bad, inconsistent = [], []
+        for msg in batch:
+            try:
+                fname, exc = msg
+            except (TypeError, ValueError):
                 logging.error("\t\tWrite handler had trouble unpacking message!", exc_info=True)
-            except IOError:
-                logging.error("\t\tWrite handler had trouble writing!", exc_info=True)
+                continue
+            if isinstance(exc, rut.InconsistentRawacfError):
+                inconsistent.append((fname, exc))
+            elif isinstance(exc, (backscatter.dmap.DmapDataError, rut.BadRawacfError,
+                                  ParseTimeoutError)):
+                bad.append((fname, exc))
+            elif type(exc) == MemoryError:
+                logging.error("\t\tException handler sees memory error: {0}".format(fname))
+            elif isinstance(exc, ParseCrashError):
+                # Not necessarily a bad file, so it's not listed as one
+                logging.error("\t\tException handler sees a crashed worker: {0}".format(fname))
+            else:
+                err_str = "\t\tHandled miscellaneous 'other' exception: {0}"
+                logging.debug(err_str.format(exc))
+        try:
+            if len(inconsistent) > 0:
+                logging.debug("\t\tWrite handler saving {0} bad_cpid event(s)".format(len(inconsistent)))
+                write_inconsistent_rawacfs(inconsistent, inconsistents_log)
+            if len(bad) > 0:
+                logging.debug("\t\tWrite handler saving {0} bad_rawacf event(s)".format(len(bad)))
+                write_bad_rawacfs(bad, bad_files_log)
+        except IOError:
+            logging.error("\t\tWrite handler had trouble writing!", exc_info=True)
 
 def write_inconsistent_rawacf(fname, exc, inconsistents_log=INCONSISTENT_FIELDS_FILE):
     """
@@ -395,9 +1226,15 @@ def write_inconsistent_rawacf(fname, exc, inconsistents_log=INCONSISTENT_FIELDS_
     :param fname: [str] filename that had inconsistent fields in it
     :param exc: [rawacf_utils.BadRawacfError] exception object
     """
+    write_inconsistent_rawacfs([(fname, exc)], inconsistents_log)
+
+def write_inconsistent_rawacfs(msgs, inconsistents_log=INCONSISTENT_FIELDS_FILE):
+    """
+    Writes several (filename, exception) entries to the bad_fields.txt file.
+    """
     # ***ADD TO LIST OF INCONSISTENT_FIELDS ***
     with open(inconsistents_log, 'a') as f:
-        f.write(fname + ':' + str(exc) + '\n')
+        f.write(''.join(fname + ':' + str(exc) + '\n' for fname, exc in msgs))
 
 def write_bad_rawacf(fname, exc, bad_files_log=BAD_RAWACFS_FILE): 
     """
@@ -406,14 +1243,19 @@ def write_bad_rawacf(fname, exc, bad_files_log=BAD_RAWACFS_FILE):
     :param fname: [str] filename that couldn't be opened by backscatter 
     :param exc: [backscatter.dmap.DmapDataError] exception object
    
+    """
+    write_bad_rawacfs([(fname, exc)], bad_files_log)
+
+def write_bad_rawacfs(msgs, bad_files_log=BAD_RAWACFS_FILE):
+    """
+    Writes several (filename, exception) entries to the bad_rawacfs.txt file.
     """
     # ***ADD TO LIST OF BAD_RAWACFS ***
     with open(bad_files_log, 'a') as f:
         # Backscatter exceptions have a newline that looks bad in 
         # logs, so I remove them here
-        exc_tmp = str(exc).split('\n')
-        exc_tmp = reduce(lambda x, y: x+y, exc_tmp)
-        f.write(fname + ':"' + str(exc_tmp) + '"\n')
+        f.write(''.join(fname + ':"' + ''.join(str(exc).split('\n')) + '"\n' 
+                        for fname, exc in msgs))
  
 #------------------------------------------------------------------------------ 
 #                       Command-Line Usability
@@ -438,54 +1280,171 @@ def get_args():
 
     parser.add_argument("-f", "--fname", help="Indicate a filename to process")
 
+    parser.add_argument("-a", "--archive", 
+                        help="Parse the rawacfs in an archive tree in place (e.g. one laid out as YYYY/MM/)")
+    parser.add_argument("--start", type=parse_date,
+                        help="First day to parse from an archive, as YYYY-MM-DD (with -a)")
+    parser.add_argument("--end", type=parse_date,
+                        help="Last day to parse from an archive, as YYYY-MM-DD (with -a)")
+
+    parser.add_argument("-t", "--bz2_threads", type=int, default=1,
+                        help="Threads for decompressing a big .bz2 file (with -f)")
+
+    parser.add_argument("-l", "--lookahead", type=int, default=DEFAULT_LOOKAHEAD,
+                        help="Days to fetch ahead of the one being parsed (with -y -m)")
+
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Number of processes to parse files with (default: one per CPU)")
+
+    parser.add_argument("-b", "--memory_budget", type=int, default=None,
+                        help="MB of memory that files being parsed may take up " + 
+                             "(default: half of physical memory)")
+
+    parser.add_argument("--timeout", type=float, default=PARSE_TIMEOUT,
+                        help="Seconds a worker may spend on one file before it's killed")
+
+    parser.add_argument("-s", "--shard_by", choices=['hour', 'station'],
+                        help="Split a day's fetch into hourly or per-station queries (with -d)")
+
+    parser.add_argument("--fetches", type=int, default=fetch.DEFAULT_CONCURRENCY,
+                        help="Most fetch queries to run at once (with -s)")
+
+    parser.add_argument("--mirror", 
+                        help="Fetch from a local archive (laid out as YYYY/MM/) instead of Globus")
+
+    parser.add_argument("--status", action="store_true",
+                        help="Show the progress of runs so far (optionally for -y/-m/-d)")
+    parser.add_argument("--restart", action="store_true",
+                        help="Start a month over, rather than resuming it (with -y -m)")
+
+    parser.add_argument("-r", "--reparse", action="store_true",
+                        help="Re-parse files the manifest says are done (with -p)")
+    parser.add_argument("--hash", action="store_true",
+                        help="Recognize already-parsed files by content hash (with -p)")
+
     # For now, we require a particular station to be requested
     parser.add_argument("-c", "--station_code", 
                         help="SuperDARN Station Code you want stats for (e.g. 'sas')")
 
+    parser.add_argument("--db", default="superdarntimes.sqlite",
+                        help="Database to save records to (default: superdarntimes.sqlite)")
+    parser.add_argument("--config", default="config.ini",
+                        help="Config file giving the Globus paths (default: config.ini)")
+
     parser.add_argument("-q", "--quiet", help="Use quiet mode",
                         action="store_true")
     args = parser.parse_args()
     return args
 
-def process_args(year, month, day, st_code, directory, fname):
+def process_args(year, month, day, st_code, directory, fname, bz2_threads=1,
+                 reparse=False, use_hash=False, lookahead=DEFAULT_LOOKAHEAD,
+                 workers=None, memory_budget=None, file_timeout=PARSE_TIMEOUT,
+                 shard_by=None, fetches=fetch.DEFAULT_CONCURRENCY, mirror=None,
+                 archive=None, start=None, end=None, status=False, restart=False,
+                 conn=None):
     """
     Function which handles interpreting what kind of processing request
     to make.
+
+    :returns: [boolean] False if some of the requested data couldn't be 
+                fetched
     """
+    if conn is None:
+        conn = rut.connect_db()
+
+    # Just reporting on progress?
+    if status:
+        print_job_status(conn, *date_range(year, month, day))
+        return
+
     # Highest precedence: if a particular file is provided as an arg.
     if fname is not None:
         if os.path.isfile(fname):
             logging.info("Parsing file {0}".format(fname))
-            process_file(fname)
+            process_file(fname, conn=conn, bz2_threads=bz2_threads)
             return
         else:
             logging.error("Invalid filename.")
 
+    # Next: an archive to parse in place, over a range of days (by default,
+    # whatever -y/-m/-d ask for)
+    if archive is not None:
+        if os.path.isdir(archive):
+            if start is None and end is None:
+                start, end = date_range(year, month, day)
+            elif end is not None:
+                end = end + timedelta(days=1)
+            logging.info("Parsing files in archive {0} from {1} to {2}".format(
+                         archive, start, end))
+            parse_rawacf_tree(archive, conn, start=start, end=end, station_code=st_code,
+                              skip_done=not reparse, use_hash=use_hash, workers=workers,
+                              memory_budget=memory_budget, file_timeout=file_timeout)
+            return
+        else:
+            logging.error("Invalid archive directory.")
+
     # Next level of precedence: if a directory is supplied
     if directory is not None:
         if os.path.isdir(directory): 
             logging.info("Parsing files in directory {0}".format(directory))
-            parse_rawacf_folder(directory)
+            start, end = date_range(year, month, day)
+            parse_rawacf_folder(directory, conn, skip_done=not reparse, use_hash=use_hash,
+                                start=start, end=end, station_code=st_code,
+                                multiprocess=True, workers=workers,
+                                memory_budget=memory_budget, file_timeout=file_timeout)
             return
         else:
             logging.error("Invalid directory.")
 
+    backend = None if mirror is None else fetch.LocalMirrorBackend(mirror)
     if year is not None and month is not None:
         # Next check if a day was provided
         if day is not None:
             msg = "Proceeding to fetch and parse data from {0}-{1}-{2}"
             logging.info(msg.format(year, month, day))
             logging.info("By the way, station code supplied to this was: '{0}'".format(st_code))
-            process_rawacfs_day(year, month, day, station_code=st_code)
-            return
+            return process_rawacfs_day(year, month, day, station_code=st_code, conn=conn,
+                                       workers=workers, memory_budget=memory_budget,
+                                       file_timeout=file_timeout, shard_by=shard_by,
+                                       fetches=fetches, backend=backend)
         else:
             msg = "Proceeding to fetch and parse data in {0}-{1}"
             logging.info(msg.format(year, month))
-            process_rawacfs_month(year, month)
-            return
+            failed = process_rawacfs_month(year, month, conn=conn, lookahead=lookahead,
+                                           workers=workers, memory_budget=memory_budget,
+                                           file_timeout=file_timeout, backend=backend,
+                                           resume=not restart)
+            return len(failed) == 0
     else:
         logging.info("Some form of argument is kinda required!")
 
+def date_range(year=None, month=None, day=None):
+    """
+    Turns an optional year/month/day request into a [start, end) range of
+    datetimes, e.g. for selecting files in a directory by their names.
+
+    :returns: [tuple] of (start, end), which are both None if no year is given
+    """
+    if year is None:
+        return None, None
+    if month is None:
+        return dt(year, 1, 1), dt(year + 1, 1, 1)
+    if day is None:
+        return dt(year, month, 1), (dt(year + month // 12, month % 12 + 1, 1))
+    start = dt(year, month, day)
+    return start, start + timedelta(days=1)
+
+def parse_date(s):
+    """
+    Reads a YYYY-MM-DD date from the command line.
+
+    :returns: [datetime] at midnight on that day
+    """
+    try:
+        return dt.strptime(s, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{0}' isn't a YYYY-MM-DD date".format(s))
+
 def initialize_logger(quiet_mode=False):
     """
     Function for setting up the initial logging parameters
@@ -522,7 +1481,17 @@ if __name__ == "__main__":
     
     initialize_logger(quietness_mode)
 
-    rut.read_config() 
-    conn = rut.connect_db()
-    cur = conn.cursor()
-    process_args(year, month, day, st_code, directory, fname)
+    rut.read_config(args.config) 
+    try:
+        conn = rut.connect_db(args.db)
+    except rut.DatabaseSchemaError as e:
+        # Before anything's fetched, rather than part-way through saving it
+        logging.error(e)
+        sys.exit(1)
+    ok = process_args(year, month, day, st_code, directory, fname, args.bz2_threads,
+                      args.reparse, args.hash, args.lookahead, args.workers, 
+                      args.memory_budget << 20 if args.memory_budget else None, args.timeout,
+                      args.shard_by, args.fetches, args.mirror, args.archive, 
+                      args.start, args.end, args.status, args.restart, conn)
+    # e.g. for proc_range.py to tell that a month didn't finish
+    sys.exit(1 if ok is False else 0)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+file: 'proc_range.py'
+description:
+    This python script fetches and parses the rawacf data over a range of
+    months (e.g. a whole year), running several months at once and merging
+    their records into a single database at the end.
+
+    Each month is run by its own 'parse.py -y YEAR -m MONTH' process, in its
+    own work folder (WORKDIR/YYYY-MM/) with its own database, parse.log,
+    bad_rawacfs.txt and bad_fields.txt, so the months never contend for a
+    database lock and each month's logs stay together. Since each month's
+    progress is kept in its own database (see the jobs table), running the
+    same range again resumes any months that didn't finish.
+
+    Once every month is done, their databases are merged into the output
+    database in bulk (see rawacf_utils.merge_dbs()). A month only counts as
+    done if its parse.py succeeded and its jobs table has every day of the
+    month committed; any other month is left out of the merge.
+
+    This replaces 'proc_year.sh', which ran the months one after another.
+
+date: October 2026
+"""
+
+import argparse
+import calendar
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import rawacf_utils as rut
+
+# Months to run at once
+DEFAULT_JOBS = 4
+# Where each month's work folder goes
+DEFAULT_WORKDIR = 'runs'
+# Name of each month's database (in its work folder)
+MONTH_DB = 'month.sqlite'
+
+PARSE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parse.py')
+
+def month_range(start, end):
+    """
+    Lists the months from start to end, inclusive.
+
+    :param start: [tuple] of (year, month)
+    :param end: [tuple] of (year, month)
+
+    :returns: [list of tuple] of (year, month)
+    """
+    months = []
+    year, month = start
+    while (year, month) <= tuple(end):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def month_dir(workdir, year, month):
+    """ :returns: [str] the work folder for a month """
+    return os.path.join(workdir, "{0}-{1:02d}".format(year, month))
+
+def run_month(year, month, workdir, parse_args=()):
+    """
+    Runs parse.py for one month, in the month's own work folder. Its output
+    goes to 'parse.out' there (alongside parse.log).
+
+    :param year: [int]
+    :param month: [int]
+    :param workdir: [str] folder holding the months' work folders
+    [:param parse_args:] [list of str] extra arguments for parse.py
+
+    :returns: [tuple] of (year, month, parse.py's return code, seconds taken)
+    """
+    folder = month_dir(workdir, year, month)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    cmd = [sys.executable, PARSE_SCRIPT, '-y', str(year), '-m', str(month),
+           '--db', MONTH_DB] + list(parse_args)
+    logging.info("Starting {0}-{1:02d}: {2}".format(year, month, " ".join(cmd)))
+    t0 = time.time()
+    with open(os.path.join(folder, 'parse.out'), 'ab') as out:
+        returncode = subprocess.call(cmd, cwd=folder, stdout=out, stderr=subprocess.STDOUT)
+    elapsed = time.time() - t0
+    if returncode != 0:
+        logging.error("\t{0}-{1:02d} failed (exit code {2}), see {3}".format(
+                      year, month, returncode, folder))
+    else:
+        logging.info("\tFinished {0}-{1:02d} in {2:.0f} s".format(year, month, elapsed))
+    return year, month, returncode, elapsed
+
+def unfinished_days(dbname, year, month):
+    """
+    Checks a month's jobs table for days that weren't finished (e.g. whose
+    fetch failed, or which were never started).
+
+    :param dbname: [str] path to the month's database
+    :param year: [int]
+    :param month: [int]
+
+    :returns: [list of str] the month's days (YYYY-MM-DD) which aren't 
+                recorded as committed
+    """
+    first = date(year, month, 1)
+    days = [str(first + timedelta(days=i)) 
+            for i in range(calendar.monthrange(year, month)[1])]
+    if not os.path.isfile(dbname):
+        return days
+    try:
+        conn = rut.connect_db_readonly(dbname)
+        try:
+            statuses = rut.job_statuses(conn.cursor(), days[0], 
+                                        first + timedelta(days=len(days)))
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        logging.error("\tCouldn't read the jobs table in {0}".format(dbname), exc_info=True)
+        return days
+    return [day for day in days if statuses.get((day, rut.ALL_STATIONS)) != rut.JOB_COMMITTED]
+
+def process_range(start, end, dbname, workdir=DEFAULT_WORKDIR, jobs=DEFAULT_JOBS,
+                  parse_args=()):
+    """
+    Fetches and parses every month from start to end (inclusive), 'jobs' at
+    a time, then merges the months' databases into 'dbname'. Months which
+    failed, or which have days that weren't committed (see 
+    unfinished_days()), aren't merged (run the range again to resume them).
+
+    :param start: [tuple] of (year, month) to start at
+    :param end: [tuple] of (year, month) to finish with
+    :param dbname: [str] database to merge the months' records into
+    [:param workdir:] [str] folder for the months' work folders
+    [:param jobs:] [int] most months to run at once
+    [:param parse_args:] [list of str] extra arguments for each parse.py
+
+    :returns: [list of tuple] of the (year, month)s which failed
+
+    :raises: rawacf_utils.DatabaseSchemaError if 'dbname' needs migrating
+                (which is checked before any month is started)
+    """
+    conn = rut.connect_db(dbname)
+    months = month_range(start, end)
+    logging.info("Processing {0} months, {1} at a time".format(len(months), jobs))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(lambda ym: run_month(ym[0], ym[1], workdir, parse_args),
+                                months))
+    failed = []
+    dbs = []
+    for year, month, returncode, _ in results:
+        month_db = os.path.join(month_dir(workdir, year, month), MONTH_DB)
+        if returncode != 0:
+            failed.append((year, month))
+            continue
+        # parse.py can succeed without every day having been done
+        unfinished = unfinished_days(month_db, year, month)
+        if len(unfinished) > 0:
+            logging.error("\t{0}-{1:02d} has {2} unfinished day(s): {3}".format(
+                          year, month, len(unfinished), ", ".join(unfinished)))
+            failed.append((year, month))
+            continue
+        dbs.append(month_db)
+    added = rut.merge_dbs(conn, dbs)
+    conn.close()
+    logging.info("Merged {0} months into {1} ({2} new experiments)".format(
+                 len(dbs), dbname, added))
+    if len(failed) > 0:
+        logging.error("These months didn't finish: {0}".format(
+                      ", ".join("{0}-{1:02d}".format(*ym) for ym in failed)))
+    return failed
+
+def share_resources(jobs, workers=None, memory_budget=None):
+    """
+    Splits the CPUs and the memory budget between the months being run at
+    once, since each parse.py would otherwise assume it has the machine to
+    itself.
+
+    :param jobs: [int] months to run at once
+    [:param workers:] [int] parse worker processes per month
+    [:param memory_budget:] [int] MB that all the months may use (by
+                    default, half of physical memory, as parse.py would)
+
+    :returns: [tuple] of (worker processes, MB of memory budget) per month
+    """
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // jobs)
+    if memory_budget is None:
+        try:
+            memory_budget = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') >> 21
+        except (ValueError, OSError, AttributeError):
+            memory_budget = 2048
+    return workers, max(1, memory_budget // jobs)
+
+#------------------------------------------------------------------------------
+#                       Command-Line Usability
+#------------------------------------------------------------------------------
+
+def parse_month(s):
+    """ Reads a YYYY-MM month from the command line. """
+    try:
+        year, month = [int(x) for x in s.split('-')]
+        assert 1 <= month <= 12
+    except (ValueError, AssertionError):
+        raise argparse.ArgumentTypeError("'{0}' isn't a YYYY-MM month".format(s))
+    return year, month
+
+def get_args():
+    """
+    Parse the command-line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-y", "--year", type=int, help="Year to process (all 12 months)")
+    parser.add_argument("-s", "--start", type=parse_month, help="First month to process (YYYY-MM)")
+    parser.add_argument("-e", "--end", type=parse_month, help="Last month to process (YYYY-MM)")
+    parser.add_argument("-o", "--output",
+                        help="Database to merge the months into (default: YYYYdata.sqlite)")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help="Months to run at once (default: {0})".format(DEFAULT_JOBS))
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR,
+                        help="Folder for each month's database and logs (default: runs/)")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Parse processes per month (default: CPUs shared between the months)")
+    parser.add_argument("-b", "--memory_budget", type=int, default=None,
+                        help="MB of memory that all the months' parsing may take up " +
+                             "(default: half of physical memory)")
+    parser.add_argument("--mirror",
+                        help="Fetch from a local archive (laid out as YYYY/MM/) instead of Globus")
+    parser.add_argument("--config", default="config.ini",
+                        help="Config file giving the Globus paths (default: config.ini)")
+    args = parser.parse_args()
+    if args.year is not None:
+        args.start = args.start or (args.year, 1)
+        args.end = args.end or (args.year, 12)
+    if args.start is None:
+        parser.error("Either -y or -s is needed")
+    args.end = args.end or args.start
+    if args.output is None:
+        args.output = "{0}data.sqlite".format(args.start[0])
+    return args
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.basicConfig(level=logging.INFO,
+        format='%(levelname)s %(asctime)s: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    workers, memory_budget = share_resources(args.jobs, args.workers, args.memory_budget)
+    # Each month runs from its own folder, so paths have to be absolute
+    parse_args = ['-q', '-w', str(workers), '-b', str(memory_budget),
+                  '--config', os.path.abspath(args.config)]
+    if args.mirror is not None:
+        parse_args += ['--mirror', os.path.abspath(args.mirror)]
+
+    try:
+        failed = process_range(args.start, args.end, args.output, args.workdir, args.jobs,
+                               parse_args)
+    except rut.DatabaseSchemaError as e:
+        logging.error(e)
+        sys.exit(1)
+    sys.exit(1 if len(failed) > 0 else 0)
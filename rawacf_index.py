@@ -0,0 +1,284 @@
+"""
+file: 'rawacf_index.py'
+description:
+    This file contains an index of rawacf files built purely from their
+    names (and directory entries), which never opens the files themselves.
+
+    Rawacf filenames encode the start time and station of the data within,
+    e.g. '20161201.0401.00.bks.rawacf.bz2' (optionally with a channel
+    letter before '.rawacf'), so a folder or a whole archive tree can be
+    grouped by station and day, filtered by date range or station code,
+    checked against the ingest manifest, and split into evenly-sized
+    shards of work before any file is read.
+
+    The size of each file (from its directory entry) is used as an estimate
+    of how long it'll take to process.
+
+date: October 2026
+"""
+import collections
+import heapq
+import os
+import re
+from datetime import datetime as dt
+
+import rawacf_utils as rut
+
+# e.g. 20161201.0401.00.bks.rawacf.bz2 or 20161201.0401.00.bks.a.rawacf
+RAWACF_FNAME_RE = re.compile(r'^(\d{4})(\d{2})(\d{2})\.(\d{2})(\d{2})\.(\d{2})'
+                             r'\.([a-z]{3})(?:\.([a-z]))?\.rawacf(\.bz2)?$')
+
+# Rough cost of decompressing and parsing a byte of .bz2, relative to
+# parsing a byte of plain .rawacf
+BZ2_COST_FACTOR = 4
+# Typical ratio of a .rawacf's size to the size of its .rawacf.bz2
+BZ2_COMPRESSION_RATIO = 6
+
+def parse_rawacf_fname(fname):
+    """
+    Pulls the start time, station code and channel out of a rawacf filename.
+
+    :param fname: [str] name of the file (no path)
+
+    :returns: [tuple] of (datetime, station code, channel or None), or None
+                if fname isn't named like a rawacf file
+    """
+    m = RAWACF_FNAME_RE.match(fname)
+    if m is None:
+        return None
+    yr, mo, dy, hr, mt, sc = [int(g) for g in m.groups()[:6]]
+    try:
+        start = dt(yr, mo, dy, hr, mt, sc)
+    except ValueError:
+        return None
+    return start, m.group(7), m.group(8)
+
+def estimate_cost(fname, size):
+    """
+    Estimates the relative cost of processing a file from its size.
+
+    :param fname: [str] name of the file
+    :param size: [int] size of the file in bytes
+
+    :returns: [int] cost, in units of bytes of plain .rawacf
+    """
+    if fname[-4:] == '.bz2':
+        return size * BZ2_COST_FACTOR
+    return size
+
+def estimate_memory(fname, size):
+    """
+    Estimates how much memory parsing a file could take at worst, i.e. the
+    size of its decompressed contents.
+
+    :param fname: [str] name of the file
+    :param size: [int] size of the file in bytes
+
+    :returns: [int] estimated decompressed size in bytes
+    """
+    if fname[-4:] == '.bz2':
+        return size * BZ2_COMPRESSION_RATIO
+    return size
+
+def _to_datetime(d):
+    """
+    Promotes a date to a datetime (at midnight), leaving datetimes alone.
+    """
+    if d is None or isinstance(d, dt):
+        return d
+    return dt(d.year, d.month, d.day)
+
+class RawacfFile(collections.namedtuple('RawacfFile',
+        ['folder', 'fname', 'start', 'station', 'channel', 'size', 'mtime'])):
+    """
+    One entry in a RawacfIndex: a rawacf file and what its name says.
+    """
+    __slots__ = ()
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, self.fname)
+
+    @property
+    def day(self):
+        return self.start.date()
+
+    @property
+    def cost(self):
+        """ Estimated relative cost of processing the file """
+        return estimate_cost(self.fname, self.size)
+
+class RawacfIndex(object):
+    """
+    A collection of RawacfFiles, sorted by start time and station.
+    """
+    __slots__ = ('files',)
+
+    def __init__(self, files=()):
+        self.files = sorted(files, key=lambda f: (f.start, f.station, f.fname))
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __repr__(self):
+        return "RawacfIndex({0} files, {1} station-days)".format(
+            len(self.files), len(self.by_day()))
+
+    @classmethod
+    def from_folder(cls, folder):
+        """
+        Indexes the rawacf files directly inside a folder. Anything not
+        named like a rawacf file is left out.
+
+        :param folder: [str] path to the folder
+
+        :returns: [RawacfIndex]
+        """
+        return cls(_scan_folder(folder))
+
+    @classmethod
+    def from_tree(cls, root, start=None, end=None, station_code=None):
+        """
+        Indexes the rawacf files anywhere beneath a root directory (e.g. an
+        archive laid out as YYYY/MM/). Year directories outside of the
+        requested date range aren't descended into.
+
+        :param root: [str] path to the root of the tree
+        [:param start:] [datetime or date] earliest start time to include
+        [:param end:] [datetime or date] start time to stop before
+        [:param station_code:] [str] e.g. 'sas' to only include Saskatoon
+
+        :returns: [RawacfIndex]
+        """
+        start, end = _to_datetime(start), _to_datetime(end)
+        files = []
+        dirs = [root]
+        while len(dirs) > 0:
+            folder = dirs.pop()
+            subdirs = []
+            files.extend(_scan_folder(folder, subdirs))
+            # Don't bother descending into years which are out of range
+            for d in subdirs:
+                name = os.path.basename(d)
+                if len(name) == 4 and name.isdigit() and \
+                        ((start is not None and int(name) < start.year) or
+                         (end is not None and int(name) > end.year)):
+                    continue
+                dirs.append(d)
+        return cls(files).filter(start, end, station_code)
+
+    def filter(self, start=None, end=None, station_code=None):
+        """
+        Selects the files in a date range and/or from one station.
+
+        :param start: [datetime or date] earliest start time to include
+        :param end: [datetime or date] start time to stop before
+        :param station_code: [str] e.g. 'sas' to only include Saskatoon
+
+        :returns: [RawacfIndex] of the matching files
+        """
+        start, end = _to_datetime(start), _to_datetime(end)
+        return RawacfIndex(f for f in self.files
+                           if (start is None or f.start >= start) and
+                              (end is None or f.start < end) and
+                              (station_code is None or f.station == station_code))
+
+    def exclude_done(self, cur, use_hash=False):
+        """
+        Drops files which the ingest manifest says are already done.
+
+        :param cur: cursor to the sqlite3 database holding the manifest
+        [:param use_hash:] [boolean] see rawacf_utils.manifest_done()
+
+        :returns: [RawacfIndex] of the files that still need processing
+        """
+        done = set()
+        for folder, files in self.by_folder().items():
+            stats = dict((f.fname, (f.size, f.mtime)) for f in files)
+            done.update(os.path.join(folder, fname) for fname in
+                rut.manifest_done(cur, folder, list(stats), use_hash, stats))
+        return RawacfIndex(f for f in self.files if f.path not in done)
+
+    def fnames(self):
+        """ :returns: [list of str] the names of the indexed files """
+        return [f.fname for f in self.files]
+
+    def stations(self):
+        """ :returns: [list of str] the station codes seen, sorted """
+        return sorted(set(f.station for f in self.files))
+
+    def days(self):
+        """ :returns: [list of date] the days seen, sorted """
+        return sorted(set(f.day for f in self.files))
+
+    def by_folder(self):
+        """ :returns: [dict] of folder -> list of RawacfFiles in it """
+        groups = collections.OrderedDict()
+        for f in self.files:
+            groups.setdefault(f.folder, []).append(f)
+        return groups
+
+    def by_day(self):
+        """
+        :returns: [OrderedDict] of (day, station) -> list of RawacfFiles,
+                    in chronological order
+        """
+        groups = collections.OrderedDict()
+        for f in self.files:
+            groups.setdefault((f.day, f.station), []).append(f)
+        return groups
+
+    def cost(self):
+        """ :returns: [int] estimated cost of processing all the files """
+        return sum(f.cost for f in self.files)
+
+    def day_costs(self):
+        """ :returns: [OrderedDict] of (day, station) -> estimated cost """
+        return collections.OrderedDict((key, sum(f.cost for f in files))
+                                       for key, files in self.by_day().items())
+
+    def shard(self, n):
+        """
+        Splits the index into n shards of roughly equal estimated cost,
+        without splitting up any station's day. Station-days are handed out
+        largest first, each to the currently cheapest shard.
+
+        :param n: [int] number of shards wanted
+
+        :returns: [list of RawacfIndex] of length n (some may be empty)
+        """
+        groups = sorted(self.by_day().values(),
+                        key=lambda files: -sum(f.cost for f in files))
+        heap = [(0, i) for i in range(n)]
+        shards = [[] for i in range(n)]
+        for files in groups:
+            load, i = heapq.heappop(heap)
+            shards[i].extend(files)
+            heapq.heappush(heap, (load + sum(f.cost for f in files), i))
+        return [RawacfIndex(files) for files in shards]
+
+def _scan_folder(folder, subdirs=None):
+    """
+    Lists the rawacf files directly inside a folder as RawacfFiles.
+
+    :param folder: [str] path to the folder
+    [:param subdirs:] [list] if given, subdirectories are appended to it
+
+    :returns: [list of RawacfFile]
+    """
+    files = []
+    for entry in os.scandir(folder):
+        if entry.is_dir():
+            if subdirs is not None:
+                subdirs.append(entry.path)
+            continue
+        parsed = parse_rawacf_fname(entry.name)
+        if parsed is None or not entry.is_file():
+            continue
+        st = entry.stat()
+        files.append(RawacfFile(folder, entry.name, parsed[0], parsed[1],
+                                parsed[2], st.st_size, st.st_mtime))
+    return files
@@ -0,0 +1,491 @@
+"""
+file: 'rawacf_io.py'
+description:
+    This file contains low-level readers for the DMAP records stored in
+    .rawacf and .rawacf.bz2 files.
+
+    backscatter's parse_dmap_format_from_stream() needs the entire
+    decompressed file in memory before it builds any records. The readers
+    here instead pull one record at a time from any file-like object
+    (e.g. a bz2.BZ2File), so that peak memory stays at roughly the size
+    of one record no matter how large the file is. For callers that only
+    need a file's metadata, iter_dmap_scalars() reads just the record 
+    headers and scalar blocks and skips over the array payloads.
+
+    Uncompressed .rawacf files can instead be memory-mapped with 
+    iter_mmap_records(), which parses records straight out of the mapped
+    pages. Worker processes reading the same file then share the OS page
+    cache rather than each copying the file into their own heap.
+
+    Large .rawacf.bz2 files can be decompressed across several cores with
+    iter_bz2_parallel(), which splits the file at its (independent) bz2
+    block boundaries and decompresses the blocks in a thread pool.
+
+    *** DMAP RECORD LAYOUT (little-endian) ***
+        - int32 encoding code, int32 record size (incl. this header),
+          int32 number of scalars, int32 number of arrays
+        - scalars: null-terminated name, int8 type, value
+        - arrays: null-terminated name, int8 type, int32 dimension,
+          int32 dimension sizes (stored fastest-varying first), values
+
+date: October 2026
+"""
+import bz2
+import collections
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import backscatter
+
+DMAP_HEADER = struct.Struct('<iiii')
+DMAP_HEADER_SIZE = DMAP_HEADER.size
+
+# DMAP type codes and their (struct format, numpy dtype, size in bytes)
+DMAP_CHAR = 1
+DMAP_SHORT = 2
+DMAP_INT = 3
+DMAP_FLOAT = 4
+DMAP_DOUBLE = 8
+DMAP_STRING = 9
+DMAP_LONG = 10
+DMAP_UCHAR = 16
+DMAP_USHORT = 17
+DMAP_UINT = 18
+DMAP_ULONG = 19
+
+DMAP_TYPES = {DMAP_CHAR: ('<b', 'i1', 1), DMAP_SHORT: ('<h', '<i2', 2),
+              DMAP_INT: ('<i', '<i4', 4), DMAP_FLOAT: ('<f', '<f4', 4),
+              DMAP_DOUBLE: ('<d', '<f8', 8), DMAP_LONG: ('<q', '<i8', 8),
+              DMAP_UCHAR: ('<B', 'u1', 1), DMAP_USHORT: ('<H', '<u2', 2),
+              DMAP_UINT: ('<I', '<u4', 4), DMAP_ULONG: ('<Q', '<u8', 8)}
+
+# How many bytes of a record body to read in one go
+READ_CHUNK_SIZE = 1 << 20
+# How many bytes to read when looking for a record's scalar block
+SCALAR_PEEK_SIZE = 4096
+
+# 48-bit markers starting each bz2 block and ending each bz2 stream
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_EOS_MAGIC = 0x177245385090
+
+class Bz2BlockError(Exception):
+    """
+    Raised when a .bz2 file can't be split into independently 
+    decompressible blocks (e.g. a block marker turned up by chance inside
+    compressed data). Callers should fall back to serial decompression.
+    """
+
+def _read_cstring(buf, pos, end):
+    """
+    Reads a null-terminated string out of a buffer.
+
+    :param buf: [bytes or mmap] buffer holding DMAP data
+    :param pos: [int] offset of the first character of the string
+    :param end: [int] offset that the string must terminate before
+
+    :returns: ([str] decoded string, [int] offset just past the terminator)
+    """
+    nul = buf.find(b'\0', pos, end)
+    if nul < 0:
+        raise backscatter.dmap.DmapDataError(
+            "Unterminated string at byte {0} of DMAP record.".format(pos))
+    return bytes(buf[pos:nul]).decode('utf-8', 'replace'), nul + 1
+
+def _read_scalars(buf, pos, end, num_scalars, rec):
+    """
+    Reads 'num_scalars' DMAP scalars starting at offset 'pos' into 'rec'.
+
+    :returns: [int] offset just past the last scalar
+    """
+    for _ in range(num_scalars):
+        name, pos = _read_cstring(buf, pos, end)
+        if pos >= end:
+            raise backscatter.dmap.DmapDataError(
+                "Scalar '{0}' runs past the end of its record.".format(name))
+        dtype = struct.unpack_from('<b', buf, pos)[0]
+        pos += 1
+        if dtype == DMAP_STRING:
+            val, pos = _read_cstring(buf, pos, end)
+        elif dtype in DMAP_TYPES:
+            fmt, _, size = DMAP_TYPES[dtype]
+            if pos + size > end:
+                raise backscatter.dmap.DmapDataError(
+                    "Scalar '{0}' runs past the end of its record.".format(name))
+            val = struct.unpack_from(fmt, buf, pos)[0]
+            pos += size
+        else:
+            raise backscatter.dmap.DmapDataError(
+                "Bad DMAP type {0} for scalar '{1}'.".format(dtype, name))
+        rec[name] = val
+    return pos
+
+def _read_arrays(buf, pos, end, num_arrays, rec):
+    """
+    Reads 'num_arrays' DMAP arrays starting at offset 'pos' into 'rec'.
+    Numerical arrays are numpy arrays built directly on top of 'buf'.
+
+    :returns: [int] offset just past the last array
+    """
+    for _ in range(num_arrays):
+        name, pos = _read_cstring(buf, pos, end)
+        if pos + 5 > end:
+            raise backscatter.dmap.DmapDataError(
+                "Array '{0}' runs past the end of its record.".format(name))
+        dtype, ndim = struct.unpack_from('<bi', buf, pos)
+        pos += 5
+        if ndim <= 0 or pos + 4*ndim > end:
+            raise backscatter.dmap.DmapDataError(
+                "Bad dimension {0} for array '{1}'.".format(ndim, name))
+        dims = struct.unpack_from('<{0}i'.format(ndim), buf, pos)
+        pos += 4*ndim
+        # Dimensions are stored fastest-varying first
+        shape = tuple(reversed(dims))
+        count = 1
+        for d in shape:
+            count *= d
+        if count < 0:
+            raise backscatter.dmap.DmapDataError(
+                "Bad shape {0} for array '{1}'.".format(shape, name))
+        if dtype == DMAP_STRING:
+            vals = []
+            for _ in range(count):
+                val, pos = _read_cstring(buf, pos, end)
+                vals.append(val)
+            rec[name] = np.array(vals, dtype=object).reshape(shape)
+        elif dtype in DMAP_TYPES:
+            _, np_dtype, size = DMAP_TYPES[dtype]
+            if pos + count*size > end:
+                raise backscatter.dmap.DmapDataError(
+                    "Array '{0}' runs past the end of its record.".format(name))
+            arr = np.frombuffer(buf, dtype=np_dtype, count=count, offset=pos)
+            rec[name] = arr.reshape(shape)
+            pos += count*size
+        else:
+            raise backscatter.dmap.DmapDataError(
+                "Bad DMAP type {0} for array '{1}'.".format(dtype, name))
+    return pos
+
+def parse_dmap_record(buf, offset=0, scalars_only=False):
+    """
+    Parses the single DMAP record that starts at 'offset' in 'buf'.
+
+    :param buf: [bytes or mmap] buffer holding one or more DMAP records
+    [:param offset:] [int] offset of the start of the record in 'buf'
+    [:param scalars_only:] [boolean] only read the scalar block and jump
+                    straight past the array block using the record size
+
+    :returns: ([dict] of the record's scalars (and arrays),
+               [int] offset of the following record)
+    """
+    if offset + DMAP_HEADER_SIZE > len(buf):
+        raise backscatter.dmap.DmapDataError(
+            "Truncated DMAP record header at byte {0}.".format(offset))
+    _, size, num_scalars, num_arrays = DMAP_HEADER.unpack_from(buf, offset)
+    end = offset + size
+    if size < DMAP_HEADER_SIZE or end > len(buf):
+        raise backscatter.dmap.DmapDataError(
+            "Bad DMAP record size {0} at byte {1}.".format(size, offset))
+    if num_scalars < 0 or num_arrays < 0:
+        raise backscatter.dmap.DmapDataError(
+            "Bad scalar/array counts at byte {0}.".format(offset))
+    rec = dict()
+    pos = _read_scalars(buf, offset + DMAP_HEADER_SIZE, end, num_scalars, rec)
+    if scalars_only:
+        return rec, end
+    pos = _read_arrays(buf, pos, end, num_arrays, rec)
+    if pos != end:
+        raise backscatter.dmap.DmapDataError(
+            "DMAP record at byte {0} has {1} unaccounted bytes.".format(offset, end - pos))
+    return rec, end
+
+def _read_exact(stream, nbytes):
+    """
+    Reads exactly 'nbytes' bytes from 'stream' (file-like objects such as
+    BZ2File may return short reads).
+
+    :returns: [bytes] of length 'nbytes', or fewer if the stream ended
+    """
+    chunks = []
+    remaining = nbytes
+    while remaining > 0:
+        chunk = stream.read(min(remaining, READ_CHUNK_SIZE))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def _skip(stream, nbytes):
+    """
+    Moves 'stream' forward by 'nbytes' bytes, seeking where possible.
+
+    :returns: [int] number of bytes actually skipped
+    """
+    if nbytes <= 0:
+        return 0
+    if hasattr(stream, 'seekable') and stream.seekable():
+        before = stream.tell()
+        return stream.seek(nbytes, 1) - before
+    skipped = 0
+    while skipped < nbytes:
+        chunk = stream.read(min(nbytes - skipped, READ_CHUNK_SIZE))
+        if not chunk:
+            break
+        skipped += len(chunk)
+    return skipped
+
+def _read_header(stream, index):
+    """
+    Reads the 16-byte header of the next DMAP record in 'stream'.
+
+    :returns: ([bytes] header, [int] record size, [int] number of scalars),
+              or None if the stream ended cleanly
+    """
+    header = _read_exact(stream, DMAP_HEADER_SIZE)
+    if not header:
+        return None
+    if len(header) < DMAP_HEADER_SIZE:
+        raise backscatter.dmap.DmapDataError(
+            "Truncated DMAP record header in record {0}.".format(index))
+    _, size, num_scalars, _ = DMAP_HEADER.unpack(header)
+    if size < DMAP_HEADER_SIZE or num_scalars < 0:
+        raise backscatter.dmap.DmapDataError(
+            "Bad DMAP record header in record {0}.".format(index))
+    return header, size, num_scalars
+
+def iter_dmap_records(stream):
+    """
+    Generator which reads DMAP records one at a time from a file-like
+    object. Only one record's bytes are held at any time.
+
+    :param stream: file-like object with a read() method, e.g. an open
+                    bz2.BZ2File or a regular file opened in 'rb' mode
+
+    :returns: yields a [dict] per DMAP record, as backscatter would build
+    """
+    index = 0
+    while True:
+        head = _read_header(stream, index)
+        if head is None:
+            return
+        header, size, _ = head
+        body = _read_exact(stream, size - DMAP_HEADER_SIZE)
+        if len(body) < size - DMAP_HEADER_SIZE:
+            raise backscatter.dmap.DmapDataError(
+                "Truncated DMAP record {0}.".format(index))
+        rec, _ = parse_dmap_record(header + body)
+        yield rec
+        index += 1
+
+def iter_dmap_scalars(stream, fields=None):
+    """
+    Metadata-only counterpart to iter_dmap_records(). Reads each record's
+    header and scalar block, then skips past the array block (which holds
+    nearly all of a rawacf's bytes) without building anything from it.
+
+    :param stream: file-like object with a read() method
+    [:param fields:] [list of str] scalar names to keep. Default is all.
+
+    :returns: yields a [dict] of scalars per DMAP record
+    """
+    index = 0
+    while True:
+        head = _read_header(stream, index)
+        if head is None:
+            return
+        _, size, num_scalars = head
+        body_size = size - DMAP_HEADER_SIZE
+        # The scalar block is almost always well under SCALAR_PEEK_SIZE
+        peek = _read_exact(stream, min(body_size, SCALAR_PEEK_SIZE))
+        rec = dict()
+        try:
+            _read_scalars(peek, 0, len(peek), num_scalars, rec)
+        except backscatter.dmap.DmapDataError:
+            if len(peek) == body_size:
+                raise
+            # Scalars run past the peek, so fall back to the whole body
+            peek += _read_exact(stream, body_size - len(peek))
+            if len(peek) < body_size:
+                raise backscatter.dmap.DmapDataError(
+                    "Truncated DMAP record {0}.".format(index))
+            rec = dict()
+            _read_scalars(peek, 0, len(peek), num_scalars, rec)
+        if _skip(stream, body_size - len(peek)) < body_size - len(peek):
+            raise backscatter.dmap.DmapDataError(
+                "Truncated DMAP record {0}.".format(index))
+        if fields is not None:
+            rec = dict((k, rec[k]) for k in fields if k in rec)
+        yield rec
+        index += 1
+
+def iter_mmap_records(fname, scalars_only=False):
+    """
+    Generator which parses the DMAP records of an uncompressed file 
+    straight out of a read-only memory map. Numerical arrays are numpy 
+    views onto the mapped pages, so nothing is copied into the heap.
+
+    :param fname: path + filename of an uncompressed dmap (.rawacf) file
+    [:param scalars_only:] [boolean] only read each record's scalars, 
+                    so the pages holding the arrays are never touched
+
+    :returns: yields a [dict] per DMAP record
+    """
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if not scalars_only and hasattr(mm, 'madvise'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    try:
+        offset = 0
+        while offset < len(mm):
+            rec, offset = parse_dmap_record(mm, offset, scalars_only=scalars_only)
+            yield rec
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            # Arrays handed out above still point into the map; it gets
+            # unmapped once the last of them is garbage collected
+            pass
+
+class ChunkReader(object):
+    """
+    Minimal read-only file-like object over an iterable of bytes chunks,
+    so that iter_dmap_records()/iter_dmap_scalars() can consume the output
+    of iter_bz2_parallel() as it is produced.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+        self._pos = 0
+
+    def read(self, size=-1):
+        """
+        Reads up to 'size' bytes (or everything left, if size < 0).
+        """
+        out = []
+        while size != 0:
+            if self._pos >= len(self._buf):
+                self._buf = next(self._chunks, b'')
+                self._pos = 0
+                if not self._buf:
+                    break
+            end = len(self._buf) if size < 0 else self._pos + size
+            piece = self._buf[self._pos:end]
+            self._pos += len(piece)
+            out.append(piece)
+            if size > 0:
+                size -= len(piece)
+        return b''.join(out)
+
+def _read_bits(data, bitpos, nbits):
+    """
+    Reads 'nbits' bits (MSB first) from 'data' starting at bit 'bitpos'.
+
+    :returns: [int] value of the bits, or None if 'data' is too short
+    """
+    start = bitpos // 8
+    end = (bitpos + nbits + 7) // 8
+    if end > len(data):
+        return None
+    val = int.from_bytes(data[start:end], 'big')
+    val >>= (end - start)*8 - (bitpos % 8) - nbits
+    return val & ((1 << nbits) - 1)
+
+def _find_bit_pattern(data, magic):
+    """
+    Finds every (not necessarily byte-aligned) occurrence of a 48-bit 
+    marker in 'data'.
+
+    :returns: [list of int] bit offsets of the marker
+    """
+    found = []
+    for shift in range(8):
+        # The marker placed 'shift' bits into a 7-byte window. Bytes 1-5 
+        # of the window are always covered entirely by the marker.
+        window = (magic << (8 - shift)).to_bytes(7, 'big')
+        lead = 0 if shift == 0 else 1
+        pattern = window[lead:6]
+        pos = data.find(pattern)
+        while pos >= 0:
+            bitpos = (pos - lead)*8 + shift
+            if bitpos >= 0 and _read_bits(data, bitpos, 48) == magic:
+                found.append(bitpos)
+            pos = data.find(pattern, pos + 1)
+    return sorted(found)
+
+def bz2_block_spans(data):
+    """
+    Locates the blocks of a (possibly multi-stream) bz2 file.
+
+    :param data: [bytes] contents of a .bz2 file
+
+    :returns: [list of (int, int)] bit offset and length in bits of each 
+                block, running from its block marker up to the next marker
+    """
+    if data[:3] != b'BZh':
+        raise Bz2BlockError("Not a bz2 stream.")
+    markers = [ (pos, True) for pos in _find_bit_pattern(data, BZ2_BLOCK_MAGIC) ]
+    markers += [ (pos, False) for pos in _find_bit_pattern(data, BZ2_EOS_MAGIC) ]
+    markers.sort()
+    spans = []
+    for i, (pos, is_block) in enumerate(markers):
+        if not is_block:
+            continue
+        if i + 1 == len(markers):
+            raise Bz2BlockError("bz2 block at bit {0} is never closed.".format(pos))
+        spans.append((pos, markers[i+1][0] - pos))
+    return spans
+
+def decompress_bz2_block(data, bitpos, nbits):
+    """
+    Wraps one bz2 block in its own stream header and end-of-stream marker
+    (the stream CRC of a single-block stream is just the block's CRC) and
+    decompresses it.
+
+    :param data: [bytes] contents of the .bz2 file
+    :param bitpos: [int] bit offset of the block's marker
+    :param nbits: [int] length of the block in bits
+
+    :returns: [bytes] the block's decompressed data
+    """
+    block = _read_bits(data, bitpos, nbits)
+    crc = _read_bits(data, bitpos + 48, 32)
+    total = nbits + 80
+    pad = (-total) % 8
+    val = (((block << 48) | BZ2_EOS_MAGIC) << 32 | crc) << pad
+    try:
+        return bz2.decompress(b'BZh9' + val.to_bytes((total + pad)//8, 'big'))
+    except (OSError, ValueError, EOFError) as e:
+        raise Bz2BlockError("bz2 block at bit {0} failed: {1}".format(bitpos, e))
+
+def iter_bz2_parallel(fname, workers=None):
+    """
+    Generator which decompresses the blocks of a .bz2 file in a thread 
+    pool (bz2 releases the GIL while decompressing) and yields the 
+    decompressed data in file order. At most 2*workers blocks are in 
+    flight, so memory stays bounded for any size of file.
+
+    :param fname: path + filename of the .bz2 file
+    [:param workers:] [int] number of decompression threads 
+                    (default: number of CPUs)
+
+    :returns: yields [bytes] chunks of decompressed data, in order
+    """
+    with open(fname, 'rb') as f:
+        data = f.read()
+    spans = bz2_block_spans(data)
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = collections.deque()
+        for bitpos, nbits in spans:
+            futures.append(executor.submit(decompress_bz2_block, data, bitpos, nbits))
+            if len(futures) >= 2*workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
@@ -12,22 +12,31 @@ date: June 26 2017
 
 """
 import backscatter 
+import rawacf_io
 import logging
 import os
 import sys
 import subprocess
+import time
 
 import sqlite3
 import numpy as np
 
 import dateutil.parser
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 
 logging.basicConfig(level=logging.DEBUG,
     format='%(levelname)s %(asctime)s: %(message)s', 
     datefmt='%m/%d/%Y %I:%M:%S %p')
 
 CONSISTENT_RAWACF_THRESH = 20
+US_IN_SEC = 1000000
+EPOCH = dt(1970, 1, 1)
+
+# The only dmap fields that RawacfRecord.record_from_dics() needs
+RAWACF_SCALAR_FIELDS = ['cp', 'stid', 'origin.command', 'xcf', 'tfreq', 'nave', 
+                        'txpl', 'rsep', 'bmnum', 'time.yr', 'time.mo', 'time.dy',
+                        'time.hr', 'time.mt', 'time.sc', 'time.us']
 
 radars16 = {'cly': 66, 'gbr': 1, 'han': 10, 'hok': 40, 'hkw': 41, 'inv': 64,
             'kap': 3, 'ksr': 16, 'kod': 7, 'lyr': 90, 'pyk': 9, 'pgr': 6, 
@@ -40,6 +49,120 @@ allradars = radars16.copy()
 allradars.update(radars22)
 allradars.update(radars24)
 
+# Beam counts per station ID (anything not listed has 24), for checking 'bmnum'
+DEFAULT_NUM_BEAMS = 24
+STID_NUM_BEAMS = dict((stid, 16) for stid in radars16.values())
+
+# Outcomes of ingesting a file, as recorded in the manifest table
+MANIFEST_SAVED = 'saved'                # record saved to the exps table
+MANIFEST_INCONSISTENT = 'inconsistent'  # saved, but with not_corrupt False
+MANIFEST_DUPLICATE = 'duplicate'        # record was already in the exps table
+MANIFEST_BAD = 'bad'                    # file couldn't be read/made into a record
+MANIFEST_IGNORED = 'ignored'            # not a rawacf file
+MANIFEST_TIMEOUT = 'timeout'            # hung the worker parsing it
+MANIFEST_CRASHED = 'crashed'            # the worker parsing it died (e.g. OOM-killed)
+MANIFEST_ERROR = 'error'                # transient failure (e.g. DB locked)
+# Outcomes which won't change by parsing the same file again
+MANIFEST_FINAL = (MANIFEST_SAVED, MANIFEST_INCONSISTENT, MANIFEST_DUPLICATE,
+                  MANIFEST_BAD, MANIFEST_IGNORED, MANIFEST_TIMEOUT)
+
+# Progress of a (day, station) shard of a run, as recorded in the jobs table
+JOB_PENDING = 'pending'                 # planned, not yet started
+JOB_FETCHING = 'fetching'               # files being fetched
+JOB_PARSED = 'parsed'                   # records saved, files not yet cleared
+JOB_COMMITTED = 'committed'             # records committed and files cleared
+JOB_STATUSES = (JOB_PENDING, JOB_FETCHING, JOB_PARSED, JOB_COMMITTED)
+# Station code of the shard standing for all of a day's stations (which is
+# what a day's fetch asks for)
+ALL_STATIONS = '*'
+# Connection settings (see open_db())
+DB_BUSY_TIMEOUT = 30.           # seconds to wait on another connection's lock
+DB_CACHE_SIZE = 64 << 20        # bytes of page cache per connection
+DB_MMAP_SIZE = 256 << 20        # bytes of the file to memory-map for reading
+# Retries (with exponential backoff from DB_LOCK_BACKOFF s) for a write that
+# still found the database locked after DB_BUSY_TIMEOUT
+DB_LOCK_RETRIES = 3
+DB_LOCK_BACKOFF = 1.0
+# Most databases to attach at once when merging (sqlite allows 10 by default)
+MAX_ATTACHED = 8
+
+# Columns of the exps table, in order
+EXPS_COLUMNS = ('stid', 'start_iso', 'end_iso', 'cmd_name', 'cmd_args', 'cpid',
+                'min_nave', 'times_consistent', 'not_corrupt', 'min_tfreq',
+                'max_tfreq', 'xcf')
+
+# Columns of the exps table holding the start and end times as whole seconds
+# since the epoch (rounded down and up respectively, so that they never make
+# a record look shorter), for indexed range lookups
+EXPS_TS_COLUMNS = ('start_ts', 'end_ts')
+EXPS_TS_INDEX = 'CREATE INDEX IF NOT EXISTS exps_stid_ts ON exps (stid, start_ts, end_ts)'
+# Longest that any one record is expected to last: range lookups on start_ts
+# reach back this far for records which started before the range
+MAX_RECORD_SPAN = timedelta(days=1)
+
+# The database's tables (see connect_db() for what their fields hold). Every
+# statement is IF NOT EXISTS, so DB_SCHEMA can be run on an up to date 
+# database without changing anything
+EXPS_TABLE = """CREATE TABLE IF NOT EXISTS exps (
+    stid integer NOT NULL,
+    start_iso text NOT NULL,
+    end_iso text NOT NULL,
+    cmd_name text,
+    cmd_args text,
+    cpid integer,
+    min_nave integer,
+    times_consistent BOOLEAN,
+    not_corrupt BOOLEAN,
+    min_tfreq integer,
+    max_tfreq integer,
+    xcf integer,
+    start_ts integer,
+    end_ts integer,
+    PRIMARY KEY (stid, start_iso)
+    )"""
+MANIFEST_TABLE = """CREATE TABLE IF NOT EXISTS manifest (
+    fname text NOT NULL PRIMARY KEY,
+    size integer,
+    mtime real,
+    content_hash text,
+    status text,
+    detail text,
+    updated_iso text
+    )"""
+JOBS_TABLE = """CREATE TABLE IF NOT EXISTS jobs (
+    day text NOT NULL,
+    station text NOT NULL,
+    status text,
+    files integer,
+    bytes integer,
+    started_iso text,
+    updated_iso text,
+    PRIMARY KEY (day, station)
+    )"""
+DB_SCHEMA = ";\n".join([EXPS_TABLE, MANIFEST_TABLE, JOBS_TABLE, EXPS_TS_INDEX]) + ";"
+
+# Version of DB_SCHEMA, kept in each database's 'PRAGMA user_version'. Databases
+# made before it was kept are version 0. Whenever DB_SCHEMA changes, this goes
+# up by one and migrate.py gets a step bringing older databases up to it
+SCHEMA_VERSION = 3
+
+# Row layout of a RecordBatch (times are microseconds since the epoch)
+RECORD_DTYPE = np.dtype([('stid', np.int32), ('start_us', np.int64), 
+    ('end_us', np.int64), ('cmd_name', object), ('cmd_args', object),
+    ('cpid', np.int32), ('min_nave', np.int32), ('times_consistent', bool),
+    ('not_corrupt', bool), ('min_tfreq', np.int32), ('max_tfreq', np.int32),
+    ('xcf', np.int32)])
+RECORD_FIELDS = RECORD_DTYPE.names
+# What a RecordBatch stores in place of NULLs (RawacfRecord's defaults)
+RECORD_DEFAULTS = {'cmd_name': "", 'cmd_args': "", 'cpid': 0, 'min_nave': 0,
+                   'times_consistent': True, 'not_corrupt': True, 
+                   'min_tfreq': 0, 'max_tfreq': 0, 'xcf': 0}
+
+# Fields which should hold the same value throughout a .rawacf file
+CONSTANT_FIELDS = ['cp', 'origin.command', 'stid', 'xcf']
+# All the fields that check_fields() looks at
+CHECK_FIELDS = CONSTANT_FIELDS + ['txpl', 'rsep', 'bmnum']
+
 class InconsistentRawacfError(Exception):
     """
     Raised when data from a rawacf file is inconsistent or incorrectly
@@ -54,6 +177,12 @@ class BadRawacfError(backscatter.dmap.DmapDataError):
     one entry.
     """
 
+class DatabaseSchemaError(Exception):
+    """
+    Raised when a database isn't laid out as DB_SCHEMA says (e.g. because it
+    was made by an older version of these scripts and needs migrating).
+    """
+
 class RawacfRecord(object):
     """
     Class for containing a SuperDARN experiment record. Acquired by 
@@ -62,8 +191,9 @@ class RawacfRecord(object):
 
     *** FIELDS ***
         - stid (station ID) : number corresponding to which array it is
-        - start_dt: time of the start of the .rawacf entry (datetime obj)
-        - end_dt : time of the end of the .rawacf entry (datetime obj)
+        - start_us: time of the start of the .rawacf entry (int microseconds
+                    since the epoch; 'start_dt' gives it as a datetime obj)
+        - end_us : time of the end of the .rawacf entry (likewise 'end_dt')
         - cpid : Control program ID number
         - cmd_name : program name that was called to create this .rawacf 
                 file (note: CPIDs and cmd_names should match eachother)
@@ -92,7 +222,15 @@ class RawacfRecord(object):
                 tuple of relevant information (likely originating from database)
         - [Class method]: record_from_dics(): build a RawacfRecord from a 
                 list of dict (dmap records) originating from a .rawacf file
+
+    Instances use __slots__ rather than a __dict__ and keep their times as
+    plain ints, since hundreds of thousands of these get made when loading
+    a year of records. For bulk work see RecordBatch.
     """
+    __slots__ = ('stid', 'start_us', 'end_us', 'cpid', 'cmd_name', 'cmd_args',
+                 'min_nave', 'times_consistent', 'not_corrupt', 'min_tfreq',
+                 'max_tfreq', 'xcf')
+
     def __init__(self, stid, start_dt, end_dt, cmd_name="", cmd_args="", cpid=0,
                  min_nave=0, times_consistent=True, not_corrupt=True,
                  min_tfreq=0., max_tfreq=0., xcf=0.):
@@ -112,6 +250,28 @@ class RawacfRecord(object):
         self.max_tfreq = max_tfreq
         self.xcf = xcf
 
+    @property
+    def start_dt(self):
+        """
+        Start time of the record as a datetime object.
+        """
+        return us_to_dt(self.start_us)
+
+    @start_dt.setter
+    def start_dt(self, start_dt):
+        self.start_us = dt_to_us(start_dt)
+
+    @property
+    def end_dt(self):
+        """
+        End time of the record as a datetime object.
+        """
+        return us_to_dt(self.end_us)
+
+    @end_dt.setter
+    def end_dt(self, end_dt):
+        self.end_us = dt_to_us(end_dt)
+
     def __repr__(self):
         """
         How to spit out this object's internals.
@@ -131,9 +291,7 @@ class RawacfRecord(object):
         
         :returns: total difference in seconds of end time minus start time
         """
-        # datetimes can be subtracted to get intervals
-        diff = self.end_dt - self.start_dt
-        return diff.total_seconds()
+        return (self.end_us - self.start_us)/float(US_IN_SEC)
 
     def save_to_db(self, cur):
         """
@@ -141,22 +299,39 @@ class RawacfRecord(object):
         fields to the database
 
         :param cur: Cursor to an sqlite3 database to save to.
+
+        :returns: True if saved, False if the record was already in the 
+                    database
+
+        :raises: sqlite3.OperationalError if the database stayed locked (see
+                    execute_retrying())
         """
-        start_time = (self.start_dt).isoformat()
-        end_time = (self.end_dt).isoformat()
         try:
-            cur.execute('''INSERT INTO exps (stid, start_iso, end_iso, 
+            execute_retrying(cur, '''INSERT INTO exps (stid, start_iso, end_iso, 
             cmd_name, cmd_args, cpid, min_nave, times_consistent, not_corrupt,
-            min_tfreq, max_tfreq, xcf) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            (self.stid, start_time, end_time, 
-            self.cmd_name, self.cmd_args, self.cpid,
-            int(self.min_nave), int(self.times_consistent), 
-            int(self.not_corrupt), self.min_tfreq, self.max_tfreq, self.xcf))
+            min_tfreq, max_tfreq, xcf, start_ts, end_ts) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', self.to_db_row())
         except sqlite3.IntegrityError:
             logging.error("Unique constraint failed or something.")     
-        except sqlite3.OperationalError: 
-            logging.error("\t\tDatabase locked - can't save metadata!")
+            return False
+        return True
+
+    def to_row(self):
+        """
+        :returns: [tuple] of the record's fields in the column order of the
+                    exps table
+        """
+        return (self.stid, self.start_dt.isoformat(), self.end_dt.isoformat(), 
+                self.cmd_name, self.cmd_args, self.cpid, int(self.min_nave), 
+                int(self.times_consistent), int(self.not_corrupt), 
+                self.min_tfreq, self.max_tfreq, self.xcf)
+
+    def to_db_row(self):
+        """
+        :returns: [tuple] of to_row() followed by the start_ts and end_ts 
+                    columns (see EXPS_TS_COLUMNS)
+        """
+        return self.to_row() + (dt_to_ts(self.start_dt), dt_to_ts(self.end_dt, round_up=True))
 
     # Class method to read a tuple from the sqlite db and make a RawacfRecord
     @classmethod
@@ -192,7 +367,8 @@ class RawacfRecord(object):
         """
         Creates and returns a RawacfRecord object constructed from the 
         contents of a list of dictionaries that originates from parsing
-        a **RAWACF FILE***
+        a **RAWACF FILE***. The scalar fields are handled column-wise as
+        numpy arrays (see rawacf_columns()) rather than dict-by-dict.
 
         :param dmap_dicts: list of dicts from parsing a Rawacf into dmaps
         
@@ -205,7 +381,9 @@ class RawacfRecord(object):
             err_str = "DMAP record found with only one data point. "
             raise BadRawacfError(err_str)
 
-        objection_dict = check_fields(dmap_dicts)
+        # Pull every scalar field we need into its own numpy array, in one pass
+        cols = rawacf_columns(dmap_dicts)
+        objection_dict = check_columns(cols)
         cpid = dmap_dicts[0]['cp'] if 'cp' not in objection_dict else -1
         stid = dmap_dicts[0]['stid'] if 'stid' not in objection_dict else -1
         cmd  = dmap_dicts[0]['origin.command'] if 'origin.command' not in objection_dict else "" 
@@ -223,29 +401,24 @@ class RawacfRecord(object):
             logging.debug(err_str)
 
         # ** Grab tfreq **
-        tfreqs = [ d['tfreq'] for d in dmap_dicts ]
-        min_tfreq = min(tfreqs)
-        max_tfreq = max(tfreqs)
+        min_tfreq = cols['tfreq'].min().item()
+        max_tfreq = cols['tfreq'].max().item()
 
         # ** Get the lowest n_ave value **
-        min_nave = min([ d['nave'] for d in dmap_dicts ])
+        min_nave = cols['nave'].min().item()
  
         # Parse the start/end temporal fields 
         try:
-            start_dt = reconstruct_datetime(dmap_dicts[0])
-            end_dt = reconstruct_datetime(dmap_dicts[-1])
-             
-            # Check for downtime during the experiment's run
-            ts = []
-            for d in dmap_dicts:
-                ts.append(reconstruct_datetime(d))
+            ts = rawacf_timestamps(cols)
         except ValueError:
             logging.error("Possible microsecond-related error.", exc_info=True)
             err_str = "Microseconds in start and end dts: {0}, {1}"
             logging.error(err_str.format(dmap_dicts[0]['time.us'], dmap_dicts[-1]['time.us']))
-        diffs = [(ts[i+1] - ts[i]).total_seconds() for i in range( len(ts) - 1 )]
+            raise
+        start_dt = us_to_dt(ts[0])
+        end_dt = us_to_dt(ts[-1])
         # Check that every difference between entries is 20 seconds or less
-        times_consistent = int(( np.array(diffs) < CONSISTENT_RAWACF_THRESH ).all())
+        times_consistent = int(( np.diff(ts) < CONSISTENT_RAWACF_THRESH*US_IN_SEC ).all())
 
         if 'not_corrupt' not in locals():
             not_corrupt = True
@@ -254,6 +427,166 @@ class RawacfRecord(object):
                     not_corrupt=not_corrupt, min_tfreq=min_tfreq, 
                     max_tfreq=max_tfreq, xcf=xcf)
 
+class RecordBatch(object):
+    """
+    Compact, columnar container for many experiment records, built on a 
+    numpy structured array with one row per record (see RECORD_DTYPE). 
+    Used by the bulk APIs (e.g. select_exps_batch()) so that loading a
+    year of records for every radar doesn't mean one Python object per row.
+
+    Times are int64 microseconds since the epoch. Indexing with an int 
+    gives a RecordView of that row (a RawacfRecord whose fields are read
+    from, and written to, the batch's array, so nothing is copied); 
+    indexing with a slice or boolean mask gives another RecordBatch sharing
+    the same rows. The bulk methods below work on whole columns, without
+    going through a view per row.
+
+    *** METHODS ***
+        - len(), iteration (yields RecordViews), indexing
+        - durations(): numpy array of each record's duration in seconds
+        - to_rows(): tuples in the same column order as the exps table
+        - to_db_rows(): the same, with the start_ts and end_ts columns added
+        - overlap_seconds(): how much of each record falls within a range
+        - [Class method]: from_records(): build from RawacfRecord objects
+        - [Class method]: from_rows(): build from exps table tuples
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        """
+        :param data: numpy structured array with dtype RECORD_DTYPE
+        """
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self.data)
+            if not 0 <= index < len(self.data):
+                raise IndexError("RecordBatch index out of range")
+            return RecordView(self.data, int(index))
+        return RecordBatch(self.data[index])
+
+    def __iter__(self):
+        for i in range(len(self.data)):
+            yield RecordView(self.data, i)
+
+    def __repr__(self):
+        return "RecordBatch of {0} records".format(len(self.data))
+
+    def durations(self):
+        """
+        :returns: numpy array of each record's duration in seconds
+        """
+        return (self.data['end_us'] - self.data['start_us'])/float(US_IN_SEC)
+
+    def to_rows(self):
+        """
+        :returns: list of tuples in the column order of the exps table (the
+                    same as each record's RawacfRecord.to_row())
+        """
+        return list(zip(*self._columns()))
+
+    def to_db_rows(self):
+        """
+        :returns: list of tuples as from to_rows(), followed by the start_ts
+                    and end_ts columns (see EXPS_TS_COLUMNS)
+        """
+        start_ts = self.data['start_us'] // US_IN_SEC
+        end_ts = -(-self.data['end_us'] // US_IN_SEC)
+        return list(zip(*(self._columns() + [start_ts.tolist(), end_ts.tolist()])))
+
+    def _columns(self):
+        """
+        :returns: [list] of the exps table's columns, as lists of python values
+        """
+        d = self.data
+        return [d['stid'].tolist(), us_to_iso_list(d['start_us']), us_to_iso_list(d['end_us']),
+                d['cmd_name'].tolist(), d['cmd_args'].tolist(), d['cpid'].tolist(),
+                d['min_nave'].tolist(), d['times_consistent'].astype(int).tolist(),
+                d['not_corrupt'].astype(int).tolist(), d['min_tfreq'].tolist(),
+                d['max_tfreq'].tolist(), d['xcf'].tolist()]
+
+    def overlap_seconds(self, start, end):
+        """
+        :param start: [datetime] start of a time range
+        :param end: [datetime] end of the range
+
+        :returns: numpy array of the seconds of each record within the range
+        """
+        lo, hi = dt_to_us(start), dt_to_us(end)
+        return (np.clip(self.data['end_us'], lo, hi) - 
+                np.clip(self.data['start_us'], lo, hi))/float(US_IN_SEC)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        :param records: iterable of RawacfRecord objects
+        :returns: RecordBatch holding the same information
+        """
+        records = list(records)
+        data = np.empty(len(records), dtype=RECORD_DTYPE)
+        for field in RECORD_FIELDS:
+            default = RECORD_DEFAULTS.get(field)
+            vals = [ getattr(r, field) for r in records ]
+            data[field] = [ default if v is None else v for v in vals ]
+        return cls(data)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds a RecordBatch from tuples fetched from the **SQLITE DB** (see 
+        RawacfRecord.record_from_tuple()). NULL fields take the same 
+        defaults as RawacfRecord's constructor.
+
+        :param rows: list of exps table tuples
+        :returns: RecordBatch holding the same information
+        """
+        data = np.empty(len(rows), dtype=RECORD_DTYPE)
+        if len(rows) == 0:
+            return cls(data)
+        cols = list(zip(*rows))
+        data['stid'] = cols[0]
+        # numpy parses the ISO strings directly to microseconds
+        data['start_us'] = np.array(cols[1], dtype='datetime64[us]').astype(np.int64)
+        data['end_us'] = np.array(cols[2], dtype='datetime64[us]').astype(np.int64)
+        for field, col in zip(RECORD_FIELDS[3:], cols[3:12]):
+            default = RECORD_DEFAULTS[field]
+            data[field] = [ default if v is None else v for v in col ]
+        return cls(data)
+
+class RecordView(RawacfRecord):
+    """
+    One row of a RecordBatch, standing in for a RawacfRecord: its fields 
+    are read from (and written to) the batch's array when they're used, 
+    rather than being copied out when it's made, so it holds nothing but a
+    reference to the array and its row number.
+    """
+    __slots__ = ('_data', '_row')
+
+    def __init__(self, data, row):
+        """
+        :param data: numpy structured array with dtype RECORD_DTYPE
+        :param row: [int] index of the record's row
+        """
+        self._data = data
+        self._row = row
+
+def _view_field(field):
+    """ :returns: property for a RecordView's field (see RECORD_FIELDS) """
+    def get(self):
+        value = self._data[field][self._row]
+        return value if RECORD_DTYPE[field] == object else value.item()
+    def set(self, value):
+        self._data[field][self._row] = value
+    return property(get, set)
+
+for _field in RECORD_FIELDS:
+    setattr(RecordView, _field, _view_field(_field))
+
 # -----------------------------------------------------------------------------
 #                               Utility Methods 
 # -----------------------------------------------------------------------------
@@ -280,6 +613,89 @@ def bz2_dic(fname):
     dics = backscatter.dmap.parse_dmap_format_from_stream(stream)
     return dics
 
+def iter_bz2_dics(fname, fields=None):
+    """
+    Streaming counterpart to bz2_dic(): decompresses the .rawacf.bz2 file 
+    in chunks and yields its dmap records one at a time, so that only about
+    one record is ever held in memory.
+
+    :param fname: path + filename of the rawacf.bz2 file
+    [:param fields:] [list of str] dmap fields to keep from each record 
+                    (e.g. RAWACF_SCALAR_FIELDS). Everything else, including 
+                    the big acfd/xcfd arrays, is dropped straight away.
+    
+    :returns: yields a dictionary per dmap record in the .rawacf file
+    """
+    import bz2
+    if not os.path.isfile(fname):
+        raise IOError('Not a file! {0}'.format(fname))
+    if fname[-4:] != '.bz2':
+        raise IOError('Not a .bz2 file! {0}'.format(fname))
+    with bz2.BZ2File(fname, 'rb') as f:
+        for dic in rawacf_io.iter_dmap_records(f):
+            if fields is not None:
+                dic = dict((k, dic[k]) for k in fields if k in dic)
+            yield dic
+
+def scan_rawacf(fname, fields=RAWACF_SCALAR_FIELDS, bz2_threads=1):
+    """
+    Metadata-only read of a .rawacf or .rawacf.bz2 file: only the dmap 
+    record headers and scalar blocks are decoded, the acfd/xcfd array 
+    blocks are skipped over without being built.
+
+    :param fname: path + filename of the .rawacf or .rawacf.bz2 file
+    [:param fields:] [list of str] scalar fields to keep from each record
+    [:param bz2_threads:] [int] if > 1, decompress a .bz2 file's blocks in
+                    parallel with this many threads (see bz2_dic_parallel)
+
+    :returns: list of small dictionaries (one per dmap record) holding only
+                the requested scalar fields. This can be handed straight
+                to RawacfRecord.record_from_dics().
+    """
+    import bz2
+    if not os.path.isfile(fname):
+        raise IOError('Not a file! {0}'.format(fname))
+    if fname[-4:] == '.bz2':
+        if bz2_threads > 1:
+            try:
+                chunks = rawacf_io.iter_bz2_parallel(fname, workers=bz2_threads)
+                stream = rawacf_io.ChunkReader(chunks)
+                return list(rawacf_io.iter_dmap_scalars(stream, fields=fields))
+            except rawacf_io.Bz2BlockError as e:
+                logging.warning("Falling back to serial bz2 read of {0}: {1}".format(fname, e))
+        with bz2.BZ2File(fname, 'rb') as f:
+            return list(rawacf_io.iter_dmap_scalars(f, fields=fields))
+    elif fname[-7:] == '.rawacf':
+        dics = rawacf_io.iter_mmap_records(fname, scalars_only=True)
+        return [ dict((k, d[k]) for k in fields if k in d) for d in dics ]
+    else:
+        raise IOError('Not a .rawacf or .bz2 file! {0}'.format(fname))
+
+def bz2_dic_parallel(fname, workers=None):
+    """ 
+    Same as bz2_dic(), but the bz2 blocks of the file are decompressed 
+    in parallel across a pool of threads. The reassembled stream is then
+    handed to the backscatter library exactly as bz2_dic() does.
+
+    :param fname: path + filename of the rawacf.bz2 file
+    [:param workers:] [int] number of decompression threads
+
+    :returns: list of dictionaries from backscatter lib's parsing of
+                the .rawacf file
+    """
+    import bz2
+    if not os.path.isfile(fname):
+        raise IOError('Not a file! {0}'.format(fname))
+    if fname[-4:] != '.bz2':
+        raise IOError('Not a .bz2 file! {0}'.format(fname))
+    try:
+        stream = b''.join(rawacf_io.iter_bz2_parallel(fname, workers=workers))
+    except rawacf_io.Bz2BlockError as e:
+        logging.warning("Falling back to serial bz2 read of {0}: {1}".format(fname, e))
+        stream = bz2.BZ2File(fname, 'rb').read()
+    dics = backscatter.dmap.parse_dmap_format_from_stream(stream)
+    return dics
+
 def acf_dic(fname):
     """ 
     Takes a .rawacf file and uses the backscatter library to retrieve 
@@ -299,6 +715,23 @@ def acf_dic(fname):
     dics = backscatter.dmap.parse_dmap_format_from_stream(stream)
     return dics
 
+def mmap_acf_dic(fname):
+    """
+    Memory-mapped alternative to acf_dic() for uncompressed .rawacf files.
+    Records are parsed straight out of the mapped file and their arrays
+    are zero-copy views onto it, so the data lives in the (shared) OS page 
+    cache instead of being read into this process's heap.
+
+    :param fname: path + filename of the .rawacf file
+
+    :returns: list of dictionaries, one per dmap record in the .rawacf file
+    """
+    if not os.path.isfile(fname):
+        raise IOError('Not a file!')
+    if fname[-7:] != '.rawacf':
+        raise IOError('Not a .rawacf file!')
+    return list(rawacf_io.iter_mmap_records(fname))
+
 def globus_connect():
     """
     Function for encapsulating the process of connecting to Globus.
@@ -358,6 +791,27 @@ def globus_query(script_query):
     except OSError:
         logging.error("\t\tFailed to call Globus script")
 
+def staging_dir(year, month, day):
+    """
+    Gives (and creates) a day's own staging folder inside the endpoint, so 
+    that several days' files can be on hand at once without mixing.
+
+    :returns: [str] path to ENDPOINT/YYYYMMDD
+    """
+    if 'ENDPOINT' not in globals():
+        read_config()
+    folder = os.path.join(ENDPOINT, "{0}{1:02d}{2:02d}".format(year, month, day))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return folder
+
+def clear_staging_dir(folder):
+    """
+    Removes a staging folder made by staging_dir() and everything in it.
+    """
+    import shutil
+    shutil.rmtree(folder, ignore_errors=True)
+
 def read_config(cfg_file='config.ini'):
     """
     Reads the local config file which provides definitions for a few global
@@ -395,6 +849,118 @@ def read_config(cfg_file='config.ini'):
     GLOBUS_STARTUP_LOC = config.get('Paths','GLOBUS_STARTUP_LOC')
     SYNC_SCRIPT_LOC = config.get('Paths','SYNC_SCRIPT_LOC')
 
+def rawacf_columns(dmap_dicts, fields=RAWACF_SCALAR_FIELDS):
+    """
+    Columnar view of a list of dmap dictionaries: makes a single pass over
+    the list and pulls each requested scalar field out into a numpy array.
+
+    :param dmap_dicts: the list of dicts from parsing a .rawacf file
+    [:param fields:] [list of str] the scalar fields to extract
+
+    :returns: [dict] mapping each field name to a numpy array with one 
+                entry per dmap record ('origin.command' is an object array)
+    """
+    from operator import itemgetter
+    getter = itemgetter(*fields)
+    rows = [ getter(d) for d in dmap_dicts ]
+    cols = dict()
+    for field, col in zip(fields, zip(*rows)):
+        if field == 'origin.command':
+            cols[field] = np.array(col, dtype=object)
+        elif field == 'time.us':
+            # Non-integer microseconds are treated as spurious, just as
+            # reconstruct_datetime() does, by flagging them as out of range
+            cols[field] = np.array([ v if type(v) == int else -1 for v in col ], 
+                                   dtype=np.int64)
+        else:
+            cols[field] = np.array(col)
+    return cols
+
+def rawacf_timestamps(cols):
+    """
+    Vectorized counterpart of reconstruct_datetime(): turns the time.* 
+    columns from rawacf_columns() into int64 microseconds since the epoch.
+
+    :param cols: [dict] of numpy arrays from rawacf_columns()
+
+    :returns: numpy int64 array of timestamps in microseconds since 1970
+    """
+    yr, mo, dy, hr, mt, sc, us = [ cols[f].astype(np.int64) for f in 
+        ['time.yr', 'time.mo', 'time.dy', 'time.hr', 'time.mt', 'time.sc', 'time.us'] ]
+    # There are a couple spurious cases of 0 or negative microseconds that 
+    # mess things up, so here I catch them and set them to 1us
+    bad_us = (us < 0) | (us > 999999)
+    if bad_us.any():
+        err_str = "Microseconds value is : {0} ({1} records)".format(
+                  cols['time.us'][bad_us][0], bad_us.sum())
+        err_str += "\t Setting it to 1 us before proceeding..."
+        logging.warning(err_str)
+        us = np.where(bad_us, 1, us)
+    valid_ym = (yr >= 1) & (yr <= 9999) & (mo >= 1) & (mo <= 12)
+    if not valid_ym.all():
+        raise ValueError("Year/month out of range in {0}-{1}".format(
+                         yr[~valid_ym][0], mo[~valid_ym][0]))
+    months = ((yr - 1970)*12 + (mo - 1)).astype('datetime64[M]')
+    month_start = months.astype('datetime64[D]')
+    month_len = ((months + 1).astype('datetime64[D]') - month_start).astype(np.int64)
+    valid = (dy >= 1) & (dy <= month_len) & (hr >= 0) & (hr < 24) & \
+            (mt >= 0) & (mt < 60) & (sc >= 0) & (sc < 60)
+    if not valid.all():
+        i = np.argmin(valid)
+        raise ValueError("Invalid date/time {0}-{1}-{2} {3}:{4}:{5}".format(
+                         yr[i], mo[i], dy[i], hr[i], mt[i], sc[i]))
+    days = month_start.astype(np.int64) + (dy - 1)
+    return (((days*24 + hr)*60 + mt)*60 + sc)*US_IN_SEC + us
+
+def us_to_dt(us):
+    """
+    Converts microseconds since the epoch into a (naive) datetime object
+
+    :param us: [int] microseconds since 1970-01-01T00:00:00
+
+    :returns: a [Datetime] object
+    """
+    return EPOCH + timedelta(microseconds=int(us))
+
+def us_to_iso_list(us):
+    """
+    Converts an array of microseconds since the epoch into ISO strings, 
+    formatted as datetime.isoformat() would (with no fraction when the 
+    microseconds are 0), since these are the exps table's keys.
+
+    :param us: numpy array of [int] microseconds since 1970-01-01T00:00:00
+
+    :returns: [list of str]
+    """
+    isos = np.datetime_as_string(np.asarray(us).astype('datetime64[us]')).tolist()
+    return [iso[:-7] if iso.endswith('.000000') else iso for iso in isos]
+
+def dt_to_us(dt_obj):
+    """
+    Converts a (naive) datetime object into microseconds since the epoch
+
+    :param dt_obj: a [Datetime] object
+
+    :returns: [int] microseconds since 1970-01-01T00:00:00
+    """
+    delta = dt_obj - EPOCH
+    return (delta.days*86400 + delta.seconds)*US_IN_SEC + delta.microseconds
+
+def dt_to_ts(dt_obj, round_up=False):
+    """
+    Converts a (naive) datetime object into whole seconds since the epoch, as
+    kept in the exps table's start_ts/end_ts columns
+
+    :param dt_obj: a [Datetime] object
+    [:param round_up:] [boolean] round up rather than down to the second
+
+    :returns: [int] seconds since 1970-01-01T00:00:00
+    """
+    us = dt_to_us(dt_obj)
+    if round_up:
+        return -(-us // US_IN_SEC)
+    return us // US_IN_SEC
+
 def reconstruct_datetime(dic):
     """
     Takes a dictionary of a dmap and constructs a datetime object from 
@@ -418,38 +984,57 @@ def reconstruct_datetime(dic):
 def check_fields(dmap_dicts):
     """
     Takes a list of dictionaries representing the dmap object for a 
-    rawacf file as well as a particular field, and extracts the field 
-    and checks that the field has the same value for each dictionary in
-    the list. If not, raises an exception indicating likely corrupted record
+    rawacf file and checks it for signs of corruption: fields which should
+    be constant throughout the file, the relation between 'rsep' and 
+    'txpl', and the range of 'bmnum'. See check_columns().
 
     :param dics: the list of dicts from backscatter lib's parse of a .rawacf
     
-    :returns: [abstract] the value that's been requested if it's consistent    
+    :returns: [dict] of objections, keyed on the offending field
+    """
+    return check_columns(rawacf_columns(dmap_dicts, fields=CHECK_FIELDS))
+
+def check_columns(cols):
+    """
+    Runs each of check_fields()'s validation rules as a single array 
+    comparison over the columns from rawacf_columns(), reporting the first
+    offending record for each rule that fails.
+
+    :param cols: [dict] of numpy arrays, including all of CHECK_FIELDS
+    
+    :returns: [dict] of objections, keyed on the offending field
     """
     objection_dict = dict()
-    for i, dmap_dict in enumerate(dmap_dicts):
-        # Check if some fields are consistent throughout
-        for field in ['cp', 'origin.command', 'stid', 'xcf']: 
-            val = dmap_dict[field]
-            first_val = dmap_dicts[0][field]
-            if first_val != val:
-                # Current value of field is different from first value
-                dbg_str = "\t\tcheck_field() was seeing record of {0} for ".format(first_val)
-                dbg_str += "'{0}' but now sees {1} at index {2} of {3}".format(field, val, i, len(dmap_dicts))
-                objection_dict[field] = dbg_str
-                #raise InconsistentRawacfError(dbg_str)
-        # Check if rsep corresponds to txpl
-        txpl = dmap_dict['txpl']
-        rsep = dmap_dict['rsep']
-        if (txpl*3/20) != rsep:
-            dbg_str = "Fields 'rsep' and 'txpl' are inconsistent with each other."
-            dbg_str += "\trsep: {0}, txpl: {1}".format(rsep, txpl)
-            objection_dict['rsep'] = objection_dict['txpl'] = dbg_str
-        # Check if bmnum is valid ?
-        range_max = 16 if dmap_dict['stid'] in radars16.values() else 24
-        if dmap_dict['bmnum'] not in range(range_max):
-            dbg_str = "Saw unexpected value of 'bmnum'"
-            objection_dict['bmnum'] = dbg_str
+    num_recs = len(cols['stid'])
+    # Check if some fields are consistent throughout
+    for field in CONSTANT_FIELDS:
+        col = cols[field]
+        bad = col != col[0]
+        if bad.any():
+            # Current value of field is different from first value
+            i = int(np.argmax(bad))
+            dbg_str = "\t\tcheck_field() was seeing record of {0} for ".format(col[0])
+            dbg_str += "'{0}' but now sees {1} at index {2} of {3}".format(field, col[i], i, num_recs)
+            objection_dict[field] = dbg_str
+    # Check if rsep corresponds to txpl
+    txpl = cols['txpl']
+    rsep = cols['rsep']
+    bad = (txpl*3/20) != rsep
+    if bad.any():
+        i = int(np.argmax(bad))
+        dbg_str = "Fields 'rsep' and 'txpl' are inconsistent with each other."
+        dbg_str += "\trsep: {0}, txpl: {1} at index {2}".format(rsep[i], txpl[i], i)
+        objection_dict['rsep'] = objection_dict['txpl'] = dbg_str
+    # Check if bmnum is valid, looking up each distinct stid's beam count once
+    stids, inverse = np.unique(cols['stid'], return_inverse=True)
+    beams = np.array([ STID_NUM_BEAMS.get(stid, DEFAULT_NUM_BEAMS) for stid in stids.tolist() ])
+    range_max = beams[inverse.ravel()]
+    bmnum = cols['bmnum']
+    bad = (bmnum < 0) | (bmnum >= range_max) | (bmnum != np.trunc(bmnum))
+    if bad.any():
+        i = int(np.argmax(bad))
+        dbg_str = "Saw unexpected value of 'bmnum': {0} at index {1}".format(bmnum[i], i)
+        objection_dict['bmnum'] = dbg_str
     return objection_dict
 
 def has_positive_nave(dics):
@@ -574,6 +1159,103 @@ def get_stid(st_code):
 # -----------------------------------------------------------------------------
 #                              DB Methods 
 # -----------------------------------------------------------------------------
+def open_db(dbname="superdarntimes.sqlite", readonly=False):
+    """
+    Opens a connection to a database with the settings that every connection
+    should have (see the DB_* constants), but without touching its tables.
+
+    A writable connection puts the database in WAL mode (which sticks to the
+    file), so that readers don't block the writer and the writer doesn't 
+    block readers, and only syncs at checkpoints (synchronous=NORMAL: a 
+    power cut can lose the last few commits but never corrupts the file).
+    Any connection waits up to DB_BUSY_TIMEOUT for another's lock rather 
+    than failing straight away.
+
+    :param dbname: [str] path to the database file (or ':memory:')
+    [:param readonly:] [boolean] open it read-only (it must already exist)
+
+    :returns: [sqlite3 connection]
+    """
+    if readonly:
+        from urllib.request import pathname2url
+        conn = sqlite3.connect('file:{0}?mode=ro'.format(pathname2url(os.path.abspath(dbname))),
+                               uri=True, timeout=DB_BUSY_TIMEOUT)
+    else:
+        conn = sqlite3.connect(dbname, timeout=DB_BUSY_TIMEOUT)
+    cur = conn.cursor()
+    if not readonly and dbname != ':memory:':
+        cur.execute('PRAGMA journal_mode = WAL')
+    cur.execute('PRAGMA synchronous = NORMAL')
+    cur.execute('PRAGMA busy_timeout = {0}'.format(int(DB_BUSY_TIMEOUT * 1000)))
+    # (a negative cache_size is in KiB rather than pages)
+    cur.execute('PRAGMA cache_size = {0}'.format(-(DB_CACHE_SIZE >> 10)))
+    cur.execute('PRAGMA mmap_size = {0}'.format(DB_MMAP_SIZE))
+    if readonly:
+        cur.execute('PRAGMA query_only = 1')
+    return conn
+
+def connect_db_readonly(dbname="superdarntimes.sqlite"):
+    """
+    Connects to an existing database just for reading from it (e.g. for 
+    computing statistics), which can be done while a parse run is writing
+    to it.
+
+    A database which is only missing things that reading doesn't need (e.g.
+    the manifest or jobs table) can still be read, but one without the 
+    start_ts/end_ts columns can't be (select_overlapping() looks records up
+    by them).
+
+    :param dbname: [str] path to the database file
+
+    :returns: [sqlite3 connection]
+
+    :raises: DatabaseSchemaError if its exps table is missing, or is missing
+                the start_ts/end_ts columns
+    """
+    conn = open_db(dbname, readonly=True)
+    cur = conn.cursor()
+    if not check_db(cur):
+        tables = schema_layout(cur)[0]
+        if 'exps' not in tables or any(col not in tables['exps'] for col in EXPS_TS_COLUMNS):
+            conn.close()
+            raise DatabaseSchemaError("Database {0} can't be read without its start_ts/end_ts "
+                                      "columns. If it was made by an older version of these "
+                                      "scripts, run 'migrate.py {0}'".format(dbname))
+        logging.error("Database {0} incorrectly configured. If it was made by an older "
+                      "version of these scripts, run 'migrate.py {0}'".format(dbname))
+    return conn
+
+def is_locked_error(e):
+    """ :returns: [boolean] whether an sqlite3.OperationalError was a lock """
+    msg = str(e).lower()
+    return 'locked' in msg or 'busy' in msg
+
+def execute_retrying(cur, sql, params=(), many=False, retries=DB_LOCK_RETRIES):
+    """
+    Runs a write, retrying with exponential backoff if the database is still
+    locked after the busy timeout. 
+
+    :param cur: cursor to the sqlite3 database
+    :param sql: [str] the statement
+    [:param params:] parameters for it (or a list of them, with 'many')
+    [:param many:] [boolean] use executemany() rather than execute()
+    [:param retries:] [int] times to try again
+
+    :raises: sqlite3.OperationalError if it's still locked after that (so 
+                that nothing is ever dropped silently)
+    """
+    for attempt in range(retries + 1):
+        try:
+            if many:
+                return cur.executemany(sql, params)
+            return cur.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            if not is_locked_error(e) or attempt == retries:
+                raise
+            delay = DB_LOCK_BACKOFF * 2**attempt
+            logging.warning("\t\tDatabase locked, trying again in {0:.1f} s...".format(delay))
+            time.sleep(delay)
+
 def connect_db(dbname="superdarntimes.sqlite"):
     """
     Connects to a database for storing experiment metadata parsed from 
@@ -598,75 +1280,319 @@ def connect_db(dbname="superdarntimes.sqlite"):
     - min_tfreq:
     - max_tfreq:
     - xcf:
-
+    - start_ts : start_iso as whole seconds since the epoch (rounded down)
+    - end_ts : end_iso as whole seconds since the epoch (rounded up)
+    They're indexed by (stid, start_ts, end_ts), for select_overlapping().
+
+    Entries in the Manifest Table record the outcome of ingesting each 
+    rawacf file, so that re-runs can skip files that are already done:
+    - fname : name of the rawacf file (no path)
+    - size : size of the file in bytes
+    - mtime : modification time of the file (seconds since the epoch)
+    - content_hash : sha1 of the file's contents (only if requested)
+    - status : one of the MANIFEST_* outcomes
+    - detail : e.g. the exception raised while parsing the file
+    - updated_iso : when this entry was last written (isoformat)
+
+    Entries in the Jobs Table record the progress of fetch-and-parse runs,
+    one per (day, station) shard, so that a run can pick up where it stopped:
+    - day : the day (YYYY-MM-DD)
+    - station : the station code, or ALL_STATIONS for the whole day
+    - status : one of the JOB_* statuses
+    - files : number of rawacf files found for the shard
+    - bytes : total size of those files
+    - started_iso : when the shard was started (isoformat)
+    - updated_iso : when its status last changed (isoformat)
+
+
+    The tables are made from DB_SCHEMA, and the database's schema version 
+    (SCHEMA_VERSION) is kept in its 'PRAGMA user_version'. A database made by
+    an older version of these scripts isn't written to until it's been 
+    brought up to date with migrate.py: connecting to it raises a 
+    DatabaseSchemaError saying what's wrong with it.
 
     *** not_corrupt and times_consistent are currently stored as integers
     expected to only take on values of "1" or "0" ***
     """
     
-    conn = sqlite3.connect(dbname)
+    conn = open_db(dbname)
     cur = conn.cursor()
-    cur.executescript("""
-    CREATE TABLE IF NOT EXISTS exps (
-    stid integer NOT NULL,
-    start_iso text NOT NULL,
-    end_iso text NOT NULL,
-    cmd_name text,
-    cmd_args text,
-    cpid integer,
-    min_nave integer,
-    times_consistent BOOLEAN,
-    not_corrupt BOOLEAN,
-    min_tfreq integer,
-    max_tfreq integer,
-    xcf integer,
-    PRIMARY KEY (stid, start_iso)
-    );
-    """) 
-    db_correct = check_db(cur)
-    if not db_correct:
-        logging.error("Database incorrectly configured.")
+    if not has_table(cur, 'exps'):
+        # A new database
+        cur.executescript(DB_SCHEMA)
+        set_db_version(cur, SCHEMA_VERSION)
+    elif db_version(cur) == SCHEMA_VERSION:
+        cur.executescript(DB_SCHEMA)
+    problems = schema_problems(cur)
+    if len(problems) > 0:
+        conn.close()
+        raise DatabaseSchemaError("Database {0} incorrectly configured ({1}). If it was made "
+                                  "by an older version of these scripts, run 'migrate.py {0}'"
+                                  .format(dbname, "; ".join(problems)))
     return conn
 
 def check_db(cur):
     """
-    Given a cursor to a DB, checks that it has the right structuring.
-    """
-    # And if it *did* exist, make sure it has all the necessary fields:
-    cur.execute('PRAGMA table_info (exps)')
-    flds = ['stid', 'start_iso', 'end_iso', 'cmd_name', 'cmd_args', 'cpid', 
-            'min_nave', 'times_consistent', 'not_corrupt', 'min_tfreq',
-            'max_tfreq', 'xcf']
-    tbl_flds = [ en[1] for en in cur.fetchall() ]
-    db_correct = True
-    for f in flds:
-        if f not in tbl_flds:
-            db_correct = False
-    return db_correct
+    Given a cursor to a DB, checks that it has the right structuring, logging
+    anything that's wrong with it (see schema_problems()).
+
+    :returns: [boolean] whether the DB is up to date
+    """
+    problems = schema_problems(cur)
+    for problem in problems:
+        logging.error("\t{0}".format(problem))
+    return len(problems) == 0
+
+def schema_problems(cur):
+    """
+    Compares a DB with DB_SCHEMA: its version, and the tables, columns and
+    indexes it should have.
+
+    :param cur: cursor to the sqlite3 database
+
+    :returns: [list of str] what's wrong with it (empty if nothing)
+    """
+    problems = []
+    version = db_version(cur)
+    if version < SCHEMA_VERSION:
+        problems.append("Schema version {0} is older than the current version {1}".format(
+                        version, SCHEMA_VERSION))
+    elif version > SCHEMA_VERSION:
+        problems.append("Schema version {0} is newer than these scripts (version {1})".format(
+                        version, SCHEMA_VERSION))
+    tables, indexes = schema_layout(cur)
+    want_tables, want_indexes = expected_layout()
+    for table, columns in sorted(want_tables.items()):
+        if table not in tables:
+            problems.append("Table '{0}' is missing".format(table))
+            continue
+        missing = [col for col in columns if col not in tables[table]]
+        if len(missing) > 0:
+            problems.append("Table '{0}' is missing column(s) {1}".format(
+                            table, ", ".join(missing)))
+    for index in sorted(want_indexes - indexes):
+        problems.append("Index '{0}' is missing".format(index))
+    return problems
+
+def schema_layout(cur):
+    """
+    :param cur: cursor to the sqlite3 database
+
+    :returns: [tuple] of ({table name: [list of its column names]}, 
+                {set of index names}), leaving out SQLite's own
+    """
+    cur.execute("SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'")
+    entries = cur.fetchall()
+    tables = dict()
+    for kind, name in entries:
+        if kind == 'table':
+            cur.execute('PRAGMA table_info ({0})'.format(name))
+            tables[name] = [row[1] for row in cur.fetchall()]
+    return tables, set(name for kind, name in entries if kind == 'index')
+
+def expected_layout():
+    """ :returns: [tuple] schema_layout() of a database made with DB_SCHEMA """
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(DB_SCHEMA)
+    layout = schema_layout(conn.cursor())
+    conn.close()
+    return layout
+
+def has_table(cur, table):
+    """ :returns: [boolean] whether the DB has the table """
+    cur.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?",
+                (table,))
+    return cur.fetchone()[0] > 0
+
+def db_version(cur):
+    """ :returns: [int] the DB's schema version (0 if it was never set) """
+    cur.execute('PRAGMA user_version')
+    return cur.fetchone()[0]
+
+def set_db_version(cur, version):
+    """ Records the DB's schema version (see SCHEMA_VERSION). """
+    cur.execute('PRAGMA user_version = {0:d}'.format(version))
     
+def file_hash(fname):
+    """
+    Computes the sha1 hash of a file's contents, reading it in chunks.
+
+    :param fname: path + filename of the file
+
+    :returns: [str] hex digest of the file's sha1 hash
+    """
+    import hashlib
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def manifest_done(cur, folder, fnames, use_hash=False, stats=None):
+    """
+    Looks up files in the ingest manifest, without opening them, to find
+    those which were already ingested with a final outcome.
+
+    A file counts as done if its name and size match a manifest entry with
+    a status in MANIFEST_FINAL and either its mtime matches too or 
+    (with use_hash) its contents hash to the recorded content_hash. Entries
+    are keyed by the file's name alone, so a file is recognized wherever it
+    has been put (a staging folder, or somewhere in an archive tree).
+
+    :param cur: cursor to the sqlite3 database
+    :param folder: [str] folder holding the files
+    :param fnames: [list of str] names (or paths relative to folder) of files
+    [:param use_hash:] [boolean] fall back on content hashes for files whose
+                    mtime has changed (e.g. re-fetched copies)
+    [:param stats:] [dict] of fname -> (size, mtime) for files which have
+                    already been stat'ed (e.g. by a RawacfIndex)
+
+    :returns: [set] of the names in 'fnames' that can be skipped
+    """
+    entries = dict()
+    fnames = list(fnames)
+    keys = [os.path.basename(fname) for fname in fnames]
+    # Stay well under sqlite's limit on the number of bound parameters
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i+500]
+        cur.execute('SELECT fname, size, mtime, content_hash, status FROM manifest '
+                    'WHERE fname IN ({0})'.format(','.join('?'*len(chunk))), chunk)
+        for row in cur.fetchall():
+            entries[row[0]] = row[1:]
+    done = set()
+    for fname, key in zip(fnames, keys):
+        if key not in entries:
+            continue
+        size, mtime, content_hash, status = entries[key]
+        if status not in MANIFEST_FINAL:
+            continue
+        if stats is not None and fname in stats:
+            st_size, st_mtime = stats[fname]
+        else:
+            st = os.stat(os.path.join(folder, fname))
+            st_size, st_mtime = st.st_size, st.st_mtime
+        if st_size != size:
+            continue
+        if mtime is not None and abs(st_mtime - mtime) < 1e-3:
+            done.add(fname)
+        elif use_hash and content_hash is not None:
+            if file_hash(os.path.join(folder, fname)) == content_hash:
+                done.add(fname)
+    return done
+
+def record_manifest(cur, folder, fname, status, detail="", use_hash=False):
+    """
+    Writes (or overwrites) the ingest manifest entry for a file. The caller
+    is responsible for committing.
+
+    :param cur: cursor to the sqlite3 database
+    :param folder: [str] folder holding the file
+    :param fname: [str] name of the file (or its path relative to folder)
+    :param status: [str] one of the MANIFEST_* outcomes
+    [:param detail:] [str] extra information, e.g. an exception message
+    [:param use_hash:] [boolean] also record a sha1 of the file's contents
+    """
+    path = os.path.join(folder, fname)
+    st = os.stat(path)
+    content_hash = file_hash(path) if use_hash else None
+    cur.execute('''INSERT OR REPLACE INTO manifest (fname, size, mtime, 
+        content_hash, status, detail, updated_iso) VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        (os.path.basename(fname), st.st_size, st.st_mtime, content_hash, status, detail, 
+         dt.now().isoformat()))
+
+def set_job_status(cur, day, station, status, files=None, size=None):
+    """
+    Sets the status of a (day, station) shard in the jobs table, adding the
+    shard if it isn't there yet. The caller is responsible for committing.
+
+    :param cur: cursor to the sqlite3 database
+    :param day: [date or str] the shard's day
+    :param station: [str] the shard's station code, or ALL_STATIONS
+    :param status: [str] one of the JOB_* statuses
+    [:param files:] [int] number of files found for the shard
+    [:param size:] [int] total size of those files in bytes
+    """
+    assert status in JOB_STATUSES
+    day, now = str(day), dt.now().isoformat()
+    cur.execute('INSERT OR IGNORE INTO jobs (day, station, status, files, bytes) '
+                'VALUES (?, ?, ?, 0, 0)', (day, station, JOB_PENDING))
+    # A shard's clock starts when it leaves 'pending'
+    if status != JOB_PENDING:
+        cur.execute('UPDATE jobs SET started_iso = ? WHERE day = ? AND station = ? '
+                    'AND started_iso IS NULL', (now, day, station))
+    cur.execute('UPDATE jobs SET status = ?, updated_iso = ?, files = COALESCE(?, files), '
+                'bytes = COALESCE(?, bytes) WHERE day = ? AND station = ?',
+                (status, now, files, size, day, station))
+
+def clear_jobs(cur, day):
+    """
+    Forgets a day's shards (e.g. to start it again from scratch). The caller
+    is responsible for committing.
+
+    :param cur: cursor to the sqlite3 database
+    :param day: [date or str] the day
+    """
+    cur.execute('DELETE FROM jobs WHERE day = ?', (str(day),))
+
+def job_statuses(cur, start=None, end=None):
+    """
+    Looks up the shards in the jobs table.
+
+    :param cur: cursor to the sqlite3 database
+    [:param start:] [date or str] earliest day to include
+    [:param end:] [date or str] day to stop before
+
+    :returns: [dict] of (day (YYYY-MM-DD), station) -> status
+    """
+    cur.execute('SELECT day, station, status FROM jobs WHERE day >= ? AND day < ?',
+                (str(start or ''), str(end or '~')))
+    return dict(((day, station), status) for day, station, status in cur.fetchall())
+
+def job_summary(cur, start=None, end=None):
+    """
+    Sums up the progress recorded in the jobs table.
+
+    :param cur: cursor to the sqlite3 database
+    [:param start:] [date or str] earliest day to include
+    [:param end:] [date or str] day to stop before
+
+    :returns: [dict] with the number of days in each JOB_* status (under the
+                statuses' names), the 'station_days', 'files' and 'bytes' 
+                committed so far, the 'elapsed' seconds between the first 
+                shard starting and the last update, and the 'files_per_sec'
+                and 'bytes_per_sec' committed over that time
+    """
+    start, end = str(start or ''), str(end or '~')
+    summary = dict((status, 0) for status in JOB_STATUSES)
+    cur.execute('SELECT status, COUNT(*) FROM jobs WHERE day >= ? AND day < ? '
+                'AND station = ? GROUP BY status', (start, end, ALL_STATIONS))
+    summary.update(cur.fetchall())
+    cur.execute('SELECT COUNT(*), SUM(files), SUM(bytes) FROM jobs WHERE day >= ? '
+                'AND day < ? AND station != ? AND status = ?', 
+                (start, end, ALL_STATIONS, JOB_COMMITTED))
+    station_days, files, size = cur.fetchone()
+    cur.execute('SELECT MIN(started_iso), MAX(updated_iso) FROM jobs '
+                'WHERE day >= ? AND day < ?', (start, end))
+    first, last = cur.fetchone()
+    elapsed = 0.
+    if first is not None and last is not None:
+        elapsed = (dateutil.parser.parse(last) - dateutil.parser.parse(first)).total_seconds()
+    summary.update(station_days=station_days, files=files or 0, bytes=size or 0,
+                   elapsed=elapsed)
+    summary['files_per_sec'] = summary['files'] / elapsed if elapsed > 0 else 0.
+    summary['bytes_per_sec'] = summary['bytes'] / elapsed if elapsed > 0 else 0.
+    return summary
+
 def clear_db(cur):
     """
     Clears all experiment information in the sqlite3 database.
     """
     cur.executescript("""
     DROP TABLE IF EXISTS exps;
-
-    CREATE TABLE IF NOT EXISTS exps (
-    stid integer NOT NULL,
-    start_iso text NOT NULL,
-    end_iso text NOT NULL,
-    cmd_name text,
-    cmd_args text,
-    cpid integer,
-    min_nave integer,
-    times_consistent BOOLEAN,
-    not_corrupt BOOLEAN,
-    min_tfreq integer,
-    max_tfreq integer,
-    xcf integer,
-    PRIMARY KEY (stid, start_iso)
-    );
-    """) 
+    DROP TABLE IF EXISTS manifest;
+    DROP TABLE IF EXISTS jobs;
+    """ + DB_SCHEMA)
+    set_db_version(cur, SCHEMA_VERSION)
    
 def process_experiment(dics, conn):
     """
@@ -694,13 +1620,150 @@ def select_exps(sql_select, cur):
         records.append(RawacfRecord.record_from_tuple(entry))
     return records
 
+def select_overlapping(cur, stid, start, end):
+    """
+    Selects a station's experiments which overlap a time range, using the 
+    exps table's (stid, start_ts, end_ts) index: only records starting up to
+    MAX_RECORD_SPAN before the range are looked at.
+
+    :param cur: cursor to the sqlite3 database
+    :param stid: [int] station ID
+    :param start: [datetime] start of the range
+    :param end: [datetime] end of the range (exclusive)
+
+    :returns: [RecordBatch] of the records, in order of their start times
+    """
+    cur.execute('SELECT {0} FROM exps WHERE stid = ? AND start_ts >= ? AND start_ts < ? '
+                'AND end_ts > ? ORDER BY start_ts'.format(", ".join(EXPS_COLUMNS)),
+                (stid, dt_to_ts(start - MAX_RECORD_SPAN), dt_to_ts(end, round_up=True),
+                 dt_to_ts(start)))
+    return RecordBatch.from_rows(cur.fetchall())
+
+def select_exps_batch(sql_select, cur):
+    """
+    Bulk counterpart to select_exps(): takes an sql query to select certain
+    experiments and returns them all in a single RecordBatch.
+    """
+    logging.debug("Querying with the following string:\n{0}".format(sql_select))
+    cur.execute(sql_select)
+    return RecordBatch.from_rows(cur.fetchall())
+
 def dump_db(conn):
     """
     Shows all the entries in the DB
     """
     cur = conn.cursor()
     cur.execute('delete from exps')
+    cur.execute('delete from manifest')
+    cur.execute('delete from jobs')
+    conn.commit()
+
+def save_records(cur, records, on_conflict='ignore'):
+    """
+    Bulk counterpart to RawacfRecord.save_to_db(): saves many records with a
+    single executemany(), so that they all go in the same transaction. The
+    caller is responsible for committing.
+
+    Records whose (stid, start_iso) is already in the exps table (or earlier
+    in the same batch) are left alone with on_conflict='ignore', or 
+    overwritten with on_conflict='replace'.
+
+    :param cur: cursor to the sqlite3 database
+    :param records: [RecordBatch or list of RawacfRecord] records to save
+    [:param on_conflict:] [str] 'ignore' or 'replace'
+
+    :returns: [list] with an outcome per record, as for save_to_db(): True 
+                if it was new, False if its key was already there
+
+    :raises: sqlite3.OperationalError if the database stayed locked (see
+                execute_retrying())
+    """
+    assert on_conflict in ('ignore', 'replace')
+    if isinstance(records, RecordBatch):
+        rows = records.to_db_rows()
+    else:
+        rows = [rec.to_db_row() for rec in records]
+    if len(rows) == 0:
+        return []
+    # Look up which keys are already taken, a station at a time
+    by_stid = dict()
+    for row in rows:
+        by_stid.setdefault(row[0], []).append(row[1])
+    existing = set()
+    for stid, starts in by_stid.items():
+        for i in range(0, len(starts), 500):
+            chunk = starts[i:i+500]
+            cur.execute('SELECT stid, start_iso FROM exps WHERE stid = ? AND '
+                        'start_iso IN ({0})'.format(','.join('?'*len(chunk))),
+                        [stid] + chunk)
+            existing.update(cur.fetchall())
+    span = MAX_RECORD_SPAN.total_seconds()
+    for row in rows:
+        if row[-1] - row[-2] > span:
+            logging.warning("Record for station {0} from {1} to {2} is longer than "
+                            "MAX_RECORD_SPAN, so range lookups may miss it".format(*row[:3]))
+    outcomes = []
+    for row in rows:
+        key = (row[0], row[1])
+        outcomes.append(key not in existing)
+        existing.add(key)
+    cols = EXPS_COLUMNS + EXPS_TS_COLUMNS
+    execute_retrying(cur, 'INSERT OR {0} INTO exps ({1}) VALUES ({2})'.format(
+                     on_conflict.upper(), ", ".join(cols), ", ".join('?'*len(cols))),
+                     rows, many=True)
+    num_dups = outcomes.count(False)
+    if num_dups > 0:
+        logging.info("{0} / {1} records were already in the database{2}.".format(
+                     num_dups, len(rows), " (replaced)" if on_conflict == 'replace' else ""))
+    return outcomes
+
+def merge_dbs(conn, src_fnames, max_attached=MAX_ATTACHED):
+    """
+    Merges the experiments, manifest entries and jobs of other databases 
+    (e.g. one per month of a year's run) into the one that 'conn' is 
+    connected to. The sources are attached up to max_attached at a time and
+    each group is copied over in a single transaction, entirely within 
+    sqlite. Experiments already in the destination are kept as they are.
+
+    :param conn: [sqlite3 connection] to the destination database (made with
+                    connect_db())
+    :param src_fnames: [list of str] paths to the source databases
+    [:param max_attached:] [int] most sources to attach at once
+
+    :returns: [int] number of experiments added to the destination
+    """
+    exps_cols = ", ".join(EXPS_COLUMNS + EXPS_TS_COLUMNS)
+    manifest_cols = 'fname, size, mtime, content_hash, status, detail, updated_iso'
+    jobs_cols = 'day, station, status, files, bytes, started_iso, updated_iso'
+    cur = conn.cursor()
     conn.commit()
+    cur.execute('SELECT COUNT(*) FROM exps')
+    before = cur.fetchone()[0]
+    for i in range(0, len(src_fnames), max_attached):
+        group = src_fnames[i:i+max_attached]
+        # (Databases can't be attached in the middle of a transaction)
+        aliases = []
+        for j, fname in enumerate(group):
+            aliases.append('src{0}'.format(j))
+            cur.execute('ATTACH DATABASE ? AS {0}'.format(aliases[-1]), (fname,))
+        try:
+            for alias in aliases:
+                cur.execute('INSERT OR IGNORE INTO exps ({0}) SELECT {0} FROM {1}.exps'.format(
+                            exps_cols, alias))
+                cur.execute('INSERT OR REPLACE INTO manifest ({0}) SELECT {0} FROM {1}.manifest'.format(
+                            manifest_cols, alias))
+                cur.execute('INSERT OR REPLACE INTO jobs ({0}) SELECT {0} FROM {1}.jobs'.format(
+                            jobs_cols, alias))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            for alias in aliases:
+                cur.execute('DETACH DATABASE {0}'.format(alias))
+        logging.info("Merged {0}".format(", ".join(group)))
+    cur.execute('SELECT COUNT(*) FROM exps')
+    return cur.fetchone()[0] - before
 
 def copy_db_entries(dbfname_src, dbfname_dest):
     """
@@ -717,16 +1780,16 @@ def copy_db_entries(dbfname_src, dbfname_dest):
     #query = "".join(line for line in src_db.iterdump())
     #dest_db.executescript(query)
 
-    src_cur.execute('select * from exps')
+    src_cur.execute('select {0} from exps'.format(", ".join(EXPS_COLUMNS)))
     fetches = src_cur.fetchall()
     for entry_tuple in fetches:
         try: 
             logging.debug(entry_tuple)
             dest_cur.execute('''INSERT INTO exps (stid, start_iso, end_iso, 
                 cmd_name, cmd_args, cpid, min_nave, times_consistent, not_corrupt,
-                min_tfreq, max_tfreq, xcf) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                entry_tuple)
+                min_tfreq, max_tfreq, xcf, start_ts, end_ts) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                RawacfRecord.record_from_tuple(entry_tuple).to_db_row())
         except sqlite3.IntegrityError:
             logging.error("Unique constraint failed or something.")     
         except sqlite3.OperationalError: 
@@ -16,6 +16,8 @@ import os
 
 import time
 import rawacf_utils as rut
+import rawacf_io
+import rawacf_index
 import parse
 import uptime
 import sqlite3
@@ -134,8 +136,8 @@ def test_err_writers():
         file_contents = f.read()
         test_str = "testfile:\"Test Bad Exception\"\ntestfile:Test Inconsistent Exception\n"    
         if file_contents != test_str:
-            print file_contents
-            print test_str
+            print(file_contents)
+            print(test_str)
             logging.error("test_err_writers() failed!")
     os.remove(test_listfile)
 
@@ -153,19 +155,204 @@ def test_init_log():
 def test_exc_handler():
     """
     Tests whether multiprocessing can be used to spawn an exception handler
-    process.
+    process, and that it writes out everything queued before it's stopped.
     """
     logging.info("Testing the exception handler from parse.py...")
+    test_listfile = 'test_bad_files.txt'
     manager = mp.Manager()
     exc_msg_queue = manager.Queue()
-    p = mp.Process(target=parse.exc_handler_func, args=( exc_msg_queue,))
+    p = mp.Process(target=parse.exc_handler_func, 
+                   args=( exc_msg_queue, test_listfile, test_listfile))
     p.start()
     exc_msg_queue.put(('testfile',Exception("Test")))
-    # Check that the the exception was processed by the handler
-    time.sleep(parse.SHORT_SLEEP_INTERVAL)
-    if not exc_msg_queue.empty():
+    for i in range(3):
+        exc_msg_queue.put(('testfile{0}'.format(i), rut.BadRawacfError('Bad\nException')))
+    exc_msg_queue.put(None)
+    # Check that the the exceptions were processed by the handler
+    p.join(parse.SUBPROC_JOIN_TIMEOUT)
+    if p.is_alive() or not exc_msg_queue.empty():
         logging.error("Exception handler seems to be not doing its job!")
-    p.terminate()
+        p.terminate()
+    with open(test_listfile, 'r') as f:
+        if f.read().count('"BadException"\n') != 3:
+            logging.error("Exception handler didn't write every queued message!")
+    os.remove(test_listfile)
+
+def make_standin_sync_script(src_dir, script_dir):
+    """
+    Writes a stand-in for the Globus sync script which takes the same 
+    arguments (-y YEAR -m MONTH -p PATTERN DEST) but copies the files in
+    src_dir that match PATTERN into DEST.
+
+    :returns: [str] path to the (executable) script
+    """
+    import sys
+    script = os.path.join(script_dir, 'standin_sync.py')
+    with open(script, 'w') as f:
+        f.write("#!{0}\n".format(sys.executable) + 
+                "import fnmatch, os, shutil, sys\n" +
+                "pattern, dest = sys.argv[sys.argv.index('-p') + 1], sys.argv[-1]\n" +
+                "for name in os.listdir({0!r}):\n".format(os.path.abspath(src_dir)) +
+                "    if fnmatch.fnmatch(name, pattern + '*'):\n" +
+                "        shutil.copy(os.path.join({0!r}, name), dest)\n".format(
+                    os.path.abspath(src_dir)) +
+                "        print(name)\n")
+    os.chmod(script, 0o755)
+    return script
+
+def test_fetch():
+    """
+    Tests the asyncio fetch orchestrator in fetch.py against a stand-in sync
+    script which copies files from a local folder.
+    """
+    import tempfile
+    import shutil
+    import fetch
+    logging.info("Testing the sharded fetch orchestrator...")
+    src = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        names = ['20161201.0401.00.bks.rawacf.bz2', '20161201.0401.00.sas.rawacf.bz2',
+                 '20161201.1441.54.han.rawacf.bz2', '20161202.0001.00.sas.rawacf.bz2']
+        for name in names:
+            open(os.path.join(src, name), 'w').close()
+        script = make_standin_sync_script(src, src)
+        backend = fetch.GlobusBackend(sync_script=script)
+        shards = fetch.day_shards(2016, 12, 1, dest, by='station', 
+                                  station_codes=['bks', 'sas', 'han'])
+        fetched = []
+        for shard, returncode in fetch.iter_fetched(backend, shards, concurrency=2):
+            if returncode != 0:
+                logging.error("Problem running the stand-in sync script!")
+            fetched.extend(os.listdir(shard.folder))
+        if sorted(fetched) != sorted(names[:3]):
+            logging.error("Problem with fetch.iter_fetched()!")
+        shards = fetch.day_shards(2016, 12, 1, dest, by='hour')
+        if len(shards) != 24 or backend.query(shards[4])[-2] != '20161201.04*':
+            logging.error("Problem with fetch.day_shards()!")
+    finally:
+        shutil.rmtree(src)
+        shutil.rmtree(dest)
+
+def test_failed_fetch():
+    """
+    Tests that a day whose fetch fails is neither parsed nor marked done, 
+    so that the next run of the month fetches it again.
+    """
+    import tempfile
+    import shutil
+    import fetch
+    logging.info("Testing a month run with a failing fetch...")
+
+    class FailingBackend(fetch.FetchBackend):
+        # Some of the day's files arrive, but the fetch as a whole fails
+        def fetch(self, shard):
+            open(os.path.join(shard.folder, '20161201.0401.00.sas.rawacf'), 'w').close()
+            return 1
+
+    endpoint = getattr(rut, 'ENDPOINT', None)
+    rut.ENDPOINT = tempfile.mkdtemp()
+    conn = rut.connect_db(dbname=TESTDB)
+    try:
+        failed = parse.process_rawacfs_month(2016, 12, conn=conn, days=[1], lookahead=0,
+                                             workers=1, backend=FailingBackend())
+        cur = conn.cursor()
+        status = rut.job_statuses(cur).get(('2016-12-01', rut.ALL_STATIONS))
+        cur.execute('SELECT count(*) FROM manifest')
+        if failed != [1] or status != rut.JOB_FETCHING or cur.fetchone()[0] != 0:
+            logging.error("Problem with a failed fetch in process_rawacfs_month()!")
+        if os.listdir(rut.staging_dir(2016, 12, 1)) != ['20161201.0401.00.sas.rawacf']:
+            logging.error("A failed fetch's folder was cleared!")
+        if parse.plan_day_jobs(conn, 2016, 12, [1]) != [1]:
+            logging.error("A failed fetch won't be retried!")
+    finally:
+        rut.dump_db(conn)
+        shutil.rmtree(rut.ENDPOINT)
+        if endpoint is None:
+            del rut.ENDPOINT
+        else:
+            rut.ENDPOINT = endpoint
+
+def test_failed_shards():
+    """
+    Tests that a day's shards whose fetch fails are retried, and otherwise
+    left in place (unparsed) and reported.
+    """
+    import tempfile
+    import shutil
+    import fetch
+    logging.info("Testing failed shard fetches...")
+
+    class FlakyBackend(fetch.FetchBackend):
+        # 'bks' fails the first time, 'sas' every time
+        def __init__(self):
+            self.attempts = dict()
+        def fetch(self, shard):
+            self.attempts[shard.label] = self.attempts.get(shard.label, 0) + 1
+            open(os.path.join(shard.folder, shard.label + '.txt'), 'w').close()
+            if shard.label == 'sas' or (shard.label == 'bks' and self.attempts['bks'] == 1):
+                return 1
+            return 0
+
+    dest = tempfile.mkdtemp()
+    conn = rut.connect_db(dbname=TESTDB)
+    try:
+        backend = FlakyBackend()
+        failed = fetch.fetch_and_parse_day(2016, 12, 1, conn, backend=backend, dest=dest,
+                                           by='station', station_codes=['bks', 'han', 'sas'],
+                                           workers=1)
+        if [s.label for s in failed] != ['sas'] or \
+                backend.attempts != {'bks': 2, 'han': 1, 'sas': 2}:
+            logging.error("Problem retrying failed shards in fetch_and_parse_day()!")
+        if os.listdir(dest) != ['sas'] or os.listdir(os.path.join(dest, 'sas')) != ['sas.txt']:
+            logging.error("Problem keeping a failed shard's files!")
+        cur = conn.cursor()
+        cur.execute('SELECT count(*) FROM manifest')
+        if cur.fetchone()[0] != 2:
+            logging.error("Problem parsing only the shards that were fetched!")
+    finally:
+        rut.dump_db(conn)
+        shutil.rmtree(dest)
+
+def test_local_mirror():
+    """
+    Tests fetching from a local archive tree with fetch.LocalMirrorBackend.
+    """
+    import tempfile
+    import shutil
+    import fetch
+    logging.info("Testing the local mirror fetch backend...")
+    root = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        month_dir = os.path.join(root, '2016', '12')
+        os.makedirs(month_dir)
+        names = ['20161201.0401.00.bks.rawacf.bz2', '20161201.0401.00.sas.rawacf.bz2',
+                 '20161202.0001.00.sas.rawacf.bz2']
+        for name in names:
+            with open(os.path.join(month_dir, name), 'w') as f:
+                f.write(name)
+        backend = fetch.LocalMirrorBackend(root)
+        shard = fetch.FetchShard('sas', 2016, 12, '20161201*sas', dest)
+        if backend.fetch(shard) != 0 or os.listdir(dest) != names[1:2]:
+            logging.error("Problem fetching from a local mirror!")
+        with open(os.path.join(dest, names[1])) as f:
+            if f.read() != names[1]:
+                logging.error("Local mirror fetched the wrong contents!")
+        # Files already in place are left alone
+        mtime = os.stat(os.path.join(dest, names[1])).st_mtime_ns
+        backend.fetch(shard)
+        if os.stat(os.path.join(dest, names[1])).st_mtime_ns != mtime:
+            logging.error("Local mirror re-fetched a file that was already present!")
+        # Copying should work wherever linking doesn't
+        fetch.link_or_copy(os.path.join(month_dir, names[0]), os.path.join(dest, names[0]))
+        if not os.path.isfile(os.path.join(dest, names[0])):
+            logging.error("Problem with fetch.link_or_copy()!")
+        if backend.fetch(fetch.FetchShard('x', 2017, 1, '2017', dest)) == 0:
+            logging.error("Local mirror didn't notice a missing month!")
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(dest)
 
 # ------------------------------------------------------------------------------
 #                   rawacf_utils.py Tests: Database methods
@@ -197,7 +384,49 @@ def test_reads():
     dics2 = rut.acf_dic(TEST_RAWACF) 
     if type(dics2) != list and type(dics2[0]) is not dict:
         logging.error("Erroneous acf_dic() result! 4")
+
+    # The memory-mapped reader should give the same records as acf_dic()
+    dics3 = rut.mmap_acf_dic(TEST_RAWACF)
+    if len(dics3) != len(dics2) or dics3[0]['time.us'] != dics2[0]['time.us']:
+        logging.error("Erroneous mmap_acf_dic() result! 5")
         
+def test_stream_reads():
+    """
+    Check that the streaming bz2 reader and the metadata-only scanner yield 
+    the same records as the whole-file backscatter read.
+    """
+    logging.info("Testing streamed dmap records from a bz2 file")
+    dics = rut.bz2_dic(TEST_BZFILE1)
+    streamed = list(rut.iter_bz2_dics(TEST_BZFILE1, fields=rut.RAWACF_SCALAR_FIELDS))
+    if len(streamed) != len(dics):
+        logging.error("Erroneous iter_bz2_dics() result! 1")
+    for d, s in zip(dics, streamed):
+        if any(d[k] != s[k] for k in rut.RAWACF_SCALAR_FIELDS):
+            logging.error("Erroneous iter_bz2_dics() result! 2")
+            break
+
+    # The metadata-only scan should see exactly the same scalars
+    if rut.scan_rawacf(TEST_BZFILE1) != streamed:
+        logging.error("Erroneous scan_rawacf() result! 1")
+    dics2 = rut.acf_dic(TEST_RAWACF)
+    scanned = rut.scan_rawacf(TEST_RAWACF)
+    if [dict((k, d[k]) for k in rut.RAWACF_SCALAR_FIELDS) for d in dics2] != scanned:
+        logging.error("Erroneous scan_rawacf() result! 2")
+
+def test_parallel_bz2():
+    """
+    Check that block-parallel bz2 decompression reassembles the same stream
+    as a serial read.
+    """
+    import bz2
+    logging.info("Testing parallel decompression of bz2 blocks")
+    serial = bz2.BZ2File(TEST_BZFILE1, 'rb').read()
+    parallel = b''.join(rawacf_io.iter_bz2_parallel(TEST_BZFILE1, workers=4))
+    if parallel != serial:
+        logging.error("Erroneous iter_bz2_parallel() result!")
+    if rut.scan_rawacf(TEST_BZFILE1, bz2_threads=4) != rut.scan_rawacf(TEST_BZFILE1):
+        logging.error("Erroneous scan_rawacf() result with bz2_threads!")
+
 def test_globus():
     """
     Test for checking that globus functions can work
@@ -233,7 +462,7 @@ def test_db():
     conn.commit()
 
     # Try accessing it? 
-    test_sql = 'select * from exps'
+    test_sql = 'select {0} from exps'.format(", ".join(rut.EXPS_COLUMNS))
     r = rut.select_exps(test_sql, cur)
     if len(r) != 1 and not isinstance(rut.RawacfRecord, r):
         logging.error("Problem with database insert/retrieval!")
@@ -244,6 +473,490 @@ def test_db():
     if r != []:
         logging.error("Problem with dumping database!")   
 
+def test_db_connections():
+    """
+    Tests the connection settings: WAL, read-only readers, and writes that
+    fail loudly (after retrying) rather than being dropped when locked.
+    """
+    import sqlite3
+    logging.info("Testing database connection settings...")
+    # Short timeouts (set before connecting, since open_db() applies them) so
+    # the locked write below fails in milliseconds rather than waiting them out
+    timeout, backoff = rut.DB_BUSY_TIMEOUT, rut.DB_LOCK_BACKOFF
+    rut.DB_BUSY_TIMEOUT, rut.DB_LOCK_BACKOFF = 0.01, 0.01
+    try:
+        conn = rut.connect_db(dbname=TESTDB)
+        if conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+            logging.error("Problem with open_db(): not in WAL mode!")
+        reader = rut.connect_db_readonly(TESTDB)
+        try:
+            reader.execute('DELETE FROM exps')
+            logging.error("Problem with connect_db_readonly(): it can write!")
+        except sqlite3.OperationalError:
+            pass
+        other = rut.open_db(TESTDB)
+        other.execute('BEGIN IMMEDIATE')
+        try:
+            rut.execute_retrying(conn.cursor(), 'INSERT INTO exps (stid, start_iso, end_iso) '
+                                 'VALUES (?, ?, ?)', (3, sample_start_iso, sample_end_iso),
+                                 retries=1)
+            logging.error("Problem with execute_retrying(): a locked write went through!")
+        except sqlite3.OperationalError:
+            pass
+        other.rollback()
+        other.close()
+    finally:
+        rut.DB_BUSY_TIMEOUT, rut.DB_LOCK_BACKOFF = timeout, backoff
+    reader.close()
+    rut.dump_db(conn)
+
+def test_manifest():
+    """
+    Tests that files recorded in the ingest manifest are recognized as done.
+    """
+    logging.info("Testing the ingest manifest...")
+    conn = rut.connect_db(dbname=TESTDB)
+    cur = conn.cursor()
+    folder = os.path.dirname(TEST_RAWACF)
+    fil = os.path.basename(TEST_RAWACF)
+    rut.record_manifest(cur, folder, fil, rut.MANIFEST_ERROR)
+    if fil in rut.manifest_done(cur, folder, [fil]):
+        logging.error("Problem with manifest_done(): retryable file skipped!")
+    rut.record_manifest(cur, folder, fil, rut.MANIFEST_SAVED, use_hash=True)
+    conn.commit()
+    if rut.manifest_done(cur, folder, [fil]) != set([fil]):
+        logging.error("Problem with record_manifest()/manifest_done()!")
+    cur.execute('UPDATE manifest SET mtime = 0 WHERE fname = ?', (fil,))
+    if fil in rut.manifest_done(cur, folder, [fil]) or \
+            fil not in rut.manifest_done(cur, folder, [fil], use_hash=True):
+        logging.error("Problem with manifest_done() mtime/hash matching!")
+    # Entries are keyed by name, so the file is known from elsewhere in a tree
+    parent, sub = os.path.split(folder)
+    rel = os.path.join(sub, fil)
+    if rut.manifest_done(cur, parent, [rel], use_hash=True) != set([rel]):
+        logging.error("Problem with manifest_done() on a relative path!")
+    rut.dump_db(conn)
+
+def test_jobs():
+    """
+    Tests recording and summing up run progress in the jobs table.
+    """
+    from datetime import date
+    logging.info("Testing the jobs table...")
+    conn = rut.connect_db(dbname=TESTDB)
+    cur = conn.cursor()
+    day = date(2016, 12, 1)
+    rut.set_job_status(cur, day, rut.ALL_STATIONS, rut.JOB_PENDING)
+    rut.set_job_status(cur, day, 'sas', rut.JOB_FETCHING, files=2, size=300)
+    rut.set_job_status(cur, day, 'sas', rut.JOB_COMMITTED)
+    rut.set_job_status(cur, date(2016, 12, 2), rut.ALL_STATIONS, rut.JOB_PARSED)
+    statuses = rut.job_statuses(cur, day, date(2016, 12, 2))
+    if statuses != {('2016-12-01', '*'): rut.JOB_PENDING, 
+                    ('2016-12-01', 'sas'): rut.JOB_COMMITTED}:
+        logging.error("Problem with set_job_status()/job_statuses()!")
+    summary = rut.job_summary(cur)
+    if summary[rut.JOB_PENDING] != 1 or summary[rut.JOB_PARSED] != 1 or \
+            summary['station_days'] != 1 or summary['files'] != 2 or summary['bytes'] != 300:
+        logging.error("Problem with job_summary()!")
+    rut.clear_jobs(cur, day)
+    if len(rut.job_statuses(cur)) != 1:
+        logging.error("Problem with clear_jobs()!")
+    rut.dump_db(conn)
+
+def test_merge_dbs():
+    """
+    Tests merging per-month databases into one, as proc_range.py does.
+    """
+    import tempfile
+    import shutil
+    logging.info("Testing merging databases...")
+    tmp = tempfile.mkdtemp()
+    try:
+        srcs = []
+        for i, stid in enumerate([3, 3, 5]):
+            fname = os.path.join(tmp, 'month{0}.sqlite'.format(i))
+            conn = rut.connect_db(dbname=fname)
+            conn.execute('INSERT INTO exps (stid, start_iso, end_iso) VALUES (?, ?, ?)',
+                         (stid, sample_start_iso, sample_end_iso))
+            rut.set_job_status(conn.cursor(), '2016-12-0{0}'.format(i + 1), 
+                               rut.ALL_STATIONS, rut.JOB_COMMITTED)
+            conn.commit()
+            conn.close()
+            srcs.append(fname)
+        conn = rut.connect_db(dbname=os.path.join(tmp, 'merged.sqlite'))
+        # Small groups, to check that attaching them a few at a time works
+        added = rut.merge_dbs(conn, srcs, max_attached=2)
+        if added != 2 or len(rut.job_statuses(conn.cursor())) != 3:
+            logging.error("Problem with merge_dbs()!")
+        conn.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_unfinished_days():
+    """
+    Tests that proc_range.py spots a month whose jobs table isn't all done.
+    """
+    import tempfile
+    import shutil
+    import proc_range
+    logging.info("Testing proc_range's check for unfinished days...")
+    tmp = tempfile.mkdtemp()
+    try:
+        dbname = os.path.join(tmp, proc_range.MONTH_DB)
+        if len(proc_range.unfinished_days(dbname, 2017, 2)) != 28:
+            logging.error("Problem with unfinished_days() for a missing database!")
+        conn = rut.connect_db(dbname=dbname)
+        cur = conn.cursor()
+        for day in range(1, 29):
+            status = rut.JOB_FETCHING if day == 14 else rut.JOB_COMMITTED
+            rut.set_job_status(cur, '2017-02-{0:02d}'.format(day), rut.ALL_STATIONS, status)
+        # Stations (and other months) don't count
+        rut.set_job_status(cur, '2017-02-15', 'sas', rut.JOB_PENDING)
+        rut.set_job_status(cur, '2017-03-01', rut.ALL_STATIONS, rut.JOB_PENDING)
+        conn.commit()
+        conn.close()
+        if proc_range.unfinished_days(dbname, 2017, 2) != ['2017-02-14']:
+            logging.error("Problem with unfinished_days()!")
+    finally:
+        shutil.rmtree(tmp)
+
+def test_index():
+    """
+    Tests building, filtering and sharding a RawacfIndex from filenames.
+    """
+    import tempfile
+    import shutil
+    from datetime import datetime as dt
+    logging.info("Testing the filename-based rawacf index...")
+    if rawacf_index.parse_rawacf_fname('20161201.0401.00.bks.rawacf.bz2') != \
+            (dt(2016, 12, 1, 4, 1), 'bks', None):
+        logging.error("Problem with parse_rawacf_fname()!")
+    if rawacf_index.parse_rawacf_fname('bad_rawacfs.txt') is not None:
+        logging.error("Problem with parse_rawacf_fname() on a non-rawacf!")
+
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, '2016', '12'))
+    os.makedirs(os.path.join(root, '2017', '01'))
+    names = [('2016/12', '20161201.0401.00.bks.rawacf.bz2', 300),
+             ('2016/12', '20161201.0601.00.bks.rawacf.bz2', 300),
+             ('2016/12', '20161201.0401.00.sas.rawacf.bz2', 500),
+             ('2016/12', '20161202.0001.00.sas.a.rawacf', 100),
+             ('2017/01', '20170101.0001.00.sas.rawacf.bz2', 100),
+             ('2016/12', 'notes.txt', 10)]
+    for sub, name, size in names:
+        with open(os.path.join(root, sub, name), 'wb') as f:
+            f.write(b'\0' * size)
+    try:
+        index = rawacf_index.RawacfIndex.from_tree(root)
+        if len(index) != 5 or index.stations() != ['bks', 'sas']:
+            logging.error("Problem with RawacfIndex.from_tree()!")
+        dec1 = index.filter(dt(2016, 12, 1), dt(2016, 12, 2))
+        if len(dec1) != 3 or len(dec1.filter(station_code='sas')) != 1:
+            logging.error("Problem with RawacfIndex.filter()!")
+        if len(rawacf_index.RawacfIndex.from_tree(root, start=dt(2017, 1, 1))) != 1:
+            logging.error("Problem with RawacfIndex.from_tree() date pruning!")
+        shards = index.shard(2)
+        if [len(s.by_day()) for s in shards] != [2, 2] or \
+                sum(s.cost() for s in shards) != index.cost():
+            logging.error("Problem with RawacfIndex.shard()!")
+    finally:
+        shutil.rmtree(root)
+
+def test_save_records():
+    """
+    Tests saving records in bulk, and the per-record outcomes it reports.
+    """
+    from datetime import datetime as dt
+    logging.info("Testing bulk saves of records...")
+    conn = rut.connect_db(dbname=TESTDB)
+    cur = conn.cursor()
+    recs = [rut.RawacfRecord(stid, dt(2016, 12, 1, hr), dt(2016, 12, 1, hr, 30), cpid=1)
+            for stid, hr in [(5, 0), (5, 1), (3, 0)]]
+    if rut.save_records(cur, recs[:1]) != [True]:
+        logging.error("Problem with save_records()!")
+    # One already saved, and one repeated within the batch
+    batch = rut.RecordBatch.from_records(recs + recs[1:2])
+    if rut.save_records(cur, batch) != [False, True, True, False]:
+        logging.error("Problem with save_records() outcomes!")
+    recs[0].cpid = 2
+    rut.save_records(cur, recs[:1], on_conflict='replace')
+    conn.commit()
+    cur.execute('SELECT count(*), max(cpid) FROM exps')
+    if cur.fetchone() != (3, 2):
+        logging.error("Problem with save_records() conflict handling!")
+    rut.dump_db(conn)
+
+def test_select_overlapping():
+    """
+    Tests indexed lookups of the records overlapping a time range.
+    """
+    from datetime import datetime as dt
+    logging.info("Testing range lookups of records...")
+    conn = rut.connect_db(dbname=TESTDB)
+    cur = conn.cursor()
+    recs = [rut.RawacfRecord(5, dt(2016, 11, 30, 23), dt(2016, 12, 1, 1)),
+            rut.RawacfRecord(5, dt(2016, 12, 1, 12), dt(2016, 12, 1, 14, 0, 0, 500)),
+            rut.RawacfRecord(5, dt(2016, 12, 1, 23), dt(2016, 12, 2, 2)),
+            rut.RawacfRecord(5, dt(2016, 12, 2, 2), dt(2016, 12, 2, 4)),
+            rut.RawacfRecord(3, dt(2016, 12, 1, 12), dt(2016, 12, 1, 14))]
+    rut.save_records(cur, recs)
+    batch = rut.select_overlapping(cur, 5, dt(2016, 12, 1), dt(2016, 12, 2))
+    if len(batch) != 3 or batch[0].start_dt != recs[0].start_dt:
+        logging.error("Problem with select_overlapping()!")
+    if list(batch.overlap_seconds(dt(2016, 12, 1), dt(2016, 12, 2))) != [3600., 7200.0005, 3600.]:
+        logging.error("Problem with RecordBatch.overlap_seconds()!")
+    cur.execute('EXPLAIN QUERY PLAN SELECT * FROM exps WHERE stid = 5 AND start_ts >= 0 '
+                'AND start_ts < 10')
+    if 'exps_stid_ts' not in str(cur.fetchall()):
+        logging.error("Range lookups aren't using the (stid, start_ts, end_ts) index!")
+    rut.dump_db(conn)
+
+def test_migrate():
+    """
+    Tests bringing a database without the start_ts/end_ts columns up to date,
+    and migrating a folder of databases in parallel.
+    """
+    import sqlite3
+    import tempfile
+    import shutil
+    import migrate
+    logging.info("Testing database migration...")
+    tmp = tempfile.mkdtemp()
+    try:
+        dbname = os.path.join(tmp, 'old.sqlite')
+        conn = sqlite3.connect(dbname)
+        conn.execute('CREATE TABLE exps (stid integer NOT NULL, start_iso text NOT NULL, '
+                     'end_iso text NOT NULL, cmd_name text, cmd_args text, cpid integer, '
+                     'min_nave integer, times_consistent BOOLEAN, not_corrupt BOOLEAN, '
+                     'min_tfreq integer, max_tfreq integer, xcf integer, '
+                     'PRIMARY KEY (stid, start_iso))')
+        conn.execute('INSERT INTO exps (stid, start_iso, end_iso) VALUES (?, ?, ?)',
+                     (3, '2016-12-01T00:00:00.500000', '2016-12-01T02:00:00.250000'))
+        conn.commit()
+        conn.close()
+        try:
+            rut.connect_db(dbname)
+            logging.error("connect_db() didn't refuse a database needing migration!")
+        except rut.DatabaseSchemaError:
+            pass
+        # uptime.py can't look records up until the start_ts/end_ts are there
+        try:
+            reader = rut.connect_db_readonly(dbname)
+            uptime.stats_day(2016, 12, 1, reader.cursor(), 'kap')
+            reader.close()
+            logging.error("connect_db_readonly() didn't refuse a database without start_ts!")
+        except rut.DatabaseSchemaError:
+            pass
+        if migrate.migrate_db(dbname, batch_size=1) != 1 or migrate.migrate_db(dbname) != 0:
+            logging.error("Problem with migrate_db()!")
+        conn = rut.connect_db(dbname)
+        row = conn.execute('SELECT start_ts, end_ts FROM exps').fetchone()
+        if row != (1480550400, 1480557601) or not rut.check_db(conn.cursor()):
+            logging.error("Problem with the migrated start_ts/end_ts!")
+        if rut.db_version(conn.cursor()) != rut.SCHEMA_VERSION:
+            logging.error("Problem with the migrated schema version!")
+        conn.close()
+        reader = rut.connect_db_readonly(dbname)
+        if abs(uptime.stats_day(2016, 12, 1, reader.cursor(), 'kap') - 7199.75/864.) > 1e-9:
+            logging.error("Problem with stats_day() on the migrated database!")
+        reader.close()
+
+        # A folder of databases, one of which is missing the manifest and jobs
+        # tables and one of which isn't a database at all
+        os.makedirs(os.path.join(tmp, '2016-12'))
+        shutil.copy(dbname, os.path.join(tmp, '2016-12', 'month.sqlite'))
+        conn = sqlite3.connect(os.path.join(tmp, '2016-12', 'month.sqlite'))
+        conn.executescript('DROP TABLE manifest; DROP TABLE jobs; PRAGMA user_version = 0;')
+        conn.close()
+        with open(os.path.join(tmp, 'junk.sqlite'), 'w') as f:
+            f.write('not a database' * 100)
+        dbnames = migrate.find_dbs([tmp])
+        failed = migrate.migrate_dbs(dbnames, jobs=2)
+        if len(dbnames) != 3 or failed != [os.path.join(tmp, 'junk.sqlite')]:
+            logging.error("Problem with migrate_dbs()!")
+        conn = rut.open_db(os.path.join(tmp, '2016-12', 'month.sqlite'), readonly=True)
+        if len(rut.schema_problems(conn.cursor())) > 0:
+            logging.error("Problem with the migrated folder of databases!")
+        conn.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_record_writer():
+    """
+    Tests that parse.RecordWriter commits what it's handed from its own thread.
+    """
+    import tempfile
+    import shutil
+    logging.info("Testing the streaming record writer...")
+    folder = tempfile.mkdtemp()
+    conn = rut.connect_db(dbname=TESTDB)
+    try:
+        names = ['notes{0}.txt'.format(i) for i in range(5)]
+        for name in names:
+            open(os.path.join(folder, name), 'w').close()
+        writer = parse.RecordWriter(conn, folder, batch_size=2, maxsize=1)
+        writer.start()
+        for name in names:
+            writer.put(name, None)
+        writer.close()
+        cur = conn.cursor()
+        cur.execute('SELECT count(*) FROM manifest WHERE status = ?', (rut.MANIFEST_IGNORED,))
+        if cur.fetchone()[0] != len(names) or writer.num_uncounted != len(names):
+            logging.error("Problem with RecordWriter!")
+    finally:
+        rut.dump_db(conn)
+        shutil.rmtree(folder)
+
+def test_memory_retries():
+    """
+    Tests that running out of memory in parse_file() is retried with backoff
+    and, failing that, raised as a ParseRetryError rather than taken to mean
+    the file is bad.
+    """
+    import queue
+    logging.info("Testing parse_file() running out of memory...")
+
+    class FakeRecord(object):
+        not_corrupt = True
+
+    attempts = []
+    def scan_rawacf(fname, bz2_threads=1, fails=1):
+        attempts.append(fname)
+        if len(attempts) <= fails:
+            raise MemoryError()
+        return []
+
+    real_scan, real_make = rut.scan_rawacf, rut.RawacfRecord.record_from_dics
+    real_backoff = parse.RETRY_BACKOFF
+    parse.RETRY_BACKOFF = 0
+    rut.scan_rawacf = scan_rawacf
+    rut.RawacfRecord.record_from_dics = staticmethod(lambda dics: FakeRecord())
+    try:
+        # A passing shortage is ridden out
+        r = parse.parse_file('.', 'x.rawacf', 1, queue.Queue())
+        if not isinstance(r, FakeRecord) or len(attempts) != 2:
+            logging.error("Problem retrying a file that ran out of memory!")
+        # One that doesn't pass is given up on, but only for now
+        del attempts[:]
+        rut.scan_rawacf = lambda fname, bz2_threads=1: scan_rawacf(fname, fails=99)
+        try:
+            parse.parse_file('.', 'x.rawacf', 1, queue.Queue())
+            logging.error("parse_file() didn't give up on running out of memory!")
+        except parse.ParseRetryError:
+            if len(attempts) != parse.MAX_PARSE_RETRIES + 1:
+                logging.error("Problem with the number of retries in parse_file()!")
+        # Likewise while making the record
+        rut.scan_rawacf = lambda fname, bz2_threads=1: []
+        def out_of_memory(dics):
+            raise MemoryError()
+        rut.RawacfRecord.record_from_dics = staticmethod(out_of_memory)
+        try:
+            parse.parse_file('.', 'x.rawacf', 1, queue.Queue())
+            logging.error("parse_file() didn't raise on running out of memory!")
+        except parse.ParseRetryError:
+            pass
+    finally:
+        rut.scan_rawacf = real_scan
+        rut.RawacfRecord.record_from_dics = staticmethod(real_make)
+        parse.RETRY_BACKOFF = real_backoff
+
+def test_memory_budget():
+    """
+    Tests that files too big to share the memory budget are parsed one at a
+    time, with all of them still getting parsed.
+    """
+    import tempfile
+    import shutil
+    logging.info("Testing the worker pool's memory budget...")
+    folder = tempfile.mkdtemp()
+    running = os.path.join(folder, 'running')
+    os.makedirs(running)
+
+    def fake_parse_file(path, fname, index, exc_msg_queue, bz2_threads=1):
+        # Note how many files are being parsed at once (forked workers see this)
+        marker = os.path.join(running, fname)
+        open(marker, 'w').close()
+        with open(os.path.join(folder, 'overlaps.txt'), 'a') as f:
+            f.write("{0}\n".format(len(os.listdir(running))))
+        time.sleep(0.2)
+        os.remove(marker)
+        return None
+
+    real_parse_file = parse.parse_file
+    parse.parse_file = fake_parse_file
+    exc_msg_queue, write_handler = parse.start_exc_handler()
+    try:
+        names = ['{0}.rawacf'.format(i) for i in range(4)]
+        for name in names:
+            with open(os.path.join(folder, name), 'w') as f:
+                f.write('x' * 1000)
+        results = list(parse.parse_files_parallel(folder, names, exc_msg_queue, workers=4,
+                                                  chunksize=1, memory_budget=100))
+        with open(os.path.join(folder, 'overlaps.txt')) as f:
+            overlaps = [int(line) for line in f]
+        if sorted(r[0] for r in results) != names or max(overlaps) != 1:
+            logging.error("Problem with parsing big files one at a time!")
+    finally:
+        parse.parse_file = real_parse_file
+        parse.stop_exc_handler(exc_msg_queue, write_handler)
+        shutil.rmtree(folder)
+
+def test_pool_recycling():
+    """
+    Tests that parse_files_parallel() gets through files which hang or kill
+    their worker, and what ends up in the manifest for them.
+    """
+    import tempfile
+    import shutil
+    logging.info("Testing hung and crashed workers...")
+
+    def fake_parse_file(path, fname, index, exc_msg_queue, bz2_threads=1):
+        # (The pool's workers are forked, so they see this too)
+        if fname.startswith('hang'):
+            time.sleep(60)
+        elif fname.startswith('die'):
+            os._exit(1)
+        return None
+
+    folder = tempfile.mkdtemp()
+    conn = rut.connect_db(dbname=TESTDB)
+    real_parse_file = parse.parse_file
+    parse.parse_file = fake_parse_file
+    try:
+        names = ['hang.rawacf', 'die.rawacf', 'ok1.rawacf', 'ok2.rawacf']
+        for name in names:
+            open(os.path.join(folder, name), 'w').close()
+        t0 = time.time()
+        parse.parse_rawacf_files(folder, names, conn, workers=2, file_timeout=1)
+        cur = conn.cursor()
+        cur.execute('SELECT fname, status FROM manifest')
+        statuses = dict(cur.fetchall())
+        if statuses != {'hang.rawacf': rut.MANIFEST_TIMEOUT, 'die.rawacf': rut.MANIFEST_CRASHED,
+                        'ok1.rawacf': rut.MANIFEST_BAD, 'ok2.rawacf': rut.MANIFEST_BAD}:
+            logging.error("Problem with the manifest after hung/crashed workers: {0}".format(
+                          statuses))
+        if time.time() - t0 > 30:
+            logging.error("Hung workers weren't killed in time!")
+        # A crash is worth retrying; a timeout isn't
+        if rut.manifest_done(cur, folder, names) != set(names) - set(['die.rawacf']):
+            logging.error("Problem with retrying a crashed file!")
+    finally:
+        parse.parse_file = real_parse_file
+        rut.dump_db(conn)
+        shutil.rmtree(folder)
+
+def test_plan_tasks():
+    """
+    Tests that plan_tasks() orders files largest first and batches small ones.
+    """
+    logging.info("Testing the largest-first task planning...")
+    stats = {'big.rawacf': (1000, 0), 'mid.rawacf': (600, 0), 
+             'a.rawacf': (100, 0), 'b.rawacf': (100, 0), 'c.rawacf': (100, 0)}
+    tasks = parse.plan_tasks('.', sorted(stats), stats, batch_cost=500, max_batch=2)
+    if [[fil for i, fil in batch] for cost, mem, batch in tasks] != \
+            [['big.rawacf'], ['mid.rawacf'], ['c.rawacf', 'b.rawacf'], ['a.rawacf']]:
+        logging.error("Problem with plan_tasks()!")
+
 # ------------------------------------------------------------------------------
 #                   rawacf_utils.py Tests: Utility Methods
 # ------------------------------------------------------------------------------
@@ -255,12 +968,12 @@ def test_check_fields():
     """
     logging.info("Testing the field-checking for dmap entries...")
     objection_dict = rut.check_fields(test_dmap_dicts) 
-    test1 = objection_dict.keys() == []
+    test1 = len(objection_dict) == 0
 
     # Needs to be able to deal with a non-splittable command name without breaking 
     test_dmap_dicts[0]['origin.command'] = "test"
     objection_dict = rut.check_fields(test_dmap_dicts) 
-    test2 = objection_dict.keys() == []
+    test2 = len(objection_dict) == 0
 
     # Needs to detect cpid inconsistency
     tmp = test_dmap_dicts[0]['cp']
@@ -282,6 +995,22 @@ def test_check_fields():
     if not(test1 and test2 and test3 and test4 and test5):
         logging.error("Problem wth check_fields()!")
 
+def test_timestamps():
+    """
+    Tests that the vectorized timestamps from rawacf_timestamps() agree with
+    reconstruct_datetime() record by record.
+    """
+    logging.info("Testing the columnar timestamps for dmap entries...")
+    dmap_dicts = rut.acf_dic(TEST_RAWACF)
+    cols = rut.rawacf_columns(dmap_dicts)
+    ts = rut.rawacf_timestamps(cols)
+    for t, d in zip(ts, dmap_dicts):
+        if rut.us_to_dt(t) != rut.reconstruct_datetime(d):
+            logging.error("Problem with rawacf_timestamps()!")
+            break
+    if rut.dt_to_us(rut.us_to_dt(ts[0])) != ts[0]:
+        logging.error("Problem with us_to_dt()/dt_to_us()!")
+
 def test_records():
     """
     Tests the creation of RawacfRecord objects and their use.
@@ -305,7 +1034,7 @@ def test_records():
     # recs = rut.select_exps('select * from exps', cur)
     
     # Testing record_from_tuple()
-    cur.execute('select * from exps')
+    cur.execute('select {0} from exps'.format(", ".join(rut.EXPS_COLUMNS)))
     recs = cur.fetchall()
     tup = recs[0]
     if type(tup) != tuple:
@@ -323,6 +1052,34 @@ def test_records():
     if type(dur) != float:
         logging.error("Error with duration()")
 
+def test_record_batch():
+    """
+    Tests that a RecordBatch round-trips the records it's built from.
+    """
+    logging.info("Testing RecordBatch construction and indexing...")
+    r = rut.RawacfRecord.record_from_dics(rut.acf_dic(TEST_RAWACF))
+    batch = rut.RecordBatch.from_records([r, r])
+    if len(batch) != 2 or batch[1].start_dt != r.start_dt or batch[0].cpid != r.cpid:
+        logging.error("Problem with RecordBatch.from_records()!")
+    if list(batch.durations()) != [r.duration(), r.duration()]:
+        logging.error("Problem with RecordBatch.durations()!")
+    rows_batch = rut.RecordBatch.from_rows(batch.to_rows())
+    if rows_batch.to_rows() != batch.to_rows():
+        logging.error("Problem with RecordBatch.from_rows()!")
+    # The bulk conversions should match the records' own, whole seconds included
+    from datetime import datetime as dt
+    r2 = rut.RawacfRecord(3, dt(2016, 12, 1, 4, 1), dt(2016, 12, 1, 6, 1, 0, 500), "x", "-y")
+    batch = rut.RecordBatch.from_records([r, r2])
+    if batch.to_db_rows() != [r.to_db_row(), r2.to_db_row()] or \
+            [rec.to_row() for rec in batch] != batch.to_rows():
+        logging.error("Problem with RecordBatch.to_rows()/to_db_rows()!")
+    # Rows are views into the batch
+    view = batch[-1]
+    view.cpid = 42
+    if not isinstance(view, rut.RawacfRecord) or batch.data['cpid'][1] != 42 or \
+            batch[1].cpid != 42 or view.cmd_name != "x":
+        logging.error("Problem with RecordBatch's row views!")
+
 if __name__=="__main__":
     rut.read_config()
     rut.globus_connect()
@@ -335,11 +1092,33 @@ if __name__=="__main__":
    
     parse.initialize_logger(quiet_mode=False)#True)
     test_reads()
+    test_stream_reads()
+    test_parallel_bz2()
     test_check_fields() 
+    test_timestamps()
     test_db()
+    test_db_connections()
+    test_manifest()
+    test_jobs()
+    test_merge_dbs()
+    test_unfinished_days()
+    test_index()
+    test_save_records()
+    test_select_overlapping()
+    test_migrate()
+    test_record_writer()
+    test_plan_tasks()
+    test_memory_retries()
+    test_memory_budget()
+    test_pool_recycling()
     test_records() # Requires reads(), fields(), db() to have been tested before.
+    test_record_batch()
 
     test_exc_handler()
+    test_fetch()
+    test_local_mirror()
+    test_failed_fetch()
+    test_failed_shards()
     test_err_writers()
 
     #test_process_rawacfs()
@@ -14,9 +14,10 @@ date: June 20 2017
 """
 import logging
 import os
+import sys
 import argparse
 
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 import numpy as np
 import sqlite3
 import calendar
@@ -104,37 +105,20 @@ def stats_day(year, month, day, cur, code=None):
     if code is None:
         logging.warning("No station code given, proceeding with default, Saskatoon ('sas')")
 
-    date_str = str(year) + two_pad(month) + two_pad(day)
-    date_str_iso = str(year) + "-" + two_pad(month) + "-" + two_pad(day)
-
-    uptime_on_day = dict()
+    day_start = dt(year, month, day)
+    day_end = day_start + timedelta(days=1)
 
+    # Every record overlapping the day (including any which span all of it),
+    # looked up by the (stid, start_ts, end_ts) index
     stid = rut.get_stid(code)
-    sql = "select * from exps where (start_iso like '%{0}%' or end_iso like '%{1}%') and stid='{2}'"
-    recs = rut.select_exps(sql.format(date_str_iso, date_str_iso, stid), cur)
-
-    for r in recs:
-        logging.debug("Looking at record from {0} to {1}".format(r.start_dt, r.end_dt))
-        st = r.start_dt
-        et = r.end_dt
-        if rut.get_datestr(st) != rut.get_datestr(et):
-            logging.debug("\tStart date not the same as end date?")
-            if date_str == rut.get_datestr(st):
-                logging.debug("\tSpecial case: end-of-day record")
-                seconds_this_day = SEC_IN_DAY - rut.get_tod_seconds(st)
-            elif date_str == rut.get_datestr(et):
-                logging.debug("\tSpecial case: start-of-day record")
-                seconds_prev_day = SEC_IN_DAY - rut.get_tod_seconds(st)
-                seconds_this_day = r.duration() - seconds_prev_day                
-            else: 
-                # This shouldn't ever happen
-                raise Exception('Unexpected start date and end date discrepancies?')
-        else:
-            seconds_this_day = r.duration()
-        logging.debug("Seconds of operation for this record: {0}\n".format(seconds_this_day)) 
-        uptime_on_day[r] = seconds_this_day 
+    recs = rut.select_overlapping(cur, stid, day_start, day_end)
+
+    # Only the part of each record within the day counts towards it
+    seconds_this_day = recs.overlap_seconds(day_start, day_end)
+    logging.debug("{0} records overlapping {1}, for {2} s of operation".format(
+                  len(recs), day_start.date(), seconds_this_day.sum()))
     
-    uptime_pct = sum(uptime_on_day.values())/SEC_IN_DAY * 100.
+    uptime_pct = seconds_this_day.sum()/SEC_IN_DAY * 100.
     return uptime_pct
 
 def stats_month(year, month, cur, code=None):
@@ -156,14 +140,13 @@ def stats_summary(cur):
     """
     Informational overview of timespan of entries in DB
     """
-    sql = "select * from exps"
-    recs = rut.select_exps(sql, cur)
-    if type(recs)!=list or len(recs)==0:
+    cur.execute("select min(start_iso), max(start_iso) from exps")
+    first, last = cur.fetchone()
+    if first is None:
         logging.warning("No entries in database!")
     else:
-        times = [ r.start_dt for r in recs ]
-        first = min(times)
-        last = max(times)
+        first = rut.iso_to_dt(first)
+        last = rut.iso_to_dt(last)
         print("Entries in database span {0} through {1}".format(first, last))
     return None
 
@@ -291,12 +274,19 @@ if __name__ == "__main__":
     rut.read_config()
     if db_file is not None:
         logging.info("Going with specified database {0}".format(db_file))
-        conn = rut.connect_db(db_file)
-        cur = conn.cursor()     
     else:
         logging.info("Going with default database 'superdarntimes.sqlite'")
-        conn = rut.connect_db()
-        cur = conn.cursor()
+        db_file = "superdarntimes.sqlite"
+    # Only reading, so this can run alongside a parse.py that's saving to it
+    try:
+        if os.path.isfile(db_file):
+            conn = rut.connect_db_readonly(db_file)
+        else:
+            conn = rut.connect_db(db_file)
+    except rut.DatabaseSchemaError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    cur = conn.cursor()
     stats = process_args(year, month, day, st_code, use_verbose, cur)
     if stats is not None:  
         print("\nStatistics are shown below for selected period:")